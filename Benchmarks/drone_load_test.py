@@ -0,0 +1,96 @@
+"""
+Нагрузочный тест API беспилотников: несколько потоков одновременно отправляют запросы маршрута
+на /api/find_drone_path и считают задержки, пропускную способность и ошибки.
+
+Пример: python Benchmarks/drone_load_test.py --url http://127.0.0.1:8000 --concurrency 16 --requests 200
+"""
+import argparse
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Точки из примера в README: отправление и прибытие внутри одной утвержденной области
+DEFAULT_START_POINT = [41.112852, 140.715037]
+DEFAULT_END_POINT = [41.611078, 141.231892]
+
+
+def send_request(url, start_point, end_point, timeout):
+    body = json.dumps({'start_point': start_point, 'end_point': end_point}).encode('utf-8')
+    request = urllib.request.Request(url=f'{url}/api/find_drone_path', data=body, method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+            response.read()
+    except urllib.error.HTTPError as exc:
+        # 400 - маршрут не найден, это штатный ответ API, а не сбой сервера
+        status = exc.code
+    except (urllib.error.URLError, TimeoutError) as exc:
+        return time.perf_counter() - start, type(exc).__name__
+    return time.perf_counter() - start, status
+
+
+def jitter_point(point, jitter):
+    return [point[0] + random.uniform(-jitter, jitter), point[1] + random.uniform(-jitter, jitter)]
+
+
+def run_load_test(url, concurrency, requests_count, start_point, end_point, jitter, timeout):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        test_start = time.perf_counter()
+        futures = [executor.submit(send_request, url, jitter_point(start_point, jitter),
+                                   jitter_point(end_point, jitter), timeout)
+                   for _ in range(requests_count)]
+        results = [future.result() for future in futures]
+        total_time = time.perf_counter() - test_start
+
+    latencies = np.array([latency for latency, _ in results])
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'requests': requests_count,
+        'total_time': round(total_time, 3),
+        'requests_per_second': round(requests_count / total_time, 2),
+        'latency_p50': round(float(np.percentile(latencies, 50)), 3),
+        'latency_p95': round(float(np.percentile(latencies, 95)), 3),
+        'latency_p99': round(float(np.percentile(latencies, 99)), 3),
+        'latency_max': round(float(latencies.max()), 3),
+        'statuses': statuses,
+        # Ошибки сервера и сети; 400 (маршрут не найден) к ним не относится
+        'errors': sum(count for status, count in statuses.items() if status not in ('200', '400'))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест API беспилотников')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--start-point', type=float, nargs=2, default=DEFAULT_START_POINT)
+    parser.add_argument('--end-point', type=float, nargs=2, default=DEFAULT_END_POINT)
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='случайный сдвиг точек в градусах, чтобы запросы не были одинаковыми')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    # Первые запросы загружают граф в память воркеров, в замеры они не входят
+    warmup = run_load_test(args.url, args.concurrency, args.concurrency, args.start_point, args.end_point,
+                           args.jitter, args.timeout)
+    print(f'Прогрев: {warmup["requests"]} запросов, максимум {warmup["latency_max"]} сек., '
+          f'статусы {warmup["statuses"]}')
+
+    result = run_load_test(args.url, args.concurrency, args.requests, args.start_point, args.end_point,
+                           args.jitter, args.timeout)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
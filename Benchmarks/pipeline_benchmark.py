@@ -0,0 +1,382 @@
+"""
+Воспроизводимый замер всего конвейера на синтетических данных АИС: судоходные коридоры, пересекающие
+друг друга, разброс судов поперек коридора, пропуски в сигнале и шум. Этапы: загрузка датасета
+(process_and_store_dataset) с линейной и со сплайновой интерполяцией, кластеризация, построение графа
+и поиск пути (GraphBuilder.build_graph) - по построенному графу, по графу из БД и по утвержденному графу.
+Тайлы карты не загружаются, вместо них подставляются пустые - замер работает без сети.
+
+Результат - JSON со временем каждого этапа и вкладом span-этапов из Helpers/metrics.py (dbscan, hull,
+db_io и др.); с --baseline результат сравнивается с сохраненным ранее прогоном.
+
+Пример: python Benchmarks/pipeline_benchmark.py --vessels 80 --reports 100 --output before.json
+        python Benchmarks/pipeline_benchmark.py --vessels 80 --reports 100 --baseline before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from cairo import ImageSurface, Context, FORMAT_ARGB32
+from flask import Flask
+from sqlalchemy.engine import Engine
+from werkzeug.datastructures import FileStorage
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import Visualization.visualization as visualization  # noqa: E402
+from Clustering.clustering import clustering  # noqa: E402
+from DataMovements.data_movements import process_and_store_dataset, approve_graph  # noqa: E402
+from DataMovements.model import db, User, Datasets, PositionsCleaned, Graphs, GraphVertexes, GraphEdges, \
+    READ_ONLY_BIND, install_sqlite_pragmas  # noqa: E402
+from FindPath.find_path import find_path  # noqa: E402
+from Helpers.metrics import span_duration, instrument_engine  # noqa: E402
+from Helpers.run_log import run_log  # noqa: E402
+from Main.main import load_clustering_params, load_graph_params  # noqa: E402
+
+# Область по умолчанию - Сангарский пролив, как в примерах данных: запад, юг, восток, север
+DEFAULT_BBOX = (140.5, 41.0, 141.5, 41.7)
+# Начало отсчета времени сообщений; от него зависит хэш датасета, поэтому оно фиксировано
+BASE_TIME = datetime(2024, 1, 1)
+# Интервал между сообщениями судна в минутах (среднее экспоненциального распределения)
+REPORT_INTERVAL_MINUTES = 3.0
+# Доля интервалов с пропуском сигнала и его длительность: длиннее max_gap_minutes, чтобы делить трек
+GAP_SHARE = 0.03
+GAP_MINUTES = (40, 120)
+# Ширина коридора (стандартное отклонение смещения судна поперек коридора) в градусах
+LANE_WIDTH = 0.01
+# Доля сообщений с course=511 и судов с длиной 0 - такие данные отбрасывает clean_positions
+INVALID_COURSE_SHARE = 0.01
+INVALID_VESSEL_SHARE = 0.02
+MAX_GAP_MINUTES = 30
+
+
+install_sqlite_pragmas(Engine)
+instrument_engine(Engine)
+
+
+def blank_tile(tile, min_x, min_y, tile_size, headers):
+    """
+    Замена load_tile: тайл цвета воды вместо загрузки с openstreetmap.
+    """
+    img = ImageSurface(FORMAT_ARGB32, tile_size[0], tile_size[1])
+    ctx = Context(img)
+    ctx.set_source_rgb(0.67, 0.83, 0.87)
+    ctx.paint()
+    return img, (tile.x - min_x) * tile_size[0], (tile.y - min_y) * tile_size[0]
+
+
+def generate_lanes(lanes_count, bbox, rng):
+    """
+    Коридоры по очереди идут с запада на восток и с юга на север через всю область,
+    поэтому каждый коридор одного направления пересекает каждый коридор другого.
+    Возвращает список пар точек (широта, долгота).
+    """
+    west, south, east, north = bbox
+    lanes = []
+    for i in range(lanes_count):
+        share_start, share_end = rng.uniform(0.1, 0.9, 2)
+        if i % 2 == 0:
+            lanes.append(((south + share_start * (north - south), west), (south + share_end * (north - south), east)))
+        else:
+            lanes.append(((south, west + share_start * (east - west)), (north, west + share_end * (east - west))))
+    return lanes
+
+
+def generate_track(vessel_id, lane, reports, rng):
+    """
+    Трек одного судна: движение вдоль коридора туда и обратно с постоянной скоростью,
+    смещение поперек коридора, пропуски сигнала и разброс скорости и курса.
+    """
+    (lat_start, lon_start), (lat_end, lon_end) = lane
+    cos_lat = math.cos(math.radians((lat_start + lat_end) / 2))
+    lane_length = math.hypot(lat_end - lat_start, (lon_end - lon_start) * cos_lat) * 60  # морские мили
+    lane_course = math.degrees(math.atan2((lon_end - lon_start) * cos_lat, lat_end - lat_start)) % 360
+
+    intervals = rng.exponential(REPORT_INTERVAL_MINUTES, reports) + 0.5
+    gaps = rng.random(reports) < GAP_SHARE
+    intervals[gaps] = rng.uniform(*GAP_MINUTES, gaps.sum())
+    minutes = rng.uniform(0, 600) + np.cumsum(intervals)
+
+    knots = rng.uniform(8, 16)
+    phase = rng.uniform(0, 2) + knots * (minutes - minutes[0]) / 60 / lane_length
+    phase %= 2
+    forward = phase < 1
+    share = np.where(forward, phase, 2 - phase)
+
+    # Смещение поперек коридора: постоянное для судна и небольшое от сообщения к сообщению
+    offset = rng.normal(0, LANE_WIDTH) + rng.normal(0, LANE_WIDTH / 5, reports)
+    normal_lat, normal_lon = -(lon_end - lon_start) * cos_lat, lat_end - lat_start
+    norm = math.hypot(normal_lat, normal_lon)
+    lat = lat_start + share * (lat_end - lat_start) + offset * normal_lat / norm
+    lon = lon_start + share * (lon_end - lon_start) + offset * normal_lon / norm / cos_lat
+
+    course = (lane_course + np.where(forward, 0, 180) + rng.normal(0, 3, reports)) % 360
+    # Скорость в АИС - в десятых долях узла
+    speed = np.clip(knots * 10 + rng.normal(0, 5, reports), 0, None)
+    return pd.DataFrame({'id_marine': vessel_id, 'lat': lat, 'lon': lon, 'speed': speed.round(1),
+                         'course': course.round(1), 'minutes': minutes})
+
+
+def generate_traffic(vessels, reports, lanes_count, noise_share, bbox, rng):
+    """
+    Синтетические данные АИС в формате входных файлов: позиции (id_marine, lat, lon, speed, course,
+    date_add, age) и суда (id_marine, port, length). Кроме треков в коридорах добавляются шумовые
+    сообщения в случайных точках области и данные, которые отбрасывает очистка.
+    """
+    west, south, east, north = bbox
+    lanes = generate_lanes(lanes_count, bbox, rng)
+    tracks = [generate_track(vessel_id, lanes[rng.integers(lanes_count)], reports, rng)
+              for vessel_id in range(1, vessels + 1)]
+    df_data = pd.concat(tracks, ignore_index=True)
+
+    noise = rng.random(len(df_data)) < noise_share
+    noise_count = int(noise.sum())
+    df_data.loc[noise, 'lat'] = rng.uniform(south, north, noise_count)
+    df_data.loc[noise, 'lon'] = rng.uniform(west, east, noise_count)
+    df_data.loc[noise, 'speed'] = rng.uniform(0, 250, noise_count).round(1)
+    df_data.loc[noise, 'course'] = rng.uniform(0, 360, noise_count).round(1)
+    df_data.loc[rng.random(len(df_data)) < INVALID_COURSE_SHARE, 'course'] = 511
+
+    # date_add - время получения сообщения, age - его возраст в минутах. Время - с точностью до минуты:
+    # линейная интерполяция достраивает трек по минутной сетке от первого сообщения судна
+    df_data['age'] = rng.integers(0, 3, len(df_data))
+    date_add = BASE_TIME + pd.to_timedelta(df_data['minutes'].round() + df_data['age'], unit='m')
+    df_data['date_add'] = date_add.dt.strftime('%Y-%m-%d %H:%M:%S')
+    df_data = df_data[['id_marine', 'lat', 'lon', 'speed', 'course', 'date_add', 'age']]
+
+    df_marine = pd.DataFrame({'id_marine': range(1, vessels + 1), 'port': 'JP BENCH',
+                              'length': rng.integers(20, 300, vessels)})
+    df_marine.loc[rng.random(vessels) < INVALID_VESSEL_SHARE, 'length'] = 0
+    return df_data, df_marine, lanes
+
+
+def to_csv_file(df, file_name):
+    """
+    Файл в том виде, в каком его присылает форма загрузки.
+    """
+    content = df.to_csv(sep=';', decimal=',', index=False).encode('utf-8')
+    return FileStorage(stream=io.BytesIO(content), filename=file_name)
+
+
+def route_points(lane):
+    """
+    Точки маршрута внутри коридора, чуть отступив от границ области, в формате формы: 'широта, долгота'.
+    """
+    (lat_start, lon_start), (lat_end, lon_end) = lane
+    start = f'{lat_start + 0.1 * (lat_end - lat_start)}, {lon_start + 0.1 * (lon_end - lon_start)}'
+    end = f'{lat_start + 0.9 * (lat_end - lat_start)}, {lon_start + 0.9 * (lon_end - lon_start)}'
+    return start, end
+
+
+def create_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.config['SQLALCHEMY_BINDS'] = {READ_ONLY_BIND: 'sqlite:///file:' + db_path + '?mode=ro&uri=true'}
+    db.init_app(app)
+    return app
+
+
+def run_stage(stages, name, func, *args):
+    """
+    Выполняет этап и записывает его время и прирост гистограммы span-этапов за время выполнения.
+    """
+    spans_before = span_duration.snapshot()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    spans = {}
+    for labels, (count, total) in span_duration.snapshot().items():
+        count_before, total_before = spans_before.get(labels, (0, 0.0))
+        if count > count_before:
+            spans[labels[0]] = {'count': count - count_before, 'seconds': round(total - total_before, 3)}
+    stages.append({'stage': name, 'seconds': round(seconds, 3), 'spans': spans})
+    print(f'{name}: {seconds:.3f} сек.', file=sys.stderr)
+    return result, stages[-1]
+
+
+def route_summary(result):
+    """
+    Краткий итог поиска: из результата интерфейса (изображение, словарь, extent) или ответа беспилотнику.
+    """
+    result_graph = result[1] if isinstance(result, tuple) else result
+    error = result_graph.get('Error') or result_graph.get('error')
+    return {'found': not error, 'error': error}
+
+
+def run_pipeline(args, rng):
+    df_data, df_marine, lanes = generate_traffic(args.vessels, args.reports, args.lanes, args.noise,
+                                                 args.bbox, rng)
+    stages = []
+    app = create_app(os.path.join(os.getcwd(), 'benchmark.db'))
+    with app.app_context():
+        db.create_all()
+        user = User(username='benchmark')
+        user.set_password('benchmark')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    datasets = {}
+    for algorithm in ('linear', 'spline'):
+        with app.app_context():
+            dataset_name = f'benchmark_{algorithm}'
+            (success, message), stage = run_stage(
+                stages, f'ingest_{algorithm}', process_and_store_dataset, to_csv_file(df_data, 'positions.csv'),
+                to_csv_file(df_marine, 'marine.csv'), dataset_name, user_id, True, algorithm, MAX_GAP_MINUTES)
+            if not success:
+                raise RuntimeError(message)
+            dataset_id = db.session.query(Datasets.id).filter_by(dataset_name=dataset_name).scalar()
+            stage['positions'] = db.session.query(PositionsCleaned).filter_by(dataset_id=dataset_id).count()
+            datasets[algorithm] = dataset_id
+
+    clustering_params = dict(load_clustering_params(), dataset_id=datasets[args.cluster_dataset])
+    with app.app_context():
+        (_, result_clustering, _, cl_hash_id), stage = run_stage(stages, 'clustering', clustering,
+                                                                   dict(clustering_params))
+        stage['clusters'] = int(result_clustering['Всего кластеров'])
+    # Повторный запрос с теми же параметрами берет кластеры из БД и только рисует карту
+    with app.app_context():
+        run_stage(stages, 'clustering_stored', clustering, dict(clustering_params))
+
+    start_coords, end_coords = route_points(lanes[0])
+    graph_params = dict(load_graph_params(), dataset_id=clustering_params['dataset_id'], cl_hash_id=cl_hash_id)
+    route_params = dict(graph_params, start_coords=start_coords, end_coords=end_coords)
+    skipped_stages = []
+    with app.app_context():
+        result, stage = run_stage(stages, 'graph_build_and_search', find_path, dict(route_params),
+                                  clustering_params, cl_hash_id)
+        stage.update(route_summary(result))
+        graph_id = result[1].get('ID графа')
+        if graph_id is not None:
+            stage['vertexes'] = db.session.query(GraphVertexes).filter_by(graph_id=graph_id).count()
+            stage['edges'] = db.session.query(GraphEdges).filter_by(graph_id=graph_id).count()
+
+    if graph_id is None:
+        # Граф не сохранен (на малых данных между точками маршрута может не быть пути):
+        # загружать и утверждать нечего, ошибка остается в этапе graph_build_and_search
+        skipped_stages = ['search_stored_graph', 'approve_graph'] + \
+                         [f'search_approved_graph_{i}' for i in range(args.searches)]
+        print(f'Граф не построен, пропущены этапы: {", ".join(skipped_stages)}', file=sys.stderr)
+    else:
+        # Тот же граф загружается из БД (load_graph), поиск выполняется заново
+        with app.app_context():
+            result, stage = run_stage(stages, 'search_stored_graph', find_path, dict(route_params),
+                                      clustering_params, cl_hash_id)
+            stage.update(route_summary(result))
+
+        # Утвержденный граф: иерархия стягивания строится при утверждении, поиск идет как в API беспилотников
+        with app.app_context():
+            _, stage = run_stage(stages, 'approve_graph', approve_graph, graph_id)
+            gr_hash_id = db.session.get(Graphs, graph_id).hash_id
+        for i in range(args.searches):
+            start_coords, end_coords = route_points(lanes[i % len(lanes)])
+            with app.app_context():
+                result, stage = run_stage(stages, f'search_approved_graph_{i}', find_path,
+                                          dict(graph_params, start_coords=start_coords, end_coords=end_coords),
+                                          clustering_params, cl_hash_id, gr_hash_id)
+                stage.update(route_summary(result))
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    return {'positions_generated': len(df_data), 'stages': stages, 'skipped_stages': skipped_stages,
+            'total_seconds': round(sum(stage['seconds'] for stage in stages), 3)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(result, baseline):
+    """
+    Отношение времени этапов к сохраненному прогону: меньше 1 - быстрее, больше 1 - медленнее.
+    """
+    baseline_stages = {stage['stage']: stage['seconds'] for stage in baseline['stages']}
+    baseline_stages['total'] = baseline['total_seconds']
+    comparison = {}
+    for stage in result['stages'] + [{'stage': 'total', 'seconds': result['total_seconds']}]:
+        baseline_seconds = baseline_stages.get(stage['stage'])
+        if baseline_seconds is None:
+            continue
+        comparison[stage['stage']] = {
+            'baseline': baseline_seconds,
+            'current': stage['seconds'],
+            'ratio': round(stage['seconds'] / baseline_seconds, 3) if baseline_seconds else None
+        }
+    return {
+        'baseline_revision': baseline.get('revision'),
+        # Сравнивать имеет смысл только прогоны на одинаковых данных
+        'same_parameters': baseline.get('parameters') == result['parameters'],
+        'stages': comparison
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер конвейера обработки на синтетических данных АИС')
+    parser.add_argument('--vessels', type=int, default=80)
+    parser.add_argument('--reports', type=int, default=100, help='сообщений АИС на одно судно')
+    parser.add_argument('--lanes', type=int, default=4, help='судоходных коридоров')
+    parser.add_argument('--noise', type=float, default=0.05, help='доля шумовых сообщений')
+    parser.add_argument('--bbox', type=float, nargs=4, default=DEFAULT_BBOX,
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cluster-dataset', choices=['linear', 'spline'], default='linear',
+                        help='какой из загруженных датасетов кластеризовать')
+    parser.add_argument('--searches', type=int, default=4, help='поисков по утвержденному графу')
+    parser.add_argument('--output', help='файл для сохранения результата в JSON')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    visualization.load_tile = blank_tile
+    rng = np.random.default_rng(args.seed)
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Изображения, журнал запусков и снимки датасетов пишутся относительно рабочего каталога
+        os.chdir(work_dir)
+        for path in ('static/images/clean', 'static/images/clustered', 'DB/cache'):
+            os.makedirs(path)
+        try:
+            # Сообщения самого приложения - в stderr, в stdout только итоговый JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                pipeline = run_pipeline(args, rng)
+        finally:
+            run_log.flush()
+            os.chdir(previous_dir)
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}
+    parameters['bbox'] = list(parameters['bbox'])
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': parameters,
+        **pipeline
+    }
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            result['comparison'] = compare_with_baseline(result, json.load(f))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Замер конкурентной работы с SQLite: загрузка датасетов (store_dataset) пишет в БД, пока несколько
+процессов, как воркеры gunicorn, выполняют чтения маршрутизации беспилотников (find_approved_graphs + load_graph).
+Сравниваются прагмы по умолчанию (журнал отката, только foreign_keys) и SQLITE_PRAGMAS (WAL и др.).
+
+Пример: python Benchmarks/sqlite_concurrency.py --positions 1000000 --ingests 3 --readers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import mercantile
+import numpy as np
+import pandas as pd
+from flask import Flask
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DataMovements.data_movements import store_dataset, find_approved_graphs, load_graph  # noqa: E402
+from DataMovements.model import db, User, Hashes, Datasets, DatasetAnalysisLink, Graphs, GraphVertexes, \
+    GraphEdges, ApprovedGraphs, READ_ONLY_BIND, SQLITE_PRAGMAS, use_read_only_db, \
+    install_sqlite_pragmas  # noqa: E402
+
+BASELINE_PRAGMAS = ('PRAGMA foreign_keys=1;',)
+# Точки маршрута внутри extent тестового датасета (широта, долгота)
+START_POINT = (41.2, 140.8)
+END_POINT = (41.5, 141.1)
+
+_pragmas = BASELINE_PRAGMAS
+
+
+install_sqlite_pragmas(Engine, lambda: _pragmas)
+
+
+class GridRenderer:
+    """
+    Привязка карты для load_graph: координаты изображения - долгота и широта в сотых долях градуса.
+    """
+
+    @staticmethod
+    def img_coords_from_lon_lat(lon, lat):
+        return np.column_stack([lon * 100, lat * 100])
+
+
+def create_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.config['SQLALCHEMY_BINDS'] = {READ_ONLY_BIND: 'sqlite:///file:' + db_path + '?mode=ro&uri=true'}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 30}
+    db.init_app(app)
+    return app
+
+
+def seed_graph(vertexes_count, edges_per_vertex, rng):
+    """
+    Пользователь, датасет с extent вокруг START_POINT/END_POINT и утвержденный граф со случайными ребрами.
+    """
+    user = User(username='benchmark')
+    user.set_password('benchmark')
+    db.session.add(user)
+    dataset_hash = Hashes(hash_value='benchmark_dataset', timestamp=datetime.now())
+    analysis_hash = Hashes(hash_value='benchmark_clustering', timestamp=datetime.now(), params={})
+    graph_hash = Hashes(hash_value='benchmark_graph', timestamp=datetime.now(), params={})
+    db.session.add_all([dataset_hash, analysis_hash, graph_hash])
+    db.session.flush()
+
+    min_x, min_y = mercantile.xy(140.5, 41.0)
+    max_x, max_y = mercantile.xy(141.5, 41.7)
+    dataset = Datasets(dataset_name='benchmark', user_id=user.id, source_hash_id=dataset_hash.hash_id,
+                       extent_min_x=min_x, extent_min_y=min_y, extent_max_x=max_x, extent_max_y=max_y)
+    db.session.add(dataset)
+    db.session.flush()
+    db.session.add(DatasetAnalysisLink(dataset_id=dataset.id, analysis_hash_id=analysis_hash.hash_id))
+    graph = Graphs(hash_id=graph_hash.hash_id, dataset_id=dataset.id, analysis_hash_id=analysis_hash.hash_id)
+    db.session.add(graph)
+    db.session.flush()
+
+    latitudes, longitudes = rng.uniform(41.0, 41.7, vertexes_count), rng.uniform(140.5, 141.5, vertexes_count)
+    vertexes = [GraphVertexes(graph_id=graph.graph_id, latitude=float(lat), longitude=float(lon))
+                for lat, lon in zip(latitudes, longitudes)]
+    db.session.add_all(vertexes)
+    db.session.flush()
+    vertex_ids = np.array([vertex.vertex_id for vertex in vertexes])
+    sources = np.repeat(vertex_ids, edges_per_vertex)
+    targets = rng.choice(vertex_ids, len(sources))
+    db.session.execute(GraphEdges.__table__.insert(), [
+        {'graph_id': graph.graph_id, 'start_vertex_id': int(u), 'end_vertex_id': int(w), 'weight': float(weight),
+         'distance': float(weight), 'speed': 10.0, 'angle_deviation': 0.0, 'cluster_num': 0}
+        for u, w, weight in zip(sources, targets, rng.random(len(sources))) if u != w])
+    db.session.add(ApprovedGraphs(graph_id=graph.graph_id))
+    db.session.commit()
+    return user.id
+
+
+def ingest(app, user_id, positions_count, ingests_count, rng, timings):
+    with app.app_context():
+        for i in range(ingests_count):
+            df = pd.DataFrame({'latitude': rng.uniform(41.0, 41.7, positions_count),
+                               'longitude': rng.uniform(140.5, 141.5, positions_count),
+                               'speed': rng.uniform(0, 20, positions_count),
+                               'course': rng.uniform(0, 360, positions_count)})
+            start = time.perf_counter()
+            store_dataset(df, f'ingest_{i}', user_id, f'ingest_hash_{i}')
+            timings.append(time.perf_counter() - start)
+
+
+def route_reads(db_path, mode, stop_event, results):
+    """
+    Процесс чтения, как воркер gunicorn: свое приложение и свои подключения только для чтения.
+    """
+    global _pragmas
+    _pragmas = SQLITE_PRAGMAS if mode == 'tuned' else BASELINE_PRAGMAS
+    app = create_app(db_path)
+    renderer = GridRenderer()
+    latencies, errors = [], []
+    while not stop_event.is_set():
+        with app.app_context():
+            use_read_only_db()
+            start = time.perf_counter()
+            try:
+                approved_graphs = find_approved_graphs(START_POINT, END_POINT)
+                if not approved_graphs:
+                    raise RuntimeError('утвержденный граф не найден')
+                load_graph(approved_graphs[0]['gr_hash_id'], renderer)
+                latencies.append(time.perf_counter() - start)
+            except Exception as exc:
+                errors.append(f'{type(exc).__name__}: {exc}'[:200])
+    results.put((latencies, errors))
+
+
+def run_mode(mode, args):
+    global _pragmas
+    _pragmas = SQLITE_PRAGMAS if mode == 'tuned' else BASELINE_PRAGMAS
+    rng = np.random.default_rng(0)
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # store_dataset пишет снимки в ./DB/cache относительно рабочего каталога
+        os.chdir(work_dir)
+        try:
+            db_path = os.path.join(work_dir, 'benchmark.db')
+            app = create_app(db_path)
+            with app.app_context():
+                db.create_all()
+                user_id = seed_graph(args.vertexes, args.edges_per_vertex, rng)
+
+            # Читатели - отдельные процессы, чтобы загрузка и чтение не делили GIL
+            context = multiprocessing.get_context('spawn')
+            stop_event = context.Event()
+            results = context.Queue()
+            readers = [context.Process(target=route_reads, args=(db_path, mode, stop_event, results))
+                       for _ in range(args.readers)]
+            for reader in readers:
+                reader.start()
+            # Читатели должны успеть запуститься до начала загрузки
+            time.sleep(args.warmup)
+            ingest_timings = []
+            start = time.perf_counter()
+            ingest(app, user_id, args.positions, args.ingests, rng, ingest_timings)
+            total_time = time.perf_counter() - start
+            stop_event.set()
+            latencies, errors = [], []
+            for _ in readers:
+                reader_latencies, reader_errors = results.get()
+                latencies.extend(reader_latencies)
+                errors.extend(reader_errors)
+            for reader in readers:
+                reader.join()
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+        finally:
+            os.chdir(previous_dir)
+
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        'mode': mode,
+        'ingest_total_time': round(total_time, 3),
+        'ingest_rows_per_second': round(args.positions * args.ingests / total_time),
+        'ingest_times': [round(timing, 3) for timing in ingest_timings],
+        'route_reads': int(np.isfinite(latencies).sum()),
+        'route_reads_per_second': round(float(np.isfinite(latencies).sum()) / total_time, 2),
+        'route_latency_p50': round(float(np.nanpercentile(latencies, 50)), 4),
+        'route_latency_p95': round(float(np.nanpercentile(latencies, 95)), 4),
+        'route_latency_max': round(float(np.nanmax(latencies)), 4),
+        'route_errors': len(errors),
+        'route_error_examples': sorted(set(errors))[:3]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конкурентная загрузка датасетов и чтение графов в SQLite')
+    parser.add_argument('--mode', choices=['baseline', 'tuned', 'both'], default='both')
+    parser.add_argument('--positions', type=int, default=500000, help='позиций в одном загружаемом датасете')
+    parser.add_argument('--ingests', type=int, default=3, help='сколько датасетов загрузить подряд')
+    parser.add_argument('--readers', type=int, default=4, help='процессов чтения графа')
+    parser.add_argument('--vertexes', type=int, default=1000)
+    parser.add_argument('--edges-per-vertex', type=int, default=5)
+    parser.add_argument('--warmup', type=float, default=5.0, help='секунд на запуск процессов чтения')
+    args = parser.parse_args()
+
+    modes = ['baseline', 'tuned'] if args.mode == 'both' else [args.mode]
+    results = [run_mode(mode, args) for mode in modes]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,97 +1,215 @@
 import time
 
 import numpy as np
-from joblib import parallel_backend
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
 
+from Clustering.incremental import incremental_dbscan
+from Clustering.neighbor_index import get_neighbor_index, scale_features
 from DataMovements.data_movements import load_positions_cleaned, check_clusters, \
-    store_clusters, store_avg_values, get_hash_value, get_ds_hash_id
+    store_clusters, store_avg_values, get_hash_value, get_ds_hash_id, get_hash_value_from_clustering_params, \
+    append_positions, get_dataset_clusterings, load_cluster_labels, update_clusters_incrementally
+from DataMovements.model import db
+from Helpers.metrics import span, observe_span
+from Helpers.run_log import run_log
+from Jobs.jobs import report_progress
+from Jobs.single_flight import clustering_flight
 from Visualization.visualization import MapRenderer
 
 
-# from sklearn.neighbors import NearestNeighbors
-# import numpy as np
-# import matplotlib.pyplot as plt
-# import statistics
-
-def clustering(clustering_params):
+def build_features(df, clustering_params, feature_scaler=None):
+    """
+    feature_scaler - среднее и масштаб признаков сохраненной кластеризации. Без него StandardScaler
+    обучается на всех точках df. Возвращает признаки, веса столбцов и использованный масштаб.
+    """
     weight_distance = float(clustering_params['weight_distance'])
     weight_speed = float(clustering_params['weight_speed'])
     weight_course = float(clustering_params['weight_course'])
-    eps = float(clustering_params['eps'])
-    min_samples = int(clustering_params['min_samples'])
     metric_degree = float(clustering_params['metric_degree'])
+
+    df['sin_course'] = np.sin(np.deg2rad(df['course']))
+    df['cos_course'] = np.cos(np.deg2rad(df['course']))
+
+    # Нормализуем данные, значительно увеличивает вычислительную эффективность
+    features = df[['lat', 'lon', 'speed', 'sin_course', 'cos_course']].to_numpy(dtype=float)
+    if feature_scaler is None:
+        scaler = StandardScaler().fit(features)
+        feature_scaler = {'mean': scaler.mean_.tolist(), 'scale': scaler.scale_.tolist()}
+    # При дозаписи масштаб не пересчитывается: eps и метки старых точек заданы в масштабе исходной кластеризации
+    X = (features - np.array(feature_scaler['mean'])) / np.array(feature_scaler['scale'])
+    weights = np.array([
+        weight_distance / (2 ** (1 / metric_degree)),
+        weight_distance / (2 ** (1 / metric_degree)),
+        weight_speed,
+        weight_course / (2 ** (1 / metric_degree)),
+        weight_course / (2 ** (1 / metric_degree))
+    ])
+    return X, weights, feature_scaler
+
+
+def get_dataset_neighbor_index(df, clustering_params):
+    dataset_id = int(clustering_params['dataset_id'])
+    metric_degree = float(clustering_params['metric_degree'])
+    X, weights, feature_scaler = build_features(df, clustering_params)
+    ds_hash_value = get_hash_value(get_ds_hash_id(dataset_id))
+    return get_neighbor_index(ds_hash_value, weights, metric_degree, X), feature_scaler
+
+
+def run_dbscan(clustering_params_for_hashing):
+    eps = float(clustering_params_for_hashing['eps'])
+    min_samples = int(clustering_params_for_hashing['min_samples'])
+    dataset_id = int(clustering_params_for_hashing['dataset_id'])
+
+    report_progress('dbscan', 0, 1)
+    df = load_positions_cleaned(dataset_id)
+
+    dbscan_start_time = time.time()
+    # Соседи кэшируются для датасета, весов и степени метрики, поэтому перебор eps и min_samples
+    # сводится к фильтрации готового разреженного графа расстояний
+    neighbor_index, feature_scaler = get_dataset_neighbor_index(df, clustering_params_for_hashing)
+    clusters = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit_predict(
+        neighbor_index.radius_graph(eps))
+    dbscan_time = round(time.time() - dbscan_start_time, 3)
+    observe_span('dbscan', dbscan_time)
+    report_progress('dbscan', 1, 1)
+
+    df['cluster'] = clusters
+
+    cl_hash_id = store_clusters(df, clustering_params_for_hashing, feature_scaler)
+    store_avg_values(df[['cluster', 'speed', 'course']], cl_hash_id)
+    df = df.drop('position_id', axis=1)
+
+    return cl_hash_id, df, dbscan_time
+
+
+def _check_and_run_dbscan(clustering_params_for_hashing):
+    # Ключ мог освободиться уже после того, как прежний лидер сохранил результат: тогда он есть в БД
+    cl_hash_id, df = check_clusters(clustering_params_for_hashing)
+    if cl_hash_id is not None:
+        return cl_hash_id, df, 0
+    return run_dbscan(clustering_params_for_hashing)
+
+
+def find_or_run_dbscan(clustering_params_for_hashing):
+    """
+    Результат кластеризации из БД или новый DBSCAN. Одинаковые параметры, пришедшие одновременно,
+    считаются один раз. dbscan_time = 0 - результат взят из БД.
+    """
+    cl_hash_id, df = check_clusters(clustering_params_for_hashing)
+    if cl_hash_id is not None:
+        return cl_hash_id, df, 0
+    return clustering_flight.do(get_hash_value_from_clustering_params(clustering_params_for_hashing),
+                                _check_and_run_dbscan, clustering_params_for_hashing)
+
+
+def clustering(clustering_params):
+    start_time = time.perf_counter()
     dataset_id = int(clustering_params['dataset_id'])
 
     clustering_params_for_hashing = {
         key: value for key, value in clustering_params.items() if key != 'hull_type'
     }
 
-    cl_hash_id, result_df = check_clusters(clustering_params_for_hashing)
+    cl_hash_id, df, dbscan_time = find_or_run_dbscan(clustering_params_for_hashing)
 
-    if cl_hash_id is not None:
-        df = result_df
-        min_lat = df['lat'].min()
-        min_lon = df['lon'].min()
-        max_lat = df['lat'].max()
-        max_lon = df['lon'].max()
-        dbscan_time = 0
-
-    else:
-        df = load_positions_cleaned(dataset_id)
-
-        df['sin_course'] = np.sin(np.deg2rad(df['course']))
-        df['cos_course'] = np.cos(np.deg2rad(df['course']))
-
-        min_lat = df['lat'].min()
-        min_lon = df['lon'].min()
-        max_lat = df['lat'].max()
-        max_lon = df['lon'].max()
-
-        dbscan_start_time = time.time()
-        # Нормализуем данные, значительно увеличивает вычислительную эффективность
-        scaler = StandardScaler()
-        X = scaler.fit_transform(df[['lat', 'lon', 'speed', 'sin_course', 'cos_course']])  # Распараллеливаем вычисления
-        weights = [
-            weight_distance / (2 ** (1 / metric_degree)),
-            weight_distance / (2 ** (1 / metric_degree)),
-            weight_speed,
-            weight_course / (2 ** (1 / metric_degree)),
-            weight_course / (2 ** (1 / metric_degree))
-        ]
-        with parallel_backend('loky', n_jobs=-1):
-            clusters = DBSCAN(eps=eps, min_samples=min_samples, metric='minkowski', p=metric_degree,
-                              metric_params={'w': weights}).fit_predict(X)
-            # # Создание графика для подбора eps
-            # neighbors = NearestNeighbors(n_neighbors=min_samples, metric='minkowski', p=metric_degree,
-            #                              metric_params={'w': [weight_distance, weight_distance,
-            #                                                   weight_speed, weight_course]}).fit(X)
-            # distances, indexes = neighbors.kneighbors(X)
-        dbscan_time = round(time.time() - dbscan_start_time, 3)
-
-        df['cluster'] = clusters
-
-        cl_hash_id = store_clusters(df, clustering_params_for_hashing)
-        store_avg_values(df[['cluster', 'speed', 'course']], cl_hash_id)
-        df = df.drop('position_id', axis=1)
-
-    # # Создание графика для подбора eps
-    # mean_distances = np.mean(distances, axis=1)
-    # mean_distances = np.sort(mean_distances)
-    # plt.figure(figsize=(12, 8))
-    # plt.plot(mean_distances)
-    # plt.yticks(np.arange(np.max(mean_distances), step=0.1))
-    # plt.xlabel('Sorted distances over all pairs')
-    # plt.ylabel(f'Mean distance over {min_samples} nearest neighbors')
-    # file_path = f'./static/images/clustered/clustered_{file_name}_eps_for_min_samples_{min_samples}.png'
-    # plt.savefig(file_path)
+    min_lat = df['lat'].min()
+    min_lon = df['lon'].min()
+    max_lat = df['lat'].max()
+    max_lon = df['lon'].max()
 
     ds_hash_id = get_ds_hash_id(dataset_id)
     ds_hash_value = get_hash_value(ds_hash_id)
     map_renderer = MapRenderer(west=min_lon, south=min_lat, east=max_lon, north=max_lat, zoom=12, df=df,
                                cl_hash_id=cl_hash_id, ds_hash_value=ds_hash_value)
     map_renderer.clustering_params = clustering_params
+    render_start_time = time.perf_counter()
     img_paths, result_clustering = map_renderer.create_clustered_map(dbscan_time=dbscan_time)
 
+    # dbscan_time = 0 - кластеризация с такими параметрами уже была, результат взят из БД
+    run_log.write('clustering', dataset_id=dataset_id, cl_hash_id=cl_hash_id, params=clustering_params,
+                  cached=dbscan_time == 0, clusters=map_renderer.cluster_count, noise=map_renderer.noise_count,
+                  positions=map_renderer.total_count,
+                  timings={'dbscan': dbscan_time, 'render': round(time.perf_counter() - render_start_time, 3),
+                           'total': round(time.perf_counter() - start_time, 3)})
     return img_paths, result_clustering, map_renderer.geographic_extent_manual, cl_hash_id
+
+
+# Подбор eps по графику k-расстояний (бывший закомментированный NearestNeighbors)
+def suggest_eps(clustering_params):
+    min_samples = int(clustering_params['min_samples'])
+    df = load_positions_cleaned(int(clustering_params['dataset_id']))
+    neighbor_index, _ = get_dataset_neighbor_index(df, clustering_params)
+    eps, k_distances = neighbor_index.suggest_eps(min_samples)
+    # Для графика на клиенте хватает прореженной кривой
+    step = max(1, len(k_distances) // 500)
+    return {'eps': round(eps, 3), 'k_distances': [round(float(d), 4) for d in k_distances[::step]]}
+
+
+@span('ingest')
+def append_to_dataset(df_data, df_marine, dataset_id, user_id, interpolation, algorithm, max_gap_minutes):
+    """
+    Дописывает новые позиции в датасет и обновляет все его кластеризации инкрементально,
+    без повторного DBSCAN по всему датасету.
+    """
+    try:
+        success, message, n_old = append_positions(df_data, df_marine, dataset_id, user_id, interpolation,
+                                                   algorithm, max_gap_minutes)
+        if not success:
+            return success, message
+
+        df = load_positions_cleaned(int(dataset_id))
+        if len(df) == n_old:
+            return success, message
+
+        df_old = df.iloc[:n_old]
+
+        clusterings = get_dataset_clusterings(int(dataset_id))
+        invalidated_graphs = 0
+        stale_graph_ids = []
+        for i, (cl_hash_id, clustering_params, feature_scaler) in enumerate(clusterings):
+            report_progress('clustering', i, len(clusterings))
+            start_time = time.time()
+            old_labels = load_cluster_labels(cl_hash_id)
+            old_labels_aligned = df_old[['position_id']].merge(old_labels, on='position_id', how='left')
+            metric_degree = float(clustering_params['metric_degree'])
+
+            missing_scaler = None
+            if feature_scaler is None:
+                # Кластеризация сохранена без масштаба: берем его по точкам до дозаписи и сохраняем
+                _, _, missing_scaler = build_features(df_old.copy(), clustering_params)
+                feature_scaler = missing_scaler
+            X, weights, _ = build_features(df.copy(), clustering_params, feature_scaler)
+            with span('dbscan'):
+                labels, changed_labels = incremental_dbscan(
+                    scale_features(X, weights, metric_degree),
+                    old_labels_aligned['cluster'].fillna(-1).to_numpy(),
+                    float(clustering_params['eps']), int(clustering_params['min_samples']), metric_degree)
+
+            df_results = df[['position_id', 'speed', 'course']].assign(cluster=labels)
+            changed_members, graphs_count, stale_ids = update_clusters_incrementally(
+                cl_hash_id, df_results, old_labels, changed_labels, missing_scaler)
+            invalidated_graphs += graphs_count
+            stale_graph_ids += stale_ids
+            update_time = round(time.time() - start_time, 3)
+            print(f'Кластеризация {cl_hash_id} обновлена за {update_time} сек.: '
+                  f'изменено меток точек {changed_members}, затронуто кластеров {len(changed_labels)}')
+            run_log.write('clustering_update', dataset_id=int(dataset_id), cl_hash_id=cl_hash_id,
+                          params=clustering_params, positions=len(df), appended_positions=len(df) - n_old,
+                          changed_members=changed_members, changed_clusters=len(changed_labels),
+                          invalidated_graphs=graphs_count, stale_approved_graphs=stale_ids,
+                          timings={'total': update_time})
+        report_progress('clustering', len(clusterings), len(clusterings))
+
+        message += f'. Обновлено кластеризаций: {len(clusterings)}'
+        if invalidated_graphs:
+            message += f', удалено устаревших графов: {invalidated_graphs}'
+        if stale_graph_ids:
+            message += (f'. Утвержденные для беспилотников графы (ID: {", ".join(map(str, stale_graph_ids))}) '
+                        f'построены по прежней кластеризации: они продолжают работать и будут заменены '
+                        f'при следующем построении графа с теми же параметрами')
+        return True, message
+
+    except Exception as exc:
+        db.session.rollback()
+        error_message = exc.args[0] if exc.args else str(exc)
+        return False, f'Ошибка при дозаписи датасета: {error_message}'
@@ -0,0 +1,103 @@
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import KDTree
+
+
+def _query_radius(tree, X, eps, **kwargs):
+    return tree.query_radius(X, r=eps, **kwargs) if len(X) else np.array([], dtype=object)
+
+
+def incremental_dbscan(X_scaled, old_labels, eps, min_samples, metric_degree):
+    """
+    Дополняет результат DBSCAN после вставки точек (Ester et al., инкрементальный DBSCAN).
+    X_scaled - признаки всех точек (сначала старые, затем новые), уже умноженные на w^(1/p);
+    old_labels - метки старых точек. Пересматриваются только точки, у которых изменилась
+    eps-окрестность: новые точки и их соседи. Вставка не лишает точки статуса ядра,
+    поэтому новые связи между кластерами могут появиться только через эти точки.
+    Возвращает (labels, changed_labels) - метки всех точек и множество меток кластеров,
+    состав которых изменился (включая исчезнувшие при слиянии).
+    """
+    n_old = len(old_labels)
+    n_points = X_scaled.shape[0]
+    labels = np.concatenate([np.asarray(old_labels, dtype=np.int64),
+                             np.full(n_points - n_old, -1, dtype=np.int64)])
+    if n_points == n_old:
+        return labels, set()
+
+    tree = KDTree(X_scaled, metric='minkowski', p=metric_degree)
+
+    new_idx = np.arange(n_old, n_points)
+    # Точки, у которых изменилось число соседей
+    affected = np.unique(np.concatenate([new_idx, *_query_radius(tree, X_scaled[new_idx], eps)]))
+    affected_neighbors = _query_radius(tree, X_scaled[affected], eps)
+
+    # Статус ядра нужен для затронутых точек и их соседей, остальные точки не меняются
+    region = np.unique(np.concatenate([affected, *affected_neighbors]))
+    is_core = np.zeros(n_points, dtype=bool)
+    is_core[region] = _query_radius(tree, X_scaled[region], eps, count_only=True) >= min_samples
+
+    seeds_mask = is_core[affected]
+    seeds = affected[seeds_mask]
+    seeds_neighbors = [neighbors for neighbors, is_seed in zip(affected_neighbors, seeds_mask) if is_seed]
+
+    changed_labels = set()
+    if len(seeds):
+        # Граф связности ядер: затронутые ядра и ядра в их окрестности
+        rows = np.concatenate([np.full(len(neighbors), seed) for seed, neighbors in zip(seeds, seeds_neighbors)])
+        cols = np.concatenate(seeds_neighbors)
+        core_edges = is_core[cols]
+        rows, cols = rows[core_edges], cols[core_edges]
+        nodes, inverse = np.unique(np.concatenate([rows, cols]), return_inverse=True)
+        adjacency = scipy.sparse.coo_matrix(
+            (np.ones(len(rows), dtype=np.int8), (inverse[:len(rows)], inverse[len(rows):])),
+            shape=(len(nodes), len(nodes)))
+        _, components = connected_components(adjacency, directed=False)
+
+        # Метки старых кластеров, соединенных новыми связями, объединяем (система непересекающихся множеств)
+        parent = {}
+
+        def find(label):
+            while parent[label] != label:
+                parent[label] = parent[parent[label]]
+                label = parent[label]
+            return label
+
+        components_old_labels = []
+        for component in range(components.max() + 1):
+            members = nodes[components == component]
+            old_members_labels = set(labels[members[members < n_old]].tolist()) - {-1}
+            for label in old_members_labels:
+                parent.setdefault(label, label)
+            if old_members_labels:
+                roots = {find(label) for label in old_members_labels}
+                target = min(roots)
+                for root in roots:
+                    parent[root] = target
+            components_old_labels.append((members, old_members_labels))
+            changed_labels.update(old_members_labels)
+
+        next_label = int(labels.max()) + 1 if n_old else 0
+        for members, old_members_labels in components_old_labels:
+            if old_members_labels:
+                target = find(next(iter(old_members_labels)))
+            else:
+                target = next_label
+                next_label += 1
+                changed_labels.add(target)
+            labels[members] = target
+
+        # Слияние затрагивает все точки поглощенных кластеров, а не только окрестность
+        for label in parent:
+            target = find(label)
+            if label != target:
+                labels[labels == label] = target
+
+        # Не являющиеся ядрами точки в окрестности затронутых ядер становятся граничными
+        for seed, neighbors in zip(seeds, seeds_neighbors):
+            border = neighbors[~is_core[neighbors] & (labels[neighbors] == -1)]
+            labels[border] = labels[seed]
+
+    # Новые точки без ядра в окрестности остаются шумом, их появление кластеры не меняет
+    changed_labels.update(set(labels[new_idx].tolist()) - {-1})
+    return labels, changed_labels
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+from sklearn.neighbors import NearestNeighbors
+
+from DataMovements.columnar_cache import CACHE_DIR
+from Jobs.jobs import report_progress
+
+# Сколько точек за раз передается в поиск соседей, ограничивает пиковую память
+NEIGHBORS_CHUNK_SIZE = 20000
+# Сколько индексов держать в памяти процесса, остальные читаются с диска
+MAX_INDEXES_IN_MEMORY = 2
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def neighbor_index_prefix(ds_hash_value):
+    return f'neighbors_{ds_hash_value}'
+
+
+def scale_features(X, weights, metric_degree):
+    """
+    sum(w * |x - y|^p)^(1/p) - это обычная метрика Минковского после умножения столбцов на w^(1/p),
+    поэтому вместо общего пути взвешенной метрики работает KD-дерево.
+    """
+    return X * np.power(weights, 1 / metric_degree)
+
+
+def _filter_graph(graph, radius):
+    graph = graph.tocoo()
+    keep = graph.data <= radius
+    # Нулевые расстояния (совпадающие точки) должны остаться явными элементами матрицы
+    return scipy.sparse.csr_matrix((graph.data[keep], (graph.row[keep], graph.col[keep])), shape=graph.shape)
+
+
+class NeighborIndex:
+    """
+    Кэш соседей для набора (датасет, веса, степень метрики): разреженный граф расстояний
+    в радиусе cached_radius и отсортированные k-расстояния. Любой eps <= cached_radius
+    обслуживается фильтрацией уже найденных пар без повторного поиска соседей.
+    """
+
+    def __init__(self, name, X_scaled, metric_degree):
+        self.name = name
+        self.X_scaled = X_scaled
+        self.metric_degree = metric_degree
+        self.cached_radius = 0.0
+        self.graph = None
+        self.k_distances = {}
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(CACHE_DIR, f'{self.name}.npz')
+
+    def _nearest_neighbors(self, **kwargs):
+        return NearestNeighbors(algorithm='kd_tree', metric='minkowski', p=self.metric_degree, n_jobs=-1,
+                                **kwargs).fit(self.X_scaled)
+
+    def _build_graph(self, radius):
+        neighbors = self._nearest_neighbors(radius=radius)
+        n_points = self.X_scaled.shape[0]
+        chunks_count = (n_points + NEIGHBORS_CHUNK_SIZE - 1) // NEIGHBORS_CHUNK_SIZE
+        blocks = []
+        for i, start in enumerate(range(0, n_points, NEIGHBORS_CHUNK_SIZE), start=1):
+            blocks.append(neighbors.radius_neighbors_graph(self.X_scaled[start:start + NEIGHBORS_CHUNK_SIZE],
+                                                           mode='distance'))
+            report_progress('neighbors', i, chunks_count)
+        self.graph = scipy.sparse.vstack(blocks, format='csr')
+        self.cached_radius = radius
+        self._save()
+
+    def _save(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp_path, data=self.graph.data, indices=self.graph.indices, indptr=self.graph.indptr,
+                 shape=np.array(self.graph.shape), radius=np.array(self.cached_radius))
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as saved:
+            if tuple(saved['shape']) != (self.X_scaled.shape[0], self.X_scaled.shape[0]):
+                return
+            self.graph = scipy.sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']),
+                                                 shape=tuple(saved['shape']))
+            self.cached_radius = float(saved['radius'])
+
+    def radius_graph(self, eps):
+        with self.lock:
+            if self.graph is None:
+                self._load()
+            # Радиус без запаса: в 5-мерном пространстве число пар растет как eps^5,
+            # запас 25% по радиусу дал бы втрое больше пар в памяти и на диске
+            if self.graph is None or eps > self.cached_radius:
+                self._build_graph(eps)
+            return _filter_graph(self.graph, eps)
+
+    def sorted_k_distances(self, k):
+        with self.lock:
+            if k not in self.k_distances:
+                distances, _ = self._nearest_neighbors(n_neighbors=k).kneighbors(self.X_scaled)
+                # Точка сама себе соседка, как и в min_samples у DBSCAN
+                self.k_distances[k] = np.sort(distances[:, -1])
+            return self.k_distances[k]
+
+    def suggest_eps(self, min_samples):
+        """
+        eps в точке максимального изгиба графика отсортированных k-расстояний
+        (наибольшее отклонение от хорды между концами нормированной кривой).
+        """
+        k_distances = self.sorted_k_distances(min_samples)
+        if len(k_distances) < 3 or k_distances[-1] == k_distances[0]:
+            return float(k_distances[-1]), k_distances
+        x = np.linspace(0, 1, len(k_distances))
+        y = (k_distances - k_distances[0]) / (k_distances[-1] - k_distances[0])
+        knee = int(np.argmax(x - y))
+        return float(k_distances[knee]), k_distances
+
+
+def get_neighbor_index(ds_hash_value, weights, metric_degree, X):
+    params_str = json.dumps({'weights': [float(w) for w in weights], 'metric_degree': float(metric_degree)},
+                            sort_keys=True)
+    name = f'{neighbor_index_prefix(ds_hash_value)}_{hashlib.md5(params_str.encode("utf-8")).hexdigest()}'
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = NeighborIndex(name, scale_features(X, weights, metric_degree), metric_degree)
+            _indexes[name] = index
+            while len(_indexes) > MAX_INDEXES_IN_MEMORY:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(name)
+        return index
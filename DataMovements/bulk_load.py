@@ -0,0 +1,74 @@
+import io
+
+import pandas as pd
+
+from DataMovements.model import db, Geometry
+from Helpers.metrics import span
+
+# Размер пачки строк, передаваемой драйверу за один вызов
+# (кэш страниц и режим журнала SQLite задаются при подключении, см. SQLITE_PRAGMAS)
+BULK_CHUNK_SIZE = 50000
+
+
+def _iter_chunks(df: pd.DataFrame, chunk_size: int):
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def _chunk_to_rows(chunk: pd.DataFrame):
+    # NaN -> None, numpy-скаляры -> python-типы, которые понимает драйвер
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    return list(chunk.itertuples(index=False, name=None))
+
+
+def _insert_sqlite(cursor, table_name, columns, df, chunk_size):
+    sql = (f'INSERT INTO {table_name} ({", ".join(columns)}) '
+           f'VALUES ({", ".join("?" for _ in columns)})')
+    for chunk in _iter_chunks(df, chunk_size):
+        cursor.executemany(sql, _chunk_to_rows(chunk))
+
+
+def _insert_postgresql(cursor, table_name, columns, df, chunk_size):
+    sql = f'COPY {table_name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)'
+    for chunk in _iter_chunks(df, chunk_size):
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False, na_rep='')
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+
+def bulk_insert(table, df: pd.DataFrame, chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Вставляет столбцы DataFrame напрямую через DBAPI-драйвер, минуя ORM (столбцы Geometry - геометрии shapely).
+    Работает в транзакции текущей сессии, фиксация остается за вызывающим кодом.
+    SQLite - executemany пачками, PostgreSQL - COPY FROM STDIN.
+    """
+    if df.empty:
+        return 0
+
+    columns = list(df.columns)
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+
+    if dialect not in ('sqlite', 'postgresql'):
+        connection.execute(table.insert(), df.to_dict(orient='records'))
+        return len(df)
+
+    # Драйвер получает значения напрямую, поэтому геометрии shapely кодируются здесь: WKB или HEXEWKB для COPY
+    geometry_columns = [column for column in columns if isinstance(table.c[column].type, Geometry)]
+    if geometry_columns:
+        df = df.copy()
+        for column in geometry_columns:
+            df[column] = table.c[column].type.encode(df[column].to_numpy(dtype=object), dialect)
+
+    cursor = connection.connection.cursor()
+    try:
+        # Курсор драйвера минует события движка, поэтому этап db_io отмечается здесь
+        with span('db_io'):
+            if dialect == 'sqlite':
+                _insert_sqlite(cursor, table.name, columns, df, chunk_size)
+            else:
+                _insert_postgresql(cursor, table.name, columns, df, chunk_size)
+    finally:
+        cursor.close()
+    return len(df)
@@ -0,0 +1,77 @@
+import contextlib
+import os
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+# Снимки хранятся в формате Arrow IPC (Feather v2) без сжатия,
+# поэтому при чтении файл просто отображается в память
+CACHE_DIR = './DB/cache'
+
+
+def _snapshot_path(name):
+    return os.path.join(CACHE_DIR, f'{name}.arrow')
+
+
+def positions_snapshot_name(ds_hash_value):
+    return f'positions_{ds_hash_value}'
+
+
+def clusters_snapshot_name(cl_hash_value):
+    return f'clusters_{cl_hash_value}'
+
+
+def write_snapshot(name, df: pd.DataFrame):
+    """
+    Снимок - только кэш, данные уже зафиксированы в БД: ошибка записи (нет места, нет прав) не прерывает
+    загрузку, без снимка данные читаются из БД. Возвращает, записан ли снимок.
+    """
+    path = _snapshot_path(name)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        # Читатели никогда не увидят недописанный файл
+        os.replace(tmp_path, path)
+        return True
+    except OSError as exc:
+        print(f'Не удалось записать снимок {name}: {exc}')
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        return False
+
+
+def read_snapshot(name):
+    """
+    Числовые столбцы без пропусков не копируются: каждый столбец - отдельный блок поверх отображенного файла.
+    Такие столбцы только для чтения - добавлять новые столбцы можно, менять значения на месте нельзя.
+    """
+    path = _snapshot_path(name)
+    if not os.path.exists(path):
+        return None
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    # self_destruct освобождает буферы Arrow по мере преобразования столбцов, которые все же копируются
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def drop_snapshot(name):
+    path = _snapshot_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def drop_cache_files(prefix):
+    """
+    Удаляет все производные файлы кэша (снимки, индексы соседей), имя которых начинается с prefix.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for file_name in os.listdir(CACHE_DIR):
+        if file_name.startswith(prefix):
+            os.remove(os.path.join(CACHE_DIR, file_name))
@@ -1,4 +1,5 @@
 import hashlib
+import io
 import json
 import time
 from datetime import datetime
@@ -9,10 +10,19 @@ import numpy as np
 import pandas as pd
 import shapely
 from scipy.interpolate import CubicSpline
-from sqlalchemy import and_, desc
+from sqlalchemy import and_, desc, func, select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
 
+from DataMovements.bulk_load import bulk_insert
+from DataMovements.columnar_cache import write_snapshot, read_snapshot, drop_snapshot, positions_snapshot_name, \
+    clusters_snapshot_name, drop_cache_files
 from DataMovements.model import db, Hashes, Datasets, PositionsCleaned, Clusters, ClusterMembers, DatasetAnalysisLink, \
-    ClAverageValues, ClPolygons, GraphVertexes, GraphEdges, Graphs, ApprovedGraphs
+    ClAverageValues, ClDerivedGeometries, ClHulls, GraphVertexes, GraphEdges, Graphs, ApprovedGraphs, \
+    GraphHierarchies, read_only_queries
+from FindPath.contraction_hierarchy import build_contraction_hierarchy
+from Helpers.metrics import span
+from Helpers.vis_helpers import generate_colors
+from Jobs.jobs import report_progress
 
 
 def fetch_datasets_for_user(user_id):
@@ -67,11 +77,16 @@ def store_dataset(df: pd.DataFrame, dataset_name, user_id, hash_value):
     db.session.flush()
 
     df['dataset_id'] = new_dataset.id
-    records = df.to_dict(orient='records')
-    db.session.bulk_insert_mappings(PositionsCleaned, records)
+    bulk_insert(PositionsCleaned.__table__, df[['dataset_id', 'latitude', 'longitude', 'speed', 'course']])
+    position_ids = [row.position_id for row in db.session.query(PositionsCleaned.position_id)
+                    .filter_by(dataset_id=new_dataset.id).order_by(PositionsCleaned.position_id)]
 
     db.session.commit()
 
+    snapshot = df[['latitude', 'longitude', 'speed', 'course']].rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+    snapshot.insert(0, 'position_id', position_ids)
+    write_snapshot(positions_snapshot_name(hash_value), snapshot)
+
 
 def haversine_distance(lon1, lat1, lon2, lat2):
     R = 6371
@@ -198,55 +213,70 @@ def linear_interpolation(df_data: pd.DataFrame, max_gap_minutes: int) -> pd.Data
     return df_data
 
 
+def read_source_files(df_data, df_marine, interpolation, algorithm, max_gap_minutes):
+    df_data = read_csv_or_xlsx(df_data)
+    df_marine = read_csv_or_xlsx(df_marine)
+    if not {'id_marine', 'lat', 'lon', 'speed', 'course', 'date_add', 'age'}.issubset(
+            set(df_data.columns.tolist())):
+        raise Exception('проверяйте формат файла с данными о движении.')
+    if not {'id_marine', 'port', 'length'}.issubset(set(df_marine.columns.tolist())):
+        raise Exception('проверяйте формат файла с данными о судах.')
+
+    hash_value = hashlib.md5(
+        (df_data.to_csv() + df_marine.to_csv() + str(interpolation) + str(max_gap_minutes) + str(algorithm)).encode(
+            'utf-8')).hexdigest()
+    return df_data, df_marine, hash_value
+
+
+def clean_positions(df_data, df_marine, interpolation, algorithm, max_gap_minutes):
+    df_data['timestamp'] = pd.to_datetime(df_data['date_add']) - pd.to_timedelta(df_data['age'], unit='m')
+    df_data = pd.merge(df_data, df_marine[['id_marine', 'port', 'length']], how='left', on='id_marine').dropna(
+        axis=0)
+    df_data = df_data.loc[
+        (df_data['course'] != 511) & (df_data['port'] != 0) & (df_data['length'] != 0)].reset_index(
+        drop=True)
+    df_data = df_data[['id_marine', 'lat', 'lon', 'speed', 'course', 'timestamp']]
+    df_data = (
+        df_data
+        .drop_duplicates(subset=['id_marine', 'lat', 'lon', 'speed', 'course'], keep='first')
+        .drop_duplicates(subset=['id_marine', 'timestamp'], keep='first')
+        .dropna(axis=0)
+    )
+    df_data = df_data.sort_values(['id_marine', 'timestamp'])
+
+    if interpolation:
+        report_progress('interpolation', 0, 1)
+        if algorithm == 'spline':
+            df_data = (df_data.groupby('id_marine', group_keys=False).apply(
+                lambda g: spline_interpolation(g, max_gap_minutes)))
+        elif algorithm == 'linear':
+            df_data = linear_interpolation(df_data, max_gap_minutes)
+        df_data = df_data.reset_index(drop=True)
+        report_progress('interpolation', 1, 1)
+
+    df_data = df_data[['lat', 'lon', 'speed', 'course']].dropna(axis=0).drop_duplicates()
+    return df_data.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+
+
+@span('ingest')
 def process_and_store_dataset(df_data, df_marine, dataset_name, user_id, interpolation, algorithm,
                               max_gap_minutes: int = 30):
     try:
-        df_data = read_csv_or_xlsx(df_data)
-        df_marine = read_csv_or_xlsx(df_marine)
-        if not {'id_marine', 'lat', 'lon', 'speed', 'course', 'date_add', 'age'}.issubset(
-                set(df_data.columns.tolist())):
-            raise Exception('проверяйте формат файла с данными о движении.')
-        if not {'id_marine', 'port', 'length'}.issubset(set(df_marine.columns.tolist())):
-            raise Exception('проверяйте формат файла с данными о судах.')
-
         if max_gap_minutes:
             max_gap_minutes = int(max_gap_minutes)
 
-        hash_value = hashlib.md5(
-            (df_data.to_csv() + df_marine.to_csv() + str(interpolation) + str(max_gap_minutes) + str(algorithm)).encode(
-                'utf-8')).hexdigest()
+        df_data, df_marine, hash_value = read_source_files(df_data, df_marine, interpolation, algorithm,
+                                                           max_gap_minutes)
 
         result_integrity_check = integrity_check(hash_value, dataset_name)
         if result_integrity_check is not None:
             return result_integrity_check
 
-        df_data['timestamp'] = pd.to_datetime(df_data['date_add']) - pd.to_timedelta(df_data['age'], unit='m')
-        df_data = pd.merge(df_data, df_marine[['id_marine', 'port', 'length']], how='left', on='id_marine').dropna(
-            axis=0)
-        df_data = df_data.loc[
-            (df_data['course'] != 511) & (df_data['port'] != 0) & (df_data['length'] != 0)].reset_index(
-            drop=True)
-        df_data = df_data[['id_marine', 'lat', 'lon', 'speed', 'course', 'timestamp']]
-        df_data = (
-            df_data
-            .drop_duplicates(subset=['id_marine', 'lat', 'lon', 'speed', 'course'], keep='first')
-            .drop_duplicates(subset=['id_marine', 'timestamp'], keep='first')
-            .dropna(axis=0)
-        )
-        df_data = df_data.sort_values(['id_marine', 'timestamp'])
-
-        if interpolation:
-            if algorithm == 'spline':
-                df_data = (df_data.groupby('id_marine', group_keys=False).apply(
-                    lambda g: spline_interpolation(g, max_gap_minutes)))
-            elif algorithm == 'linear':
-                df_data = linear_interpolation(df_data, max_gap_minutes)
-            df_data = df_data.reset_index(drop=True)
-
-        df_data = df_data[['lat', 'lon', 'speed', 'course']].dropna(axis=0).drop_duplicates()
-        df_data = df_data.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+        df_data = clean_positions(df_data, df_marine, interpolation, algorithm, max_gap_minutes)
 
+        report_progress('storing', 0, len(df_data))
         store_dataset(df_data, dataset_name, user_id, hash_value)
+        report_progress('storing', len(df_data), len(df_data))
 
         return True, f'Создан датасет: {dataset_name}'
 
@@ -256,44 +286,116 @@ def process_and_store_dataset(df_data, df_marine, dataset_name, user_id, interpo
         return False, f'Ошибка при создании датасета: {error_message}'
 
 
+def append_positions(df_data, df_marine, dataset_id, user_id, interpolation, algorithm, max_gap_minutes: int = 30):
+    """
+    Дописывает в существующий датасет только новые позиции. Хэш исходных данных датасета
+    заменяется на хэш от старого хэша и нового содержимого, снимок позиций переписывается.
+    Возвращает (успех, сообщение, количество позиций до дозаписи).
+    """
+    if max_gap_minutes:
+        max_gap_minutes = int(max_gap_minutes)
+
+    dataset = db.session.get(Datasets, int(dataset_id))
+    if not dataset:
+        return False, 'Датасет не найден.', None
+    if dataset.user_id != user_id:
+        return False, f'Отказано в доступе: вы не являетесь владельцем датасета "{dataset.dataset_name}"', None
+
+    df_data, df_marine, appended_hash_value = read_source_files(df_data, df_marine, interpolation, algorithm,
+                                                                max_gap_minutes)
+    df_new = clean_positions(df_data, df_marine, interpolation, algorithm, max_gap_minutes)
+
+    df_old = load_positions_cleaned(dataset.id)
+    old_hash_value = dataset.source_hash.hash_value
+    # Позиции, уже имеющиеся в датасете, повторно не добавляем
+    df_new = df_new.merge(df_old[['lat', 'lon', 'speed', 'course']].rename(
+        columns={'lat': 'latitude', 'lon': 'longitude'}), how='left', indicator=True)
+    df_new = df_new.loc[df_new['_merge'] == 'left_only', ['latitude', 'longitude', 'speed', 'course']]
+    if df_new.empty:
+        return True, f'Новых позиций для датасета {dataset.dataset_name} не найдено.', len(df_old)
+
+    max_position_id = int(df_old['position_id'].max()) if len(df_old) else 0
+    df_new.insert(0, 'dataset_id', dataset.id)
+    report_progress('storing', 0, len(df_new))
+    bulk_insert(PositionsCleaned.__table__, df_new)
+    position_ids = [row.position_id for row in db.session.query(PositionsCleaned.position_id)
+                    .filter(PositionsCleaned.dataset_id == dataset.id, PositionsCleaned.position_id > max_position_id)
+                    .order_by(PositionsCleaned.position_id)]
+
+    new_hash_value = hashlib.md5((old_hash_value + appended_hash_value).encode('utf-8')).hexdigest()
+    dataset.source_hash.hash_value = new_hash_value
+    dataset.source_hash.timestamp = datetime.now()
+    db.session.commit()
+    report_progress('storing', len(df_new), len(df_new))
+
+    df_new = df_new.drop(columns='dataset_id').rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+    df_new.insert(0, 'position_id', position_ids)
+    write_snapshot(positions_snapshot_name(new_hash_value), pd.concat([df_old, df_new], ignore_index=True))
+    drop_snapshot(positions_snapshot_name(old_hash_value))
+    drop_cache_files(f'neighbors_{old_hash_value}')
+
+    return True, f'В датасет {dataset.dataset_name} добавлено позиций: {len(df_new)}', len(df_old)
+
+
 def load_positions_cleaned(dataset_id):
     dataset = db.session.get(Datasets, int(dataset_id))
     if not dataset:
         raise ValueError("Датасет не найден.")
 
-    return pd.read_sql(
+    snapshot_name = positions_snapshot_name(dataset.source_hash.hash_value)
+    df = read_snapshot(snapshot_name)
+    if df is not None:
+        return df
+
+    # Датасеты, загруженные до появления снимков, читаем из БД один раз
+    df = pd.read_sql(
         db.session.query(
             PositionsCleaned.position_id,
             PositionsCleaned.latitude.label('lat'),
             PositionsCleaned.longitude.label('lon'),
             PositionsCleaned.speed,
             PositionsCleaned.course
-        ).filter_by(dataset_id=dataset.id).statement,
-        db.engine
+        ).filter_by(dataset_id=dataset.id).order_by(PositionsCleaned.position_id).statement,
+        db.session.connection()
     )
+    write_snapshot(snapshot_name, df)
+    return df
 
 
-def load_clusters(cl_hash_id):
-    return cl_hash_id, pd.read_sql(
+def load_cluster_labels(cl_hash_id):
+    snapshot_name = clusters_snapshot_name(get_hash_value(cl_hash_id))
+    df = read_snapshot(snapshot_name)
+    if df is not None:
+        return df
+
+    df = pd.read_sql(
         db.session.query(
-            Clusters.cluster_num.label('cluster'),
-            PositionsCleaned.latitude.label('lat'),
-            PositionsCleaned.longitude.label('lon'),
-            PositionsCleaned.speed,
-            PositionsCleaned.course
-        )
-        .join(ClusterMembers,
-              (Clusters.hash_id == ClusterMembers.hash_id) &
-              (Clusters.cluster_num == ClusterMembers.cluster_num))
-        .join(PositionsCleaned, ClusterMembers.position_id == PositionsCleaned.position_id)
-        .filter(Clusters.hash_id == cl_hash_id)
-        .statement, db.engine)
+            ClusterMembers.position_id,
+            ClusterMembers.cluster_num.label('cluster')
+        ).filter(ClusterMembers.hash_id == cl_hash_id).statement,
+        db.session.connection()
+    )
+    write_snapshot(snapshot_name, df)
+    return df
 
 
-def check_clusters(clustering_params: dict):
+@read_only_queries()
+def load_clusters(cl_hash_id):
+    link = db.session.query(DatasetAnalysisLink).filter_by(analysis_hash_id=cl_hash_id).first()
+    positions = load_positions_cleaned(link.dataset_id)
+    labels = load_cluster_labels(cl_hash_id)
+    df = labels.merge(positions, on='position_id', how='inner')
+    return cl_hash_id, df[['cluster', 'lat', 'lon', 'speed', 'course']]
+
+
+def get_hash_value_from_clustering_params(clustering_params: dict):
     params_for_hashing = {k: v for k, v in clustering_params.items() if k != 'hull_type'}
     params_str = json.dumps(params_for_hashing, sort_keys=True)
-    hash_value = hashlib.md5(params_str.encode('utf-8')).hexdigest()
+    return hashlib.md5(params_str.encode('utf-8')).hexdigest()
+
+
+def check_clusters(clustering_params: dict):
+    hash_value = get_hash_value_from_clustering_params(clustering_params)
 
     hash_obj = db.session.query(Hashes).filter_by(hash_value=hash_value).first()
 
@@ -305,39 +407,60 @@ def check_clusters(clustering_params: dict):
 
 
 def store_avg_values(df: pd.DataFrame, hash_id: int):
-    avg_speeds = {}
-    avg_courses = {}
+    """
+    Средние скорость и курс кластеров и сопутствующая статистика за один проход по точкам:
+    суммы скоростей, синусов и косинусов курса считаются через np.bincount по номерам кластеров.
+    """
+    df = df[df['cluster'] >= 0]
+    if df.empty:
+        return
 
-    cluster_count = max(df['cluster']) + 1
-    for cluster in range(cluster_count):
-        cluster_data = df[df['cluster'] == cluster]
-        speeds = cluster_data['speed'].dropna()
-        courses = cluster_data['course'].dropna()
+    # После дозаписи номера кластеров могут идти с пропусками (поглощенные при слиянии)
+    cluster_nums, cluster_idx = np.unique(df['cluster'].to_numpy(), return_inverse=True)
+    cluster_count = len(cluster_nums)
+    point_counts = np.bincount(cluster_idx, minlength=cluster_count)
 
-        avg_speed = speeds.mean() if not speeds.empty else None
+    speeds = df['speed'].to_numpy(dtype=float)
+    has_speed = ~np.isnan(speeds)
+    speed_counts = np.bincount(cluster_idx[has_speed], minlength=cluster_count)
+    speed_sums = np.bincount(cluster_idx[has_speed], weights=speeds[has_speed], minlength=cluster_count)
 
-        if not courses.empty:
-            sin_vals = np.sin(np.deg2rad(courses))
-            cos_vals = np.cos(np.deg2rad(courses))
-            avg_angle = np.rad2deg(np.arctan2(sin_vals.mean(), cos_vals.mean())) % 360
-        else:
-            avg_angle = None
+    courses = np.deg2rad(df['course'].to_numpy(dtype=float))
+    has_course = ~np.isnan(courses)
+    course_counts = np.bincount(cluster_idx[has_course], minlength=cluster_count)
+    sin_sums = np.bincount(cluster_idx[has_course], weights=np.sin(courses[has_course]), minlength=cluster_count)
+    cos_sums = np.bincount(cluster_idx[has_course], weights=np.cos(courses[has_course]), minlength=cluster_count)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_speeds = speed_sums / speed_counts
+        avg_courses = np.where(course_counts > 0, np.rad2deg(np.arctan2(sin_sums, cos_sums)) % 360, np.nan)
+        # Круговая дисперсия 1 - R: 0 - все суда идут одним курсом, 1 - курсы равномерно разбросаны
+        course_dispersions = 1 - np.hypot(sin_sums, cos_sums) / course_counts
+
+    # Без скоростей unstack дает пустую таблицу без столбцов квантилей - их задает reindex
+    speed_percentiles = (pd.Series(speeds[has_speed]).groupby(cluster_idx[has_speed])
+                         .quantile([0.1, 0.5, 0.9]).unstack()
+                         .reindex(index=range(cluster_count), columns=[0.1, 0.5, 0.9]))
 
-        avg_speeds[cluster] = avg_speed
-        avg_courses[cluster] = avg_angle
+    def to_value(value):
+        return None if np.isnan(value) else float(value)
 
     records = []
-    for cluster_num in avg_speeds.keys():
+    for i, cluster_num in enumerate(cluster_nums):
         records.append({
             'hash_id': hash_id,
             'cluster_num': int(cluster_num),
-            'average_speed': avg_speeds[cluster_num],
-            'average_course': avg_courses[cluster_num]
+            'average_speed': to_value(avg_speeds[i]),
+            'average_course': to_value(avg_courses[i]),
+            'point_count': int(point_counts[i]),
+            'course_dispersion': to_value(course_dispersions[i]),
+            'speed_p10': to_value(speed_percentiles.at[i, 0.1]),
+            'speed_median': to_value(speed_percentiles.at[i, 0.5]),
+            'speed_p90': to_value(speed_percentiles.at[i, 0.9])
         })
 
-    if records:
-        db.session.bulk_insert_mappings(ClAverageValues, records)
-        db.session.commit()
+    db.session.bulk_insert_mappings(ClAverageValues, records)
+    db.session.commit()
 
 
 def load_avg_values(cl_hash_id):
@@ -346,16 +469,15 @@ def load_avg_values(cl_hash_id):
             .all())
 
 
-def store_clusters(df_results: pd.DataFrame, clustering_params: dict):
+def store_clusters(df_results: pd.DataFrame, clustering_params: dict, feature_scaler: dict = None):
     source_dataset_id = clustering_params['dataset_id']
-    params_for_hashing = {k: v for k, v in clustering_params.items() if k != 'hull_type'}
-    params_str = json.dumps(params_for_hashing, sort_keys=True)
-    hash_value = hashlib.md5(params_str.encode('utf-8')).hexdigest()
+    hash_value = get_hash_value_from_clustering_params(clustering_params)
 
     new_hash = Hashes(
         hash_value=hash_value,
         timestamp=datetime.now(),
-        params=clustering_params
+        params=clustering_params,
+        feature_scaler=feature_scaler
     )
     db.session.add(new_hash)
     db.session.flush()
@@ -372,45 +494,214 @@ def store_clusters(df_results: pd.DataFrame, clustering_params: dict):
     if cluster_records:
         db.session.bulk_insert_mappings(Clusters, cluster_records)
 
-    member_records_df = df_results[['position_id', 'cluster']].copy()
-    member_records_df['hash_id'] = new_hash.hash_id
+    member_records_df = df_results[['position_id', 'cluster']].astype('int64')
+    member_records_df.insert(0, 'hash_id', new_hash.hash_id)
     member_records_df = member_records_df.rename(columns={'cluster': 'cluster_num'})
-    db.session.bulk_insert_mappings(ClusterMembers, member_records_df.to_dict(orient='records'))
+    bulk_insert(ClusterMembers.__table__, member_records_df)
 
     db.session.commit()
+
+    write_snapshot(clusters_snapshot_name(hash_value),
+                   df_results[['position_id', 'cluster']].astype('int64').reset_index(drop=True))
     return new_hash.hash_id
 
 
-def store_polygon_geoms(polygon_geoms: dict, cl_hash_id: int):
-    records = []
-    for cluster_num, bounds in polygon_geoms.items():
-        for x, y in bounds:
-            records.append({
-                'hash_id': cl_hash_id,
-                'cluster_num': int(cluster_num),
-                'x': x,
-                'y': y
-            })
-    if records:
-        db.session.bulk_insert_mappings(ClPolygons, records)
+def get_dataset_clusterings(dataset_id):
+    """
+    Возвращает [(hash_id, params, feature_scaler)] всех сохраненных кластеризаций датасета.
+    """
+    return (db.session.query(Hashes.hash_id, Hashes.params, Hashes.feature_scaler)
+            .join(DatasetAnalysisLink, DatasetAnalysisLink.analysis_hash_id == Hashes.hash_id)
+            .filter(DatasetAnalysisLink.dataset_id == dataset_id)
+            .all())
+
+
+def update_clusters_incrementally(cl_hash_id, df_results: pd.DataFrame, old_labels: pd.DataFrame,
+                                  changed_labels: set, feature_scaler: dict = None):
+    """
+    Сохраняет результат инкрементальной кластеризации поверх существующего: переписываются только
+    принадлежность точек, сменивших метку, и новые точки; средние значения и полигоны удаляются
+    только для изменившихся кластеров. Графы этой кластеризации удаляются, утвержденные - помечаются
+    к перестроению (needs_rebuild). Возвращает (число измененных меток, число удаленных графов,
+    ID утвержденных графов, ожидающих перестроения).
+    df_results - position_id, cluster, speed, course всех точек; old_labels - position_id, cluster до дозаписи.
+    feature_scaler - масштаб признаков для кластеризаций, сохраненных без него.
+    """
+    if feature_scaler is not None:
+        db.session.query(Hashes).filter(Hashes.hash_id == cl_hash_id).update({'feature_scaler': feature_scaler},
+                                                                             synchronize_session=False)
+
+    labels = df_results[['position_id', 'cluster']].astype('int64')
+    merged = labels.merge(old_labels.rename(columns={'cluster': 'old_cluster'}), on='position_id', how='left')
+    changed_members = merged.loc[merged['old_cluster'].isna() | (merged['cluster'] != merged['old_cluster']),
+                                 ['position_id', 'cluster']]
+    moved_position_ids = merged.loc[merged['old_cluster'].notna() & (merged['cluster'] != merged['old_cluster']),
+                                    'position_id'].tolist()
+
+    existing_labels = {row.cluster_num for row in
+                       db.session.query(Clusters.cluster_num).filter(Clusters.hash_id == cl_hash_id)}
+    new_labels = set(labels['cluster'].unique().tolist())
+
+    missing_labels = new_labels - existing_labels
+    if missing_labels:
+        db.session.bulk_insert_mappings(Clusters, [{'hash_id': cl_hash_id, 'cluster_num': int(num)}
+                                                   for num in missing_labels])
+
+    for start in range(0, len(moved_position_ids), 500):
+        db.session.query(ClusterMembers).filter(
+            ClusterMembers.hash_id == cl_hash_id,
+            ClusterMembers.position_id.in_(moved_position_ids[start:start + 500])
+        ).delete(synchronize_session=False)
+    member_records_df = changed_members.rename(columns={'cluster': 'cluster_num'})
+    member_records_df.insert(0, 'hash_id', cl_hash_id)
+    bulk_insert(ClusterMembers.__table__, member_records_df)
+
+    # Исчезнувшие при слиянии кластеры удаляются вместе с их средними значениями и полигонами
+    vanished_labels = [int(num) for num in existing_labels - new_labels if num != -1]
+    if vanished_labels:
+        db.session.query(Clusters).filter(Clusters.hash_id == cl_hash_id,
+                                          Clusters.cluster_num.in_(vanished_labels)).delete(synchronize_session=False)
+
+    changed_labels = [int(num) for num in changed_labels]
+    db.session.query(ClAverageValues).filter(ClAverageValues.hash_id == cl_hash_id,
+                                             ClAverageValues.cluster_num.in_(changed_labels)
+                                             ).delete(synchronize_session=False)
+    drop_derived_geometries(cl_hash_id, changed_labels)
+
+    # Граф строится по пересечениям полигонов всех кластеров, поэтому перестраивается целиком по запросу.
+    # Утвержденные графы не удаляются, чтобы не отзывать области беспилотников, а помечаются к перестроению
+    graphs = db.session.query(Graphs.graph_id, Graphs.hash_id, ApprovedGraphs.graph_id.label('approved_id')).outerjoin(
+        ApprovedGraphs, ApprovedGraphs.graph_id == Graphs.graph_id).filter(Graphs.analysis_hash_id == cl_hash_id).all()
+    graph_hash_ids = [row.hash_id for row in graphs if row.approved_id is None]
+    stale_graph_ids = [row.graph_id for row in graphs if row.approved_id is not None]
+    if graph_hash_ids:
+        db.session.query(Hashes).filter(Hashes.hash_id.in_(graph_hash_ids)).delete(synchronize_session=False)
+    if stale_graph_ids:
+        db.session.query(Graphs).filter(Graphs.graph_id.in_(stale_graph_ids)).update({'needs_rebuild': True},
+                                                                                    synchronize_session=False)
+
+    db.session.commit()
+
+    df_changed = df_results[df_results['cluster'].isin(changed_labels)]
+    store_avg_values(df_changed[['cluster', 'speed', 'course']], cl_hash_id)
+    write_snapshot(clusters_snapshot_name(get_hash_value(cl_hash_id)), labels.reset_index(drop=True))
+    return len(changed_members), len(graph_hash_ids), stale_graph_ids
+
+
+def geoms_to_arrays(keys, geoms):
+    """
+    Упаковывает геометрии в массивы для store_derived: WKB подряд в одном буфере и длины записей.
+    """
+    geoms_wkb = shapely.to_wkb(np.asarray(geoms, dtype=object))
+    return {
+        'keys': np.asarray(keys, dtype=np.int64),
+        'wkb': np.frombuffer(b''.join(geoms_wkb), dtype=np.uint8),
+        'wkb_lengths': np.fromiter((len(geom_wkb) for geom_wkb in geoms_wkb), dtype=np.int64, count=len(geoms_wkb))
+    }
+
+
+def arrays_to_geoms(arrays):
+    offsets = np.concatenate([[0], np.cumsum(arrays['wkb_lengths'])])
+    wkb = arrays['wkb'].tobytes()
+    geoms = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+    return arrays['keys'], geoms
+
+
+def _derived_geometries_query(cl_hash_id, hull_type, kind, distance_delta):
+    query = db.session.query(ClDerivedGeometries).filter(ClDerivedGeometries.hash_id == cl_hash_id,
+                                                         ClDerivedGeometries.hull_type == hull_type,
+                                                         ClDerivedGeometries.kind == kind)
+    if distance_delta is None:
+        return query.filter(ClDerivedGeometries.distance_delta.is_(None))
+    return query.filter(ClDerivedGeometries.distance_delta == float(distance_delta))
+
+
+def store_derived(cl_hash_id: int, hull_type: str, kind: str, arrays: dict, distance_delta=None):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    # Кэш необязателен: при подключении только для чтения геометрия просто будет посчитана заново
+    try:
+        _derived_geometries_query(cl_hash_id, hull_type, kind, distance_delta).delete(synchronize_session=False)
+        db.session.add(ClDerivedGeometries(hash_id=cl_hash_id, hull_type=hull_type, kind=kind,
+                                           distance_delta=None if distance_delta is None else float(distance_delta),
+                                           data=buffer.getvalue()))
+        if kind == 'hulls':
+            store_hull_geometries(cl_hash_id, hull_type, arrays)
         db.session.commit()
+    # Оболочки cl_hulls пишутся через курсор драйвера (bulk_insert), его ошибки не оборачиваются в SQLAlchemyError
+    except (SQLAlchemyError, db.engine.dialect.loaded_dbapi.Error) as e:
+        db.session.rollback()
+        print(f"Не удалось сохранить производную геометрию ({kind}) для hash_id {cl_hash_id}: {e}")
 
 
-def load_polygon_geoms(cl_hash_id: int):
-    polygons = {}
-    rows = db.session.query(ClPolygons).filter_by(hash_id=cl_hash_id).all()
+def store_hull_geometries(cl_hash_id: int, hull_type: str, arrays: dict):
+    """
+    Заменяет построчные оболочки кластеризации (cl_hulls) оболочками из массивов store_derived.
+    Фиксация остается за вызывающим кодом.
+    """
+    clusters, hulls = arrays_to_geoms(arrays)
+    db.session.query(ClHulls).filter(ClHulls.hash_id == cl_hash_id, ClHulls.hull_type == hull_type).delete(
+        synchronize_session=False)
+    bulk_insert(ClHulls.__table__, pd.DataFrame({'hash_id': cl_hash_id, 'hull_type': hull_type,
+                                                 'cluster_num': clusters, 'geom': hulls}))
+
+
+def backfill_hull_geometries():
+    """
+    Заполняет cl_hulls для кластеризаций, оболочки которых сохранены до появления таблицы.
+    """
+    stored_pairs = db.session.query(ClHulls.hash_id, ClHulls.hull_type).distinct()
+    rows = db.session.query(ClDerivedGeometries).filter(
+        ClDerivedGeometries.kind == 'hulls',
+        tuple_(ClDerivedGeometries.hash_id, ClDerivedGeometries.hull_type).not_in(stored_pairs)
+    ).all()
     for row in rows:
-        polygons.setdefault(row.cluster_num, []).append((row.x, row.y))
-    return polygons
+        with np.load(io.BytesIO(row.data)) as saved:
+            store_hull_geometries(row.hash_id, row.hull_type, {name: saved[name] for name in saved.files})
+    if rows:
+        db.session.commit()
+        print(f'Оболочки кластеров перенесены в cl_hulls для {len(rows)} кластеризаций.')
+
+
+def load_derived(cl_hash_id: int, hull_type: str, kind: str, distance_delta=None):
+    row = _derived_geometries_query(cl_hash_id, hull_type, kind, distance_delta).first()
+    if row is None:
+        return None
+    with np.load(io.BytesIO(row.data)) as saved:
+        return {name: saved[name] for name in saved.files}
+
+
+def drop_derived_geometries(cl_hash_id: int, changed_labels):
+    """
+    Убирает из кэша оболочки и буферы изменившихся кластеров, пересечения и узлы
+    зависят от всех оболочек и удаляются целиком.
+    """
+    changed_labels = np.asarray(list(changed_labels), dtype=np.int64)
+    rows = db.session.query(ClDerivedGeometries).filter(ClDerivedGeometries.hash_id == cl_hash_id).all()
+    for row in rows:
+        if row.kind not in ('hulls', 'buffers'):
+            db.session.delete(row)
+            continue
+        with np.load(io.BytesIO(row.data)) as saved:
+            keys, geoms = arrays_to_geoms({name: saved[name] for name in saved.files})
+        keep = ~np.isin(keys, changed_labels)
+        buffer = io.BytesIO()
+        np.savez(buffer, **geoms_to_arrays(keys[keep], geoms[keep]))
+        row.data = buffer.getvalue()
+    db.session.query(ClHulls).filter(ClHulls.hash_id == cl_hash_id,
+                                     ClHulls.cluster_num.in_(changed_labels.tolist())).delete(synchronize_session=False)
 
 
 def delete_dataset_by_id(dataset_id, current_user_id):
     """
     Удаляет датасет и все связанные с ним данные, включая хэши
     исходных данных, кластеризации и графов.
+    Удаление идет множественными DELETE в порядке зависимостей, без загрузки строк в сессию.
     """
     try:
-        dataset_to_delete = db.session.get(Datasets, int(dataset_id))
+        dataset_id = int(dataset_id)
+        dataset_to_delete = db.session.query(Datasets.dataset_name, Datasets.user_id, Datasets.source_hash_id).filter(
+            Datasets.id == dataset_id).first()
 
         if not dataset_to_delete:
             return False, 'Датасет не найден.'
@@ -420,43 +711,51 @@ def delete_dataset_by_id(dataset_id, current_user_id):
         if dataset_to_delete.user_id != current_user_id:
             return False, f'Отказано в доступе: вы не являетесь владельцем датасета "{dataset_name}"'
 
-        hashes_to_check_later = set()
-
-        if dataset_to_delete.source_hash_id:
-            hashes_to_check_later.add(dataset_to_delete.source_hash_id)
-
-        for link in dataset_to_delete.analysis_links:
-            if link.analysis_hash_id:
-                hashes_to_check_later.add(link.analysis_hash_id)
-
-            for graph in link.graphs:
-                if graph.hash_id:
-                    hashes_to_check_later.add(graph.hash_id)
+        analysis_hash_ids = [row.analysis_hash_id for row in db.session.query(DatasetAnalysisLink.analysis_hash_id)
+                             .filter(DatasetAnalysisLink.dataset_id == dataset_id)]
+        graph_hash_ids = [row.hash_id for row in db.session.query(Graphs.hash_id)
+                          .filter(Graphs.dataset_id == dataset_id, Graphs.hash_id.isnot(None))]
+        hashes_to_check_later = {dataset_to_delete.source_hash_id, *analysis_hash_ids, *graph_hash_ids}
+
+        print(f"Удаление датасета: '{dataset_name}' (ID: {dataset_id})")
+        graph_ids = db.session.query(Graphs.graph_id).filter(Graphs.dataset_id == dataset_id)
+        position_ids = db.session.query(PositionsCleaned.position_id).filter(PositionsCleaned.dataset_id == dataset_id)
+        for model, condition in (
+                (GraphEdges, GraphEdges.graph_id.in_(graph_ids)),
+                (GraphVertexes, GraphVertexes.graph_id.in_(graph_ids)),
+                (GraphHierarchies, GraphHierarchies.graph_id.in_(graph_ids)),
+                (ApprovedGraphs, ApprovedGraphs.graph_id.in_(graph_ids)),
+                (Graphs, Graphs.dataset_id == dataset_id),
+                (ClusterMembers, ClusterMembers.position_id.in_(position_ids)),
+                (PositionsCleaned, PositionsCleaned.dataset_id == dataset_id),
+                (DatasetAnalysisLink, DatasetAnalysisLink.dataset_id == dataset_id),
+                (Datasets, Datasets.id == dataset_id)):
+            db.session.query(model).filter(condition).delete(synchronize_session=False)
+        print(f"Датасет '{dataset_name}' и его дочерние записи удалены.")
+
+        # Хэши, на которые больше ничего не ссылается, - одним запросом
+        orphan_hashes = db.session.query(Hashes.hash_id, Hashes.hash_value).filter(
+            Hashes.hash_id.in_(hashes_to_check_later),
+            ~db.session.query(Datasets).filter(Datasets.source_hash_id == Hashes.hash_id).exists(),
+            ~db.session.query(DatasetAnalysisLink).filter(DatasetAnalysisLink.analysis_hash_id == Hashes.hash_id)
+            .exists(),
+            ~db.session.query(Graphs).filter(Graphs.hash_id == Hashes.hash_id).exists()
+        ).all()
 
-        print(f"Постановка на удаление датасета: '{dataset_name}' (ID: {dataset_id})")
-        db.session.delete(dataset_to_delete)
+        if orphan_hashes:
+            orphan_hash_ids = [row.hash_id for row in orphan_hashes]
+            print(f"Удаление осиротевших хэшей: {orphan_hash_ids}")
+            for model in (ClusterMembers, ClAverageValues, Clusters, ClDerivedGeometries, ClHulls, Hashes):
+                db.session.query(model).filter(model.hash_id.in_(orphan_hash_ids)).delete(synchronize_session=False)
 
         db.session.commit()
-        print(f"Датасет '{dataset_name}' и его дочерние записи успешно удалены.")
-
-        if hashes_to_check_later:
-            print(f"Проверка на осиротевшие хэши: {list(hashes_to_check_later)}")
-            for hash_id_to_check in reversed(list(hashes_to_check_later)):
-                is_used_elsewhere = db.session.query(
-                    db.or_(
-                        db.session.query(Datasets).filter_by(source_hash_id=hash_id_to_check).exists(),
-                        db.session.query(DatasetAnalysisLink).filter_by(analysis_hash_id=hash_id_to_check).exists(),
-                        db.session.query(Graphs).filter_by(hash_id=hash_id_to_check).exists()
-                    )
-                ).scalar()
-
-                if not is_used_elsewhere:
-                    print(f"Хэш {hash_id_to_check} больше не используется. Удаление...")
-                    hash_to_delete = db.session.get(Hashes, hash_id_to_check)
-                    if hash_to_delete:
-                        db.session.delete(hash_to_delete)
-
-            db.session.commit()
+        # Файлы кэша удаляются только после фиксации удаления в БД
+        for row in orphan_hashes:
+            drop_snapshot(positions_snapshot_name(row.hash_value))
+            drop_snapshot(clusters_snapshot_name(row.hash_value))
+            # Индексы соседей для подбора eps (Clustering.neighbor_index)
+            drop_cache_files(f'neighbors_{row.hash_value}')
+        if orphan_hashes:
             print("Очистка осиротевших хэшей завершена.")
 
         return True, f'Датасет "{dataset_name}" и все связанные данные успешно удалены.'
@@ -475,10 +774,16 @@ def store_extent(geographic_extent, dataset_id):
     dataset_to_update = db.session.query(Datasets).get(dataset_id)
 
     if dataset_to_update:
+        # Extent не меняется между запросами: без лишней записи запросы беспилотников остаются только читающими
+        if [dataset_to_update.extent_min_x, dataset_to_update.extent_min_y,
+                dataset_to_update.extent_max_x, dataset_to_update.extent_max_y] == list(geographic_extent) \
+                and dataset_to_update.extent_geom is not None:
+            return
         dataset_to_update.extent_min_x = geographic_extent[0]
         dataset_to_update.extent_min_y = geographic_extent[1]
         dataset_to_update.extent_max_x = geographic_extent[2]
         dataset_to_update.extent_max_y = geographic_extent[3]
+        dataset_to_update.extent_geom = shapely.box(*geographic_extent)
         try:
             db.session.commit()
         except Exception as e:
@@ -488,37 +793,67 @@ def store_extent(geographic_extent, dataset_id):
         print(f"Ошибка: Не удалось найти датасет с ID {dataset_id} в базе данных.")
 
 
+@read_only_queries()
 def load_graph(hash_id, map_renderer):
+    """
+    Загружает граф двумя запросами к graph_vertexes и graph_edges без ORM-объектов:
+    координаты всех вершин переводятся в координаты изображения одним вызовом NumPy.
+    """
     start = time.time()
-    graph_db = db.session.query(Graphs).filter_by(hash_id=hash_id).first()
+    graph_id = db.session.query(Graphs.graph_id).filter_by(hash_id=hash_id).scalar()
     graph_nx = networkx.DiGraph()
 
-    vertex_map = {}
-    for i, vertex in enumerate(graph_db.vertexes):
-        point = shapely.Point(map_renderer.get_img_coords_from_lat_lon(vertex.latitude, vertex.longitude))
-        graph_nx.add_node(point)
-        vertex_map[vertex.vertex_id] = point
-
-    for edge in graph_db.edges:
-        start_point = vertex_map.get(edge.start_vertex_id)
-        end_point = vertex_map.get(edge.end_vertex_id)
-
-        if start_point and end_point:
-            graph_nx.add_edge(
-                start_point,
-                end_point,
-                edge_id=edge.edge_id,
-                weight=edge.weight,
-                color=json.loads(edge.color),
-                angle_deviation=edge.angle_deviation,
-                distance=edge.distance,
-                speed=edge.speed
-            )
+    vertexes = np.array([tuple(row) for row in db.session.execute(
+        select(GraphVertexes.vertex_id, GraphVertexes.longitude, GraphVertexes.latitude)
+        .where(GraphVertexes.graph_id == graph_id)
+    )], dtype=np.float64).reshape(-1, 3)
+    vertex_ids = vertexes[:, 0].astype(np.int64).tolist()
+    points = shapely.points(map_renderer.img_coords_from_lon_lat(vertexes[:, 1], vertexes[:, 2]))
+    # vertex_id связывает узел с вершиной иерархии стягивания
+    graph_nx.add_nodes_from((point, {'vertex_id': vertex_id}) for point, vertex_id in zip(points, vertex_ids))
+    vertex_map = dict(zip(vertex_ids, points))
+
+    edges = db.session.execute(
+        select(GraphEdges.edge_id, GraphEdges.start_vertex_id, GraphEdges.end_vertex_id, GraphEdges.weight,
+               GraphEdges.cluster_num, GraphEdges.color, GraphEdges.angle_deviation, GraphEdges.distance,
+               GraphEdges.speed)
+        .where(GraphEdges.graph_id == graph_id)
+    ).all()
+    # Палитра кластеров та же, что у MapRenderer: цвет с номером i не зависит от числа кластеров
+    colors = generate_colors(max((edge[4] for edge in edges if edge[4] is not None), default=-1) + 1)
+    # У графов, сохраненных до появления cluster_num, цвет хранится строкой: разбираем каждую строку один раз
+    legacy_colors = {color: json.loads(color) for cluster_num, color in {(edge[4], edge[5]) for edge in edges}
+                     if cluster_num is None}
+
+    graph_nx.add_edges_from(
+        (vertex_map[start_vertex_id], vertex_map[end_vertex_id], {
+            'edge_id': edge_id,
+            'weight': weight,
+            'color': legacy_colors[color] if cluster_num is None else colors[cluster_num],
+            'cluster_num': cluster_num,
+            'angle_deviation': angle_deviation,
+            'distance': distance,
+            'speed': speed
+        })
+        for edge_id, start_vertex_id, end_vertex_id, weight, cluster_num, color, angle_deviation, distance, speed
+        in edges if start_vertex_id in vertex_map and end_vertex_id in vertex_map
+    )
 
-    print(
-        f"Граф ID: {graph_db.graph_id} успешно загружен из БД: {graph_nx.number_of_nodes()} вершин, {graph_nx.number_of_edges()} ребер.")
+    print(f"Граф ID: {graph_id} успешно загружен из БД: {graph_nx.number_of_nodes()} вершин, "
+          f"{graph_nx.number_of_edges()} ребер.")
     print(f'Время загрузки графа: {round(time.time() - start, 2)} сек.')
-    return graph_db.graph_id, graph_db.hash_id, graph_nx
+    return graph_id, hash_id, graph_nx
+
+
+# Параметры прореживания ребер графа и их значения "без прореживания"
+GRAPH_SPARSIFICATION_DEFAULTS = {
+    'max_edge_length': 0.0,
+    'edges_per_sector': 0.0,
+    'sectors_count': 3.0,
+    'prune_two_hop': False
+}
+# Параметры весов ребер: при их изменении сохраненный граф перевзвешивается, а не строится заново
+GRAPH_WEIGHT_PARAMS = ('weight_time_graph', 'weight_course_graph', 'weight_func_degree')
 
 
 def get_hash_value_from_graph_params(graph_params):
@@ -530,6 +865,16 @@ def get_hash_value_from_graph_params(graph_params):
         'cl_hash_id': graph_params['cl_hash_id'],
         'hull_type': graph_params['hull_type']
     }
+    # Прореживание меняет граф, но в хэш попадает только если включено, чтобы старые графы находились
+    for key, default in GRAPH_SPARSIFICATION_DEFAULTS.items():
+        value = graph_params.get(key, default)
+        if value != default:
+            params_for_hashing[key] = value
+    # Ребро, удаленное prune_two_hop при одних весах, при других может оказаться на кратчайшем пути,
+    # поэтому прореженный граф не перевзвешивается: для других весов строится свой граф
+    if params_for_hashing.get('prune_two_hop'):
+        for key in GRAPH_WEIGHT_PARAMS:
+            params_for_hashing[key] = graph_params[key]
     params_str = json.dumps(params_for_hashing, sort_keys=True)
     hash_value = hashlib.md5(params_str.encode('utf-8')).hexdigest()
     return hash_value
@@ -540,6 +885,9 @@ def check_graph(graph_params: dict, map_renderer):
     hash_obj = db.session.query(Hashes).filter_by(hash_value=hash_value).first()
 
     if hash_obj:
+        if db.session.query(Graphs.needs_rebuild).filter(Graphs.hash_id == hash_obj.hash_id).scalar():
+            print(f"Граф с hash_id: {hash_obj.hash_id} построен до изменения кластеризации и будет перестроен")
+            return None, None, None
         print(f"Найден существующий граф с hash_id: {hash_obj.hash_id}")
         return load_graph(hash_obj.hash_id, map_renderer)
     else:
@@ -552,6 +900,13 @@ def store_graph(graph: networkx.DiGraph, dataset_id: int, analysis_hash_id: int,
     hash_value = get_hash_value_from_graph_params(graph_params)
 
     del graph_params['search_algorithm']
+    # Граф, помеченный к перестроению после дозаписи, заменяется новым, утверждение переходит к новому графу
+    stale_graph = db.session.query(Graphs).join(Hashes, Hashes.hash_id == Graphs.hash_id).filter(
+        Hashes.hash_value == hash_value, Graphs.needs_rebuild.is_(True)).first()
+    reapprove = stale_graph is not None and bool(stale_graph.approved_graphs)
+    if stale_graph is not None:
+        db.session.query(Hashes).filter(Hashes.hash_id == stale_graph.hash_id).delete(synchronize_session=False)
+        db.session.expunge(stale_graph)
     new_hash = Hashes(
         hash_value=hash_value,
         timestamp=datetime.now(),
@@ -571,41 +926,50 @@ def store_graph(graph: networkx.DiGraph, dataset_id: int, analysis_hash_id: int,
             f"Граф не будет сохранен.")
         return
 
-    graph_db = Graphs(
-        hash_id=new_hash.hash_id,
-        dataset_id=dataset_id,
-        analysis_hash_id=analysis_hash_id
-    )
-
-    node_to_vertex_map = {}
-    for node in graph.nodes():
-        lat, lon = map_renderer.get_lat_lon_from_img_coords(node.x, node.y)
-
-        vertex_db = GraphVertexes(latitude=lat, longitude=lon)
-        graph_db.vertexes.append(vertex_db)
-        node_to_vertex_map[node] = vertex_db
-
-    for start_node, end_node, edge_data in graph.edges(data=True):
-        start_vertex_db = node_to_vertex_map[start_node]
-        end_vertex_db = node_to_vertex_map[end_node]
-
-        edge_db = GraphEdges(
-            start_vertex=start_vertex_db,
-            end_vertex=end_vertex_db,
-            distance=edge_data.get('distance'),
-            speed=edge_data.get('speed'),
-            weight=edge_data.get('weight'),
-            color=str(edge_data.get('color')),
-            angle_deviation=edge_data.get('angle_deviation')
-        )
-        graph_db.edges.append(edge_db)
     try:
+        graph_db = Graphs(
+            hash_id=new_hash.hash_id,
+            dataset_id=dataset_id,
+            analysis_hash_id=analysis_hash_id
+        )
         db.session.add(graph_db)
+        db.session.flush()
+
+        # Вершины - одной массовой вставкой, координаты пересчитываются для всех узлов сразу
+        nodes = list(graph.nodes())
+        node_xy = shapely.get_coordinates(np.asarray(nodes, dtype=object)).reshape(-1, 2)
+        longitudes, latitudes = map_renderer.lon_lat_from_img_coords(node_xy[:, 0], node_xy[:, 1])
+        bulk_insert(GraphVertexes.__table__, pd.DataFrame({
+            'graph_id': graph_db.graph_id,
+            'latitude': latitudes,
+            'longitude': longitudes,
+            'geom': shapely.points(longitudes, latitudes)
+        }))
+        # Идентификаторы выдаются по порядку вставки
+        vertex_ids = [row.vertex_id for row in db.session.query(GraphVertexes.vertex_id)
+                      .filter_by(graph_id=graph_db.graph_id).order_by(GraphVertexes.vertex_id)]
+        node_to_vertex_id = dict(zip(nodes, vertex_ids))
+
+        # Ребра - кортежами столбцов за один проход по графу; цвет строкой только у ребер без номера кластера
+        edges = pd.DataFrame.from_records([
+            (graph_db.graph_id, node_to_vertex_id[u], node_to_vertex_id[v], data.get('distance'), data.get('speed'),
+             data.get('weight'), data.get('cluster_num'),
+             str(data.get('color')) if data.get('cluster_num') is None else None, data.get('angle_deviation'))
+            for u, v, data in graph.edges(data=True)
+        ], columns=['graph_id', 'start_vertex_id', 'end_vertex_id', 'distance', 'speed', 'weight', 'cluster_num',
+                    'color', 'angle_deviation'])
+        # Пропуски не должны превращать номера кластеров в float (COPY в целочисленный столбец)
+        edges['cluster_num'] = edges['cluster_num'].astype('Int64')
+        bulk_insert(GraphEdges.__table__, edges)
+
         db.session.commit()
         print(
             f"Граф ID: {graph_db.graph_id} для результата кластеризации с hash_id: {analysis_hash_id} успешно сохранен: "
-            f"{len(graph_db.vertexes)} вершин и {len(graph_db.edges)} ребер.")
+            f"{len(nodes)} вершин и {len(edges)} ребер.")
         print(f'Время сохранения графа: {round(time.time() - start, 2)} сек.')
+        if reapprove:
+            print(f"Граф ID: {stale_graph.graph_id} заменен графом ID: {graph_db.graph_id}, утверждение перенесено")
+            approve_graph(graph_db.graph_id)
         return graph_db.graph_id
     except Exception as e:
         db.session.rollback()
@@ -643,8 +1007,85 @@ def update_graph_edges(hash_id: int, new_params: dict, graph_nx: networkx.DiGrap
     finally:
         print(f'Время обновления весов: {round(time.time() - start, 2)} сек.')
 
+    # Иерархия стягивания построена по старым весам: утвержденный граф переутверждаем
+    graph_db = db.session.query(Graphs).filter_by(hash_id=hash_id).first()
+    if graph_db and graph_db.hierarchy:
+        db.session.delete(graph_db.hierarchy)
+        db.session.commit()
+    if graph_db and graph_db.approved_graphs:
+        build_graph_hierarchy(graph_db.graph_id)
+
+
+def build_graph_hierarchy(graph_id: int):
+    """
+    Предварительная обработка утвержденного графа: строит и сохраняет иерархию стягивания
+    по текущим весам ребер. Запросы беспилотников затем ищут путь по ней.
+    """
+    start = time.time()
+    edges = np.array(db.session.query(GraphEdges.start_vertex_id, GraphEdges.end_vertex_id, GraphEdges.weight)
+                     .filter(GraphEdges.graph_id == graph_id).all(), dtype=np.float64).reshape(-1, 3)
+    start_vertex_ids = edges[:, 0].astype(np.int64)
+    end_vertex_ids = edges[:, 1].astype(np.int64)
+    vertex_ids = np.unique(np.concatenate([start_vertex_ids, end_vertex_ids]))
+    hierarchy = build_contraction_hierarchy(vertex_ids, np.searchsorted(vertex_ids, start_vertex_ids),
+                                            np.searchsorted(vertex_ids, end_vertex_ids), edges[:, 2])
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **hierarchy)
+    try:
+        db.session.query(GraphHierarchies).filter_by(graph_id=graph_id).delete(synchronize_session=False)
+        db.session.add(GraphHierarchies(graph_id=graph_id, data=buffer.getvalue()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ОШИБКА при сохранении иерархии стягивания графа ID: {graph_id}: {e}")
+        return False
+    print(f"Иерархия стягивания графа ID: {graph_id} построена: {len(edges)} ребер, "
+          f"{len(hierarchy['up_targets']) + len(hierarchy['down_targets'])} ребер с учетом shortcuts.")
+    print(f'Время построения иерархии: {round(time.time() - start, 2)} сек.')
+    return True
+
+
+def get_graph_version(hash_id):
+    """
+    Версия сохраненного графа для кэша в памяти процесса: меняется при пересохранении графа,
+    пересчете весов (новые параметры) и при появлении или удалении иерархии стягивания.
+    """
+    row = db.session.query(Graphs.graph_id, Hashes.timestamp, Hashes.params, GraphHierarchies.graph_id).join(
+        Hashes, Hashes.hash_id == Graphs.hash_id
+    ).outerjoin(
+        GraphHierarchies, GraphHierarchies.graph_id == Graphs.graph_id
+    ).filter(Graphs.hash_id == hash_id).first()
+    if row is None:
+        return None
+    graph_id, timestamp, params, hierarchy_graph_id = row
+    return graph_id, timestamp.isoformat(), json.dumps(params, sort_keys=True), hierarchy_graph_id is not None
+
+
+def load_graph_hierarchy(graph_id: int):
+    row = db.session.get(GraphHierarchies, graph_id)
+    if row is None:
+        return None
+    with np.load(io.BytesIO(row.data)) as saved:
+        return {name: saved[name] for name in saved.files}
+
+
+def approve_graph(graph_id: int):
+    """
+    Утверждает граф для запросов беспилотников и строит для него иерархию стягивания.
+    Повторное утверждение перестраивает иерархию.
+    """
+    if db.session.get(Graphs, graph_id) is None:
+        print(f"Граф ID: {graph_id} не найден.")
+        return False
+    if db.session.get(ApprovedGraphs, graph_id) is None:
+        db.session.add(ApprovedGraphs(graph_id=graph_id))
+        db.session.commit()
+    return build_graph_hierarchy(graph_id)
+
 
 # Для малышей беспилотников, вроде работает
+@read_only_queries()
 def find_approved_graphs(start_coords: tuple, end_coords: tuple):
     try:
         start_lat, start_lon = start_coords
@@ -652,6 +1093,20 @@ def find_approved_graphs(start_coords: tuple, end_coords: tuple):
         start_x, start_y = mercantile.xy(start_lon, start_lat)
         end_x, end_y = mercantile.xy(end_lon, end_lat)
 
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # Обе точки внутри extent - поиск по GiST-индексу datasets.extent_geom
+            area_filter = and_(
+                func.ST_Contains(Datasets.extent_geom, func.ST_SetSRID(func.ST_MakePoint(start_x, start_y), 3857)),
+                func.ST_Contains(Datasets.extent_geom, func.ST_SetSRID(func.ST_MakePoint(end_x, end_y), 3857))
+            )
+        else:
+            area_filter = and_(
+                Datasets.extent_min_x <= start_x, start_x <= Datasets.extent_max_x,
+                Datasets.extent_min_y <= start_y, start_y <= Datasets.extent_max_y,
+                Datasets.extent_min_x <= end_x, end_x <= Datasets.extent_max_x,
+                Datasets.extent_min_y <= end_y, end_y <= Datasets.extent_max_y
+            )
+
         graphs_db = db.session.query(Graphs).join(
             ApprovedGraphs, ApprovedGraphs.graph_id == Graphs.graph_id
         ).join(
@@ -659,12 +1114,7 @@ def find_approved_graphs(start_coords: tuple, end_coords: tuple):
         ).join(
             Hashes, Hashes.hash_id == Graphs.hash_id
         ).filter(
-            and_(
-                Datasets.extent_min_x <= start_x, start_x <= Datasets.extent_max_x,
-                Datasets.extent_min_y <= start_y, start_y <= Datasets.extent_max_y,
-                Datasets.extent_min_x <= end_x, end_x <= Datasets.extent_max_x,
-                Datasets.extent_min_y <= end_y, end_y <= Datasets.extent_max_y
-            )
+            area_filter
         ).order_by(
             desc(Hashes.timestamp)
         ).all()
@@ -1,9 +1,148 @@
+import sqlite3
+from contextlib import contextmanager
+
+import shapely
+from flask import g, has_app_context
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import JSON, ForeignKeyConstraint, Index
+from flask_sqlalchemy.session import Session
+from sqlalchemy import JSON, ForeignKeyConstraint, Index, LargeBinary, bindparam, event, inspect, select, text
+from sqlalchemy.types import TypeDecorator, UserDefinedType
 from werkzeug.security import generate_password_hash, check_password_hash
 
-db = SQLAlchemy()
+# Ключ движка в SQLALCHEMY_BINDS, подключения которого открывают БД только на чтение
+READ_ONLY_BIND = 'readonly'
+# Прагмы каждого нового подключения к SQLite. WAL: чтение не блокируется длинными транзакциями загрузки,
+# в этом режиме synchronous=NORMAL безопасен для целостности БД (при сбое питания теряется только хвост записей)
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL;',
+    'PRAGMA synchronous=NORMAL;',
+    'PRAGMA foreign_keys=1;',
+    # Ожидание блокировки записи другим процессом вместо немедленной ошибки database is locked, мс
+    'PRAGMA busy_timeout=30000;',
+    # Страничный кэш подключения (отрицательное значение - в КиБ) и отображение файла БД в память
+    'PRAGMA cache_size=-65536;',
+    'PRAGMA mmap_size=268435456;',
+    'PRAGMA temp_store=MEMORY;',
+)
+
+
+def install_sqlite_pragmas(engine_class, get_pragmas=lambda: SQLITE_PRAGMAS):
+    """
+    Каждое новое подключение к SQLite получает прагмы get_pragmas(), подключения к другим СУБД не меняются.
+    """
+
+    @event.listens_for(engine_class, 'connect')
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma in get_pragmas():
+            try:
+                cursor.execute(pragma)
+            except sqlite3.OperationalError:
+                # Подключение только для чтения не может сменить режим журнала,
+                # WAL хранится в самом файле БД и включается первым подключением на запись
+                if 'journal_mode' not in pragma:
+                    raise
+        cursor.close()
+
+
+class RoutingSession(Session):
+    """
+    Сессия, которая в контексте, помеченном use_read_only_db(), выполняет все запросы
+    через движок READ_ONLY_BIND. Случайная запись в таком контексте завершится ошибкой БД,
+    а не изменит данные.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('read_only_db'):
+            engine = self._db.engines.get(READ_ONLY_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def use_read_only_db():
+    """
+    Переключает сессию текущего контекста приложения на подключения только для чтения.
+    Вызывать до первого обращения к БД в контексте.
+    """
+    g.read_only_db = True
+
+
+@contextmanager
+def read_only_queries():
+    """
+    Запросы внутри блока (или декорированной функции) идут через подключения только для чтения
+    и видят только зафиксированные данные. Если в сессии есть несохраненные изменения,
+    чтение остается на основном подключении, иначе автосброс изменений попал бы в read-only.
+    """
+    if not has_app_context() or db.session.new or db.session.dirty or db.session.deleted:
+        yield
+        return
+    previous = g.get('read_only_db', False)
+    g.read_only_db = True
+    try:
+        yield
+    finally:
+        g.read_only_db = previous
+
+
+class PostgisGeometry(UserDefinedType):
+    cache_ok = True
+
+    def __init__(self, geometry_type, srid):
+        self.geometry_type = geometry_type
+        self.srid = srid
+
+    def get_col_spec(self, **kw):
+        return f'geometry({self.geometry_type}, {self.srid})'
+
+
+class Geometry(TypeDecorator):
+    """
+    Геометрия shapely. В PostgreSQL - столбец geometry PostGIS (значения передаются в виде HEXEWKB),
+    в SQLite - WKB в BLOB, пространственные запросы там выполняются по обычным столбцам.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, geometry_type='GEOMETRY', srid=4326):
+        super().__init__()
+        self.geometry_type = geometry_type
+        self.srid = srid
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(PostgisGeometry(self.geometry_type, self.srid))
+        return dialect.type_descriptor(LargeBinary())
+
+    def encode(self, geoms, dialect_name):
+        """
+        Векторное преобразование массива геометрий в значения для драйвера (для массовой загрузки).
+        """
+        if dialect_name == 'postgresql':
+            return shapely.to_wkb(shapely.set_srid(geoms, self.srid), hex=True, include_srid=True)
+        return shapely.to_wkb(geoms)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.encode(value, dialect.name)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return shapely.from_wkb(value)
+
+
+def spatial_index(name, column):
+    # GiST-индекс есть только в PostgreSQL, в SQLite столбец геометрии не индексируется
+    return Index(name, column, postgresql_using='gist').ddl_if(dialect='postgresql')
 
 
 class User(UserMixin, db.Model):
@@ -26,6 +165,8 @@ class Hashes(db.Model):
     hash_value = db.Column(db.String(64), unique=True, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     params = db.Column(JSON, nullable=True)
+    # Для кластеризаций: среднее и масштаб признаков, с которыми работал DBSCAN ({'mean': [...], 'scale': [...]})
+    feature_scaler = db.Column(JSON, nullable=True)
 
     clusters = db.relationship('Clusters', back_populates='hash', cascade="all, delete-orphan", passive_deletes=True)
     graphs = db.relationship('Graphs', back_populates='hash', cascade="all, delete-orphan", passive_deletes=True)
@@ -47,7 +188,12 @@ class Datasets(db.Model):
     extent_min_y = db.Column(db.Float, nullable=True)
     extent_max_x = db.Column(db.Float, nullable=True)
     extent_max_y = db.Column(db.Float, nullable=True)
+    # Тот же extent прямоугольником в web-mercator для пространственных запросов PostGIS
+    extent_geom = db.Column(Geometry('POLYGON', 3857), nullable=True)
 
+    __table_args__ = (
+        spatial_index('idx_datasets_extent_geom', 'extent_geom'),
+    )
     user = db.relationship('User', back_populates='datasets')
     source_hash = db.relationship('Hashes', back_populates='source_of_datasets', foreign_keys=[source_hash_id])
     analysis_links = db.relationship('DatasetAnalysisLink', back_populates='dataset', cascade="all, delete-orphan",
@@ -92,8 +238,6 @@ class Clusters(db.Model):
                               passive_deletes=True)
     avg_values = db.relationship('ClAverageValues', back_populates='cluster', uselist=False,
                                  cascade="all, delete-orphan", passive_deletes=True)
-    polygons = db.relationship('ClPolygons', back_populates='cluster', cascade="all, delete-orphan",
-                               passive_deletes=True)
 
 
 class ClusterMembers(db.Model):
@@ -107,6 +251,8 @@ class ClusterMembers(db.Model):
         ForeignKeyConstraint(['hash_id', 'cluster_num'], ['clusters.hash_id', 'clusters.cluster_num'],
                              ondelete='CASCADE'),
         Index('idx_cm_hash_cluster', 'hash_id', 'cluster_num'),
+        # Каскадное удаление позиций датасета ищет членства по position_id
+        Index('idx_cm_position', 'position_id'),
     )
     cluster = db.relationship('Clusters', back_populates='members')
     position = db.relationship('PositionsCleaned', back_populates='cluster_membership')
@@ -118,6 +264,11 @@ class ClAverageValues(db.Model):
     cluster_num = db.Column(db.Integer, primary_key=True)
     average_speed = db.Column(db.Float)
     average_course = db.Column(db.Float)
+    point_count = db.Column(db.Integer)
+    course_dispersion = db.Column(db.Float)
+    speed_p10 = db.Column(db.Float)
+    speed_median = db.Column(db.Float)
+    speed_p90 = db.Column(db.Float)
 
     __table_args__ = (
         ForeignKeyConstraint(['hash_id', 'cluster_num'], ['clusters.hash_id', 'clusters.cluster_num'],
@@ -127,20 +278,41 @@ class ClAverageValues(db.Model):
     cluster = db.relationship('Clusters', back_populates='avg_values')
 
 
-class ClPolygons(db.Model):
-    __tablename__ = 'cl_polygons'
-    polygon_point_id = db.Column(db.Integer, primary_key=True)
-    hash_id = db.Column(db.Integer, nullable=False)
-    cluster_num = db.Column(db.Integer, nullable=False)
-    x = db.Column(db.Float, nullable=False)
-    y = db.Column(db.Float, nullable=False)
+class ClDerivedGeometries(db.Model):
+    """
+    Кэш производной геометрии кластеризации: оболочки, их буферы, пересечения
+    и узлы будущего графа. Одна строка - один вид данных целиком (массивы NumPy в формате npz),
+    координаты географические (x - долгота, y - широта).
+    """
+    __tablename__ = 'cl_derived_geometries'
+    derived_id = db.Column(db.Integer, primary_key=True)
+    hash_id = db.Column(db.Integer, db.ForeignKey('hashes.hash_id', ondelete='CASCADE'), nullable=False)
+    hull_type = db.Column(db.String(32), nullable=False)
+    # hulls, buffers, intersections, boundary_nodes, inner_nodes
+    kind = db.Column(db.String(32), nullable=False)
+    # Только для узлов, у геометрии оболочек и пересечений NULL
+    distance_delta = db.Column(db.Float, nullable=True)
+    data = db.Column(db.LargeBinary, nullable=False)
 
     __table_args__ = (
-        ForeignKeyConstraint(['hash_id', 'cluster_num'], ['clusters.hash_id', 'clusters.cluster_num'],
-                             ondelete='CASCADE'),
-        Index('idx_clp_hash_cluster', 'hash_id', 'cluster_num'),
+        Index('idx_cld_hash_hull_kind', 'hash_id', 'hull_type', 'kind', 'distance_delta'),
+    )
+
+
+class ClHulls(db.Model):
+    """
+    Оболочки кластеров по одной строке на кластер, в географических координатах.
+    Дублируют оболочки из cl_derived_geometries для пространственных запросов в БД.
+    """
+    __tablename__ = 'cl_hulls'
+    hash_id = db.Column(db.Integer, db.ForeignKey('hashes.hash_id', ondelete='CASCADE'), primary_key=True)
+    hull_type = db.Column(db.String(32), primary_key=True)
+    cluster_num = db.Column(db.Integer, primary_key=True)
+    geom = db.Column(Geometry('GEOMETRY', 4326), nullable=False)
+
+    __table_args__ = (
+        spatial_index('idx_cl_hulls_geom', 'geom'),
     )
-    cluster = db.relationship('Clusters', back_populates='polygons')
 
 
 class Graphs(db.Model):
@@ -149,6 +321,9 @@ class Graphs(db.Model):
     hash_id = db.Column(db.Integer, db.ForeignKey('hashes.hash_id', ondelete='CASCADE'), index=True)
     dataset_id = db.Column(db.Integer, nullable=False)
     analysis_hash_id = db.Column(db.Integer, nullable=False)
+    # Кластеризация изменилась после построения графа (дозапись датасета). Утвержденный граф продолжает
+    # обслуживать беспилотников, пока граф с теми же параметрами не будет построен заново
+    needs_rebuild = db.Column(db.Boolean, nullable=True)
 
     __table_args__ = (
         ForeignKeyConstraint(['dataset_id', 'analysis_hash_id'],
@@ -163,6 +338,8 @@ class Graphs(db.Model):
     edges = db.relationship('GraphEdges', back_populates='graph', cascade="all, delete-orphan", passive_deletes=True)
     approved_graphs = db.relationship('ApprovedGraphs', back_populates='graph', cascade="all, delete-orphan",
                                       passive_deletes=True)
+    hierarchy = db.relationship('GraphHierarchies', back_populates='graph', uselist=False,
+                                cascade="all, delete-orphan", passive_deletes=True)
 
 
 class ApprovedGraphs(db.Model):
@@ -172,6 +349,17 @@ class ApprovedGraphs(db.Model):
     graph = db.relationship('Graphs', back_populates='approved_graphs')
 
 
+class GraphHierarchies(db.Model):
+    """
+    Иерархия стягивания утвержденного графа (массивы numpy в формате npz), строится при утверждении.
+    """
+    __tablename__ = 'graph_hierarchies'
+    graph_id = db.Column(db.Integer, db.ForeignKey('graphs.graph_id', ondelete='CASCADE'), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    graph = db.relationship('Graphs', back_populates='hierarchy')
+
+
 class GraphVertexes(db.Model):
     __tablename__ = 'graph_vertexes'
     vertex_id = db.Column(db.Integer, primary_key=True)
@@ -179,7 +367,11 @@ class GraphVertexes(db.Model):
                          index=True)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
+    geom = db.Column(Geometry('POINT', 4326), nullable=True)
 
+    __table_args__ = (
+        spatial_index('idx_graph_vertexes_geom', 'geom'),
+    )
     graph = db.relationship('Graphs', back_populates='vertexes')
     edges_start = db.relationship('GraphEdges', back_populates='start_vertex',
                                   foreign_keys='GraphEdges.start_vertex_id', cascade="all, delete-orphan",
@@ -198,7 +390,10 @@ class GraphEdges(db.Model):
     distance = db.Column(db.Float)
     speed = db.Column(db.Float)
     weight = db.Column(db.Float)
+    # Цвет ребра в старых графах (строка [r, g, b, a]), у новых NULL - цвет определяет cluster_num
     color = db.Column(db.String)
+    # Номер кластера, через который проходит ребро: индекс в палитре generate_colors
+    cluster_num = db.Column(db.Integer, nullable=True)
     angle_deviation = db.Column(db.Float)
     graph_id = db.Column(db.Integer, db.ForeignKey('graphs.graph_id', ondelete='CASCADE'), nullable=False,
                          index=True)
@@ -206,3 +401,62 @@ class GraphEdges(db.Model):
     start_vertex = db.relationship('GraphVertexes', foreign_keys=[start_vertex_id], back_populates='edges_start')
     end_vertex = db.relationship('GraphVertexes', foreign_keys=[end_vertex_id], back_populates='edges_end')
     graph = db.relationship('Graphs', back_populates='edges')
+
+
+# Вершины оболочек и пересечения кластеров до появления cl_derived_geometries. Переносить их не нужно:
+# геометрия пересчитывается по меткам кластеров при первом запросе и сохраняется в кэш
+OBSOLETE_TABLES = ('cl_polygons', 'cl_intersections')
+
+
+def upgrade_schema():
+    """
+    create_all не меняет существующие таблицы, поэтому новые необязательные столбцы
+    добавляем в уже созданную БД через ALTER TABLE, а таблицы, которых больше нет в модели, удаляем.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table_name in OBSOLETE_TABLES:
+            if inspector.has_table(table_name):
+                connection.execute(text(f'DROP TABLE {table_name}'))
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            # Индексы по добавленным столбцам (в том числе GiST в PostgreSQL)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        if db.engine.dialect.name == 'postgresql':
+            # Геометрия для строк, сохраненных до появления столбцов PostGIS
+            connection.execute(text(
+                'UPDATE datasets SET extent_geom = '
+                'ST_MakeEnvelope(extent_min_x, extent_min_y, extent_max_x, extent_max_y, 3857) '
+                'WHERE extent_geom IS NULL AND extent_min_x IS NOT NULL'))
+            connection.execute(text(
+                'UPDATE graph_vertexes SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) '
+                'WHERE geom IS NULL'))
+        else:
+            # Без PostGIS геометрию extent строит shapely: иначе store_extent считает extent несохраненным
+            # и пишет его при каждом запросе беспилотника, в том числе через подключение только для чтения
+            datasets = Datasets.__table__
+            rows = connection.execute(select(datasets.c.id, datasets.c.extent_min_x, datasets.c.extent_min_y,
+                                             datasets.c.extent_max_x, datasets.c.extent_max_y)
+                                      .where(datasets.c.extent_geom.is_(None), datasets.c.extent_min_x.is_not(None)))
+            updates = [{'dataset_id': row.id, 'geom': shapely.box(*row[1:])} for row in rows]
+            if updates:
+                connection.execute(datasets.update().where(datasets.c.id == bindparam('dataset_id'))
+                                   .values(extent_geom=bindparam('geom')), updates)
+
+
+def create_spatial_extension():
+    """
+    В PostgreSQL тип geometry появляется только после подключения PostGIS, поэтому вызывается до create_all.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as connection:
+            connection.execute(text('CREATE EXTENSION IF NOT EXISTS postgis'))
@@ -0,0 +1,247 @@
+import heapq
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+
+# Относительный допуск сравнения весов: при равенстве с точностью до округления shortcut добавляется
+WEIGHT_TOLERANCE = 1e-9
+# Сколько памяти можно занять строками матрицы расстояний исходного графа при построении
+DISTANCE_ROWS_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def _shortcuts_for_node(node, out_edges, in_edges, distance_row):
+    """
+    Ребра u->w, которые нужно добавить при стягивании node, чтобы сохранить кратчайшие расстояния.
+    Стягивание не меняет расстояний между оставшимися вершинами, поэтому путь-свидетель ищется
+    по исходному графу: shortcut нужен, только если путь u->node->w кратчайший.
+    """
+    if not in_edges[node] or not out_edges[node]:
+        return []
+    ins = np.fromiter(in_edges[node].keys(), dtype=np.int64, count=len(in_edges[node]))
+    in_weights = np.fromiter(in_edges[node].values(), dtype=np.float64, count=len(ins))
+    outs = np.fromiter(out_edges[node].keys(), dtype=np.int64, count=len(out_edges[node]))
+    out_weights = np.fromiter(out_edges[node].values(), dtype=np.float64, count=len(outs))
+
+    via_weights = in_weights[:, None] + out_weights[None, :]
+    # Поиск от каждого соседа можно ограничить его самым длинным путем через node
+    limits = via_weights.max(axis=1) * (1 + WEIGHT_TOLERANCE)
+    distances = np.vstack([distance_row(u, limit)[outs] for u, limit in zip(ins.tolist(), limits.tolist())])
+    needed = (distances >= via_weights * (1 - WEIGHT_TOLERANCE)) & (ins[:, None] != outs[None, :])
+    rows, cols = np.nonzero(needed)
+    return list(zip(ins[rows].tolist(), outs[cols].tolist(), via_weights[rows, cols].tolist()))
+
+
+def _to_csr(nodes_count, edges):
+    edges_array = np.array(edges, dtype=np.float64).reshape(-1, 4)
+    sources = edges_array[:, 0].astype(np.int64)
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(nodes_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=nodes_count), out=indptr[1:])
+    return (indptr, edges_array[order, 1].astype(np.int64), edges_array[order, 2],
+            edges_array[order, 3].astype(np.int64))
+
+
+def build_contraction_hierarchy(vertex_ids, sources, targets, weights):
+    """
+    Строит иерархию стягивания (contraction hierarchy) ориентированного графа.
+    sources/targets - позиции вершин ребер в vertex_ids, weights - неотрицательные веса.
+    Порядок стягивания - ленивая очередь по разности ребер (shortcuts - in - out) с учетом числа
+    уже стянутых соседей и уровня вершины в иерархии. Результат - словарь массивов для сохранения в npz:
+    ранги вершин, восходящий граф для прямого поиска и обращенный нисходящий граф для обратного,
+    middles - вершина, через которую проходит shortcut (-1 для исходных ребер).
+    """
+    nodes_count = len(vertex_ids)
+    # В out_edges/in_edges остаются только еще не стянутые вершины, middles - для ребер и shortcuts
+    out_edges = [{} for _ in range(nodes_count)]
+    in_edges = [{} for _ in range(nodes_count)]
+    middles = {}
+    for u, w, weight in zip(sources.tolist(), targets.tolist(), weights.tolist()):
+        if u == w or weight < 0:
+            continue
+        if weight < out_edges[u].get(w, float('inf')):
+            out_edges[u][w] = weight
+            in_edges[w][u] = weight
+            middles[(u, w)] = -1
+
+    edge_sources = np.repeat(np.arange(nodes_count), [len(edges) for edges in out_edges])
+    edge_targets = np.fromiter((w for edges in out_edges for w in edges), dtype=np.int64, count=len(edge_sources))
+    edge_weights = np.fromiter((weight for edges in out_edges for weight in edges.values()), dtype=np.float64,
+                               count=len(edge_sources))
+    graph_csr = scipy.sparse.csr_matrix((edge_weights, (edge_sources, edge_targets)), shape=(nodes_count, nodes_count))
+    # Расстояния от одной вершины нужны при моделировании стягивания каждого ее соседа,
+    # поэтому полные строки (Дейкстра из scipy) запоминаются, пока хватает DISTANCE_ROWS_CACHE_BYTES
+    distance_rows = {}
+    max_cached_rows = DISTANCE_ROWS_CACHE_BYTES // (8 * max(nodes_count, 1))
+
+    def distance_row(source, limit):
+        row = distance_rows.get(source)
+        if row is None:
+            if len(distance_rows) >= max_cached_rows:
+                return dijkstra(graph_csr, indices=source, limit=limit)
+            row = distance_rows[source] = dijkstra(graph_csr, indices=source)
+        return row
+
+    contracted_neighbors = [0] * nodes_count
+    levels = [0] * nodes_count
+    # Нужные shortcuts зависят только от ребер вершины (расстояния в исходном графе не меняются),
+    # поэтому результат моделирования стягивания устаревает лишь после стягивания соседа
+    simulated = {node: _shortcuts_for_node(node, out_edges, in_edges, distance_row) for node in range(nodes_count)}
+
+    def priority(node):
+        return (2 * (len(simulated[node]) - len(in_edges[node]) - len(out_edges[node]))
+                + contracted_neighbors[node] + levels[node])
+
+    queue = [(priority(node), node) for node in range(nodes_count)]
+    heapq.heapify(queue)
+    rank = np.zeros(nodes_count, dtype=np.int64)
+    contracted = [False] * nodes_count
+    up_edges, down_edges = [], []
+    current_rank = 0
+    while queue:
+        _, node = heapq.heappop(queue)
+        if contracted[node]:
+            continue
+        # Ленивое обновление: устаревший приоритет пересчитывается при извлечении и сравнивается со следующим
+        if node not in simulated:
+            simulated[node] = _shortcuts_for_node(node, out_edges, in_edges, distance_row)
+            node_priority = priority(node)
+            if queue and node_priority > queue[0][0]:
+                heapq.heappush(queue, (node_priority, node))
+                continue
+        shortcuts = simulated.pop(node)
+
+        # Ребра к еще не стянутым вершинам ведут вверх по рангам и попадают в иерархию
+        for w, weight in out_edges[node].items():
+            up_edges.append((node, w, weight, middles[(node, w)]))
+            del in_edges[w][node]
+            contracted_neighbors[w] += 1
+            levels[w] = max(levels[w], levels[node] + 1)
+            simulated.pop(w, None)
+        for u, weight in in_edges[node].items():
+            # Нисходящее ребро хранится обращенным: обратный поиск идет от node к u вверх по рангам
+            down_edges.append((node, u, weight, middles[(u, node)]))
+            del out_edges[u][node]
+            contracted_neighbors[u] += 1
+            levels[u] = max(levels[u], levels[node] + 1)
+            simulated.pop(u, None)
+        out_edges[node], in_edges[node] = {}, {}
+
+        for u, w, weight in shortcuts:
+            if weight < out_edges[u].get(w, float('inf')):
+                out_edges[u][w] = weight
+                in_edges[w][u] = weight
+                middles[(u, w)] = node
+        contracted[node] = True
+        rank[node] = current_rank
+        current_rank += 1
+
+    hierarchy = {'vertex_ids': np.asarray(vertex_ids, dtype=np.int64), 'rank': rank}
+    for prefix, edges in (('up', up_edges), ('down', down_edges)):
+        indptr, edge_targets, edge_weights, edge_middles = _to_csr(nodes_count, edges)
+        hierarchy[f'{prefix}_indptr'] = indptr
+        hierarchy[f'{prefix}_targets'] = edge_targets
+        hierarchy[f'{prefix}_weights'] = edge_weights
+        hierarchy[f'{prefix}_middles'] = edge_middles
+    return hierarchy
+
+
+class ContractionHierarchy:
+    """
+    Готовая к запросам иерархия стягивания: массивы переводятся в списки смежности один раз при загрузке,
+    сам запрос - двунаправленная Дейкстра только по ребрам, ведущим вверх по рангам.
+    """
+
+    def __init__(self, arrays):
+        self.vertex_ids = arrays['vertex_ids']
+        self.index_of_vertex = {vertex_id: index for index, vertex_id in enumerate(self.vertex_ids.tolist())}
+        self.middles = {}
+        self.up = self._adjacency(arrays, 'up', reverse=False)
+        self.down = self._adjacency(arrays, 'down', reverse=True)
+
+    def _adjacency(self, arrays, prefix, reverse):
+        indptr = arrays[f'{prefix}_indptr'].tolist()
+        targets = arrays[f'{prefix}_targets'].tolist()
+        weights = arrays[f'{prefix}_weights'].tolist()
+        middles = arrays[f'{prefix}_middles'].tolist()
+        adjacency = []
+        for node in range(len(indptr) - 1):
+            edges = list(zip(targets[indptr[node]:indptr[node + 1]], weights[indptr[node]:indptr[node + 1]]))
+            adjacency.append(edges)
+            for target, middle in zip(targets[indptr[node]:indptr[node + 1]],
+                                      middles[indptr[node]:indptr[node + 1]]):
+                if middle >= 0:
+                    self.middles[(target, node) if reverse else (node, target)] = middle
+        return adjacency
+
+    def _unpack(self, u, w):
+        stack, path = [(u, w)], []
+        while stack:
+            a, b = stack.pop()
+            middle = self.middles.get((a, b))
+            if middle is None:
+                path.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return path
+
+    def shortest_path(self, sources: dict, targets: dict):
+        """
+        Кратчайший путь от виртуального начала к виртуальному концу графа.
+        sources - {вершина: вес ребра от начала}, targets - {вершина: вес ребра до конца}.
+        Возвращает (расстояние, список вершин исходного графа) или (inf, None), если пути нет.
+        """
+        distances = ({}, {})
+        parents = ({}, {})
+        queues = ([], [])
+        for direction, seeds in enumerate((sources, targets)):
+            for node, weight in seeds.items():
+                if weight < distances[direction].get(node, float('inf')):
+                    distances[direction][node] = weight
+                    parents[direction][node] = None
+                    heapq.heappush(queues[direction], (weight, node))
+
+        best, meeting_node = float('inf'), None
+        graphs = (self.up, self.down)
+        direction = 0
+        while queues[0] or queues[1]:
+            # Поиск завершается, когда обе очереди не могут улучшить найденное расстояние
+            if min(queues[0][0][0] if queues[0] else float('inf'),
+                   queues[1][0][0] if queues[1] else float('inf')) >= best:
+                break
+            if not queues[direction]:
+                direction = 1 - direction
+            distance, node = heapq.heappop(queues[direction])
+            # Stall-on-demand: вершина, до которой есть более короткий путь сверху, не продолжает поиск
+            if distance <= distances[direction][node] and not any(
+                    distances[direction].get(higher, float('inf')) + weight < distance
+                    for higher, weight in graphs[1 - direction][node]):
+                other_distance = distances[1 - direction].get(node)
+                if other_distance is not None and distance + other_distance < best:
+                    best, meeting_node = distance + other_distance, node
+                for neighbor, weight in graphs[direction][node]:
+                    new_distance = distance + weight
+                    if new_distance < distances[direction].get(neighbor, float('inf')):
+                        distances[direction][neighbor] = new_distance
+                        parents[direction][neighbor] = node
+                        heapq.heappush(queues[direction], (new_distance, neighbor))
+            direction = 1 - direction
+
+        if meeting_node is None:
+            return best, None
+
+        forward = [meeting_node]
+        while parents[0][forward[-1]] is not None:
+            forward.append(parents[0][forward[-1]])
+        forward.reverse()
+        backward = [meeting_node]
+        while parents[1][backward[-1]] is not None:
+            backward.append(parents[1][backward[-1]])
+
+        path = [forward[0]]
+        for u, w in zip(forward, forward[1:]):
+            path.extend(self._unpack(u, w))
+        for u, w in zip(backward, backward[1:]):
+            path.extend(self._unpack(u, w))
+        return best, [int(self.vertex_ids[node]) for node in path]
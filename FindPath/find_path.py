@@ -10,8 +10,15 @@ import shapely.ops
 from joblib import Parallel, delayed, parallel_backend
 
 from DataMovements.data_movements import load_clusters, get_hash_value, get_ds_hash_id, store_graph, check_graph, \
-    get_hash_params, update_graph_edges, load_graph
+    get_hash_params, update_graph_edges, get_hash_value_from_graph_params, haversine_distance, \
+    GRAPH_SPARSIFICATION_DEFAULTS, GRAPH_WEIGHT_PARAMS
+from FindPath.graph_cache import get_shared_graph
+from FindPath.query_overlay import QueryOverlay
 from Helpers.data_helpers import get_coordinates, astar_heuristic, format_coordinate
+from Helpers.metrics import observe_span
+from Helpers.run_log import run_log
+from Jobs.jobs import report_progress
+from Jobs.single_flight import graph_flight
 from Visualization.visualization import MapRenderer
 
 
@@ -23,7 +30,7 @@ def find_path(graph_params, clustering_params, cl_hash_id, gr_hash_id=None):
     del graph_params['end_coords']
 
     for key in graph_params:
-        if key not in ('search_algorithm', 'points_inside', 'dataset_id', 'hull_type'):
+        if key not in ('search_algorithm', 'points_inside', 'dataset_id', 'hull_type', 'prune_two_hop'):
             graph_params[key] = float(graph_params[key])
 
     _, df = load_clusters(cl_hash_id)
@@ -54,6 +61,56 @@ def _get_edge_distance(point_1, point_2, renderer_data):
     return mpu.haversine_distance((lat1, lon1), (lat2, lon2)) / 1.85
 
 
+def _sparsify_candidates(candidates, angles, distances, angle_left_rad, graph_params):
+    """
+    Ограничивает число ребер из точки: отбрасывает слишком длинные и в каждом из секторов
+    конуса обзора оставляет только edges_per_sector ближайших точек.
+    """
+    max_edge_length = graph_params.get('max_edge_length', GRAPH_SPARSIFICATION_DEFAULTS['max_edge_length'])
+    if max_edge_length:
+        keep = distances <= max_edge_length
+        candidates, angles, distances = candidates[keep], angles[keep], distances[keep]
+
+    edges_per_sector = int(graph_params.get('edges_per_sector', GRAPH_SPARSIFICATION_DEFAULTS['edges_per_sector']))
+    if edges_per_sector and len(candidates):
+        sectors_count = max(1, int(graph_params.get('sectors_count', GRAPH_SPARSIFICATION_DEFAULTS['sectors_count'])))
+        sector_size = math.radians(graph_params['angle_of_vision']) / sectors_count
+        sectors = np.clip(((angles - angle_left_rad) // sector_size).astype(np.int64), 0, sectors_count - 1)
+        # Сортировка по сектору, затем по расстоянию: ранг внутри сектора - номер среди ближайших
+        order = np.lexsort((distances, sectors))
+        sorted_sectors = sectors[order]
+        sector_starts = np.searchsorted(sorted_sectors, sorted_sectors, side='left')
+        keep = order[np.arange(len(order)) - sector_starts < edges_per_sector]
+        keep.sort()
+        candidates, angles, distances = candidates[keep], angles[keep], distances[keep]
+
+    return candidates, angles, distances
+
+
+def prune_dominated_edges(graph: networkx.DiGraph):
+    """
+    Удаляет ребра u->w, для которых есть путь u->v->w не дороже: кратчайшие пути от этого не меняются.
+    Доминирование проверяется по текущим весам и при других весах неверно, поэтому веса
+    прореженного графа входят в его хэш (get_hash_value_from_graph_params).
+    """
+    edges_to_remove = []
+    for u, u_successors in graph.adjacency():
+        # Промежуточная вершина v годится, только если ребро u->v легче u->w, поэтому перебираем по возрастанию веса
+        successors = sorted(((data.get('weight', 0), v) for v, data in u_successors.items()
+                             if v != u and data.get('weight', 0) > 0), key=lambda item: item[0])
+        for uw_weight, w in successors:
+            for uv_weight, v in successors:
+                if uv_weight >= uw_weight:
+                    break
+                vw_data = graph.succ[v].get(w)
+                if vw_data is not None and vw_data.get('weight', 0) > 0 and \
+                        uv_weight + vw_data['weight'] <= uw_weight:
+                    edges_to_remove.append((u, w))
+                    break
+    graph.remove_edges_from(edges_to_remove)
+    return len(edges_to_remove)
+
+
 def _calculate_edges_for_point(current_point, rotation, renderer_data, intersection_points, graph_params):
     angle_of_vision = graph_params['angle_of_vision']
     available_directions = {}
@@ -63,8 +120,14 @@ def _calculate_edges_for_point(current_point, rotation, renderer_data, intersect
         if shapely.intersects(renderer_data['polygon_buffers'][key], current_point):
             available_directions[key] = renderer_data['average_courses'][key]
 
-    angles = {point: (math.atan2(point.y - current_point.y, point.x - current_point.x)
-                      + 2 * math.pi) % (math.pi * 2) for point in intersection_points}
+    # Координаты всех узлов считаются один раз в build_graph, здесь только векторные операции
+    points_xy = renderer_data['intersection_xy']
+    points_lon_lat = renderer_data['intersection_lon_lat']
+    current_lon, current_lat = mercantile.lnglat(renderer_data['left_top'][0] + current_point.x / renderer_data['kx'],
+                                                 renderer_data['left_top'][1] + current_point.y / renderer_data['ky'])
+    angles = (np.arctan2(points_xy[:, 1] - current_point.y, points_xy[:, 0] - current_point.x)
+              + 2 * math.pi) % (math.pi * 2)
+    hull_type = renderer_data['clustering_params']['hull_type']
 
     for key, direction in available_directions.items():
         angle_center = (direction - 90 - rotation + 360) % 360
@@ -74,41 +137,44 @@ def _calculate_edges_for_point(current_point, rotation, renderer_data, intersect
         angle_center_rad = math.radians(angle_center)
         angle_right_rad = math.radians(angle_right)
 
-        try:
-            current_angles_keys = []
-            hull_type = renderer_data['clustering_params']['hull_type']
-            if hull_type == 'convex_hull':
-                current_angles_keys = shapely.intersection(
-                    renderer_data['polygon_buffers'][key], shapely.MultiPoint(list(angles.keys()))).geoms
-            elif hull_type == 'concave_hull':
-                current_angles_keys_multipoint = shapely.intersection(
-                    renderer_data['polygon_buffers'][key], shapely.MultiPoint(list(angles.keys()))).geoms
-                current_angles_keys = [
-                    point for point in current_angles_keys_multipoint
-                    if shapely.contains(renderer_data['polygon_buffers'][key],
-                                        shapely.LineString([point, current_point]))]
-        except AttributeError:
+        polygon_buffer = renderer_data['polygon_buffers'][key]
+        # Подготовленная геометрия многократно ускоряет проверки принадлежности для массивов
+        shapely.prepare(polygon_buffer)
+        candidates = np.flatnonzero((angle_left_rad <= angles) & (angles <= angle_right_rad))
+        candidates = candidates[shapely.intersects_xy(polygon_buffer, points_xy[candidates, 0],
+                                                      points_xy[candidates, 1])]
+        if hull_type == 'concave_hull' and len(candidates):
+            # Ребро допустимо, только если отрезок целиком лежит внутри вогнутой оболочки
+            segments = shapely.linestrings(np.stack([points_xy[candidates],
+                                                     np.broadcast_to([current_point.x, current_point.y],
+                                                                     (len(candidates), 2))], axis=1))
+            candidates = candidates[shapely.contains(polygon_buffer, segments)]
+        elif hull_type not in ('convex_hull', 'concave_hull'):
             continue
 
-        for point in current_angles_keys:
-            if angle_left_rad <= angles[point] <= angle_right_rad:
-                angle_deviation = math.degrees(abs(angles[point] - angle_center_rad))
-                distance = _get_edge_distance(point, current_point, renderer_data)
-                speed = renderer_data['average_speeds'][key] / 10
-                p = graph_params['weight_func_degree']
-                weight = np.power(
-                    np.power(abs((distance / speed) * graph_params['weight_time_graph']), p) +
-                    np.power(abs(angle_deviation * graph_params['weight_course_graph']), p),
-                    1 / p)
-
-                edge_start, edge_end = (point, current_point) if rotation == 180 else (current_point, point)
-
-                edge_data = {
-                    'u': edge_start, 'v': edge_end, 'weight': weight,
-                    'color': renderer_data['colors'][key], 'angle_deviation': angle_deviation,
-                    'distance': distance, 'speed': speed
-                }
-                edges_to_add.append(edge_data)
+        distances = haversine_distance(points_lon_lat[candidates, 0], points_lon_lat[candidates, 1],
+                                       current_lon, current_lat) / 1.85
+        candidates, candidate_angles, distances = _sparsify_candidates(candidates, angles[candidates], distances,
+                                                                       angle_left_rad, graph_params)
+
+        for point, point_angle, distance in zip(intersection_points[candidates], candidate_angles, distances):
+            angle_deviation = math.degrees(abs(point_angle - angle_center_rad))
+            distance = float(distance)
+            speed = renderer_data['average_speeds'][key] / 10
+            p = graph_params['weight_func_degree']
+            weight = np.power(
+                np.power(abs((distance / speed) * graph_params['weight_time_graph']), p) +
+                np.power(abs(angle_deviation * graph_params['weight_course_graph']), p),
+                1 / p)
+
+            edge_start, edge_end = (point, current_point) if rotation == 180 else (current_point, point)
+
+            edge_data = {
+                'u': edge_start, 'v': edge_end, 'weight': weight,
+                'color': renderer_data['colors'][key], 'cluster_num': int(key), 'angle_deviation': angle_deviation,
+                'distance': distance, 'speed': speed
+            }
+            edges_to_add.append(edge_data)
 
     return edges_to_add
 
@@ -123,6 +189,11 @@ class GraphBuilder:
         self.map_renderer = MapRenderer(west=west, south=south, east=east, north=north,
                                         zoom=zoom, df=df, cl_hash_id=cl_hash_id, ds_hash_value=ds_hash_value)
         self.graph = networkx.DiGraph()
+        # Иерархия стягивания есть только у утвержденных графов
+        self.hierarchy = None
+        self.hierarchy_nodes = {}
+        # Время этапов запроса (graph_build, search, total) для журнала запусков
+        self.timings = {}
 
     def get_edge_distance(self, point_1, point_2):
         web_x1, web_y1 = (self.map_renderer.left_top[0] + point_1.x / self.map_renderer.kx,
@@ -134,7 +205,7 @@ class GraphBuilder:
         distance = mpu.haversine_distance((lat1, lon1), (lat2, lon2)) / 1.85
         return distance
 
-    def get_nearest_poly_point(self, point):
+    def get_nearest_poly_point(self, point, overlay):
         polygon_union = [shapely.Polygon(polygon) for polygon in self.map_renderer.polygon_bounds.values()]
         nearest_point = shapely.ops.nearest_points(shapely.ops.unary_union(polygon_union), point)[0]
         renderer_data = {
@@ -143,10 +214,10 @@ class GraphBuilder:
             'ky': self.map_renderer.ky,
         }
         distance = _get_edge_distance(point, nearest_point, renderer_data)
-        self.graph.add_edge(point, nearest_point, weight=0, color=[1, 0, 0, 1], angle_deviation=0,
-                            distance=distance, speed=15)
-        self.graph.add_edge(nearest_point, point, weight=0, color=[1, 0, 0, 1], angle_deviation=0,
-                            distance=distance, speed=15)
+        overlay.add_edge(point, nearest_point, weight=0, color=[1, 0, 0, 1], angle_deviation=0,
+                         distance=distance, speed=15)
+        overlay.add_edge(nearest_point, point, weight=0, color=[1, 0, 0, 1], angle_deviation=0,
+                         distance=distance, speed=15)
 
         return nearest_point
 
@@ -169,7 +240,8 @@ class GraphBuilder:
         result_graph = {}
         end_point_saved = None
         graph_id = None
-        points_to_delete = []
+        # Точки отправления и прибытия и их ребра живут только в графе запроса, self.graph не меняется
+        overlay = QueryOverlay(self.graph)
         start_interesting_points = end_interesting_points = 0
         # Обработка случая, когда точка А или Б не попала в полигон
         # Предполагаем, что скорость в таком случае 30 узлов
@@ -186,25 +258,20 @@ class GraphBuilder:
                     start_point_in_poly = True
 
             if not start_point_in_poly:
-                current_point = self.get_nearest_poly_point(start_point)
-                points_to_delete.append(current_point)
+                current_point = self.get_nearest_poly_point(start_point, overlay)
             else:
                 current_point = start_point
-            points_to_delete.append(start_point)
 
             if not end_point_in_poly:
                 end_point_saved = end_point
-                end_point = self.get_nearest_poly_point(end_point)
-                points_to_delete.append(end_point_saved)
-            points_to_delete.append(end_point)
+                end_point = self.get_nearest_poly_point(end_point, overlay)
 
-            if current_point not in self.map_renderer.intersection_points:
-                self.map_renderer.intersection_points.append(current_point)
-            if end_point not in self.map_renderer.intersection_points:
-                self.map_renderer.intersection_points.append(end_point)
+            query_points = [point for point in (current_point, end_point)
+                            if point not in self.map_renderer.intersection_points]
+            query_points_set = set(query_points)
 
-            self.graph.add_node(start_point)
-            self.graph.add_node(end_point)
+            overlay.add_node(start_point)
+            overlay.add_node(end_point)
 
             renderer_data = {
                 'left_top': self.map_renderer.left_top,
@@ -218,7 +285,11 @@ class GraphBuilder:
                 'clustering_params': self.map_renderer.clustering_params
             }
 
-            intersection_points = self.map_renderer.intersection_points
+            intersection_points = np.array(self.map_renderer.intersection_points + query_points, dtype=object)
+            intersection_xy = shapely.get_coordinates(intersection_points)
+            renderer_data['intersection_xy'] = intersection_xy
+            renderer_data['intersection_lon_lat'] = np.column_stack(
+                self.map_renderer.lon_lat_from_img_coords(intersection_xy[:, 0], intersection_xy[:, 1]))
             graph_params = self.map_renderer.graph_params
 
             start_edges = _calculate_edges_for_point(current_point, 0, renderer_data, intersection_points, graph_params)
@@ -228,38 +299,51 @@ class GraphBuilder:
             end_interesting_points = len(end_edges)
 
             for edge in start_edges + end_edges:
-                self.graph.add_edge(edge['u'], edge['v'], **{k: v for k, v in edge.items() if k not in ['u', 'v']})
+                overlay.add_edge(edge['u'], edge['v'], **{k: v for k, v in edge.items() if k not in ['u', 'v']})
 
             if start_interesting_points != 0 and end_interesting_points != 0 and create_new_graph:
+                points_to_visit = [point for point in intersection_points if point not in (current_point, end_point)]
                 with parallel_backend('loky'):
-                    results = Parallel(n_jobs=-1)(
+                    results = Parallel(n_jobs=-1, return_as='generator')(
                         delayed(_calculate_edges_for_point)(point, 0, renderer_data, intersection_points, graph_params)
-                        for point in intersection_points
-                        if point not in (current_point, end_point)
+                        for point in points_to_visit
                     )
 
-                for edge_list in results:
-                    for edge_data in edge_list:
-                        existing_edge = self.graph.get_edge_data(edge_data['u'], edge_data['v'])
-                        if existing_edge is None or existing_edge.get('weight', float('inf')) > edge_data['weight']:
-                            self.graph.add_edge(edge_data['u'], edge_data['v'],
-                                                **{k: v for k, v in edge_data.items() if k not in ['u', 'v']})
-
+                    for points_processed, edge_list in enumerate(results, start=1):
+                        report_progress('graph_points', points_processed, len(points_to_visit))
+                        for edge_data in edge_list:
+                            # Ребра к точкам запроса нужны только для поиска, в сохраняемый граф не попадают
+                            target_graph = overlay if edge_data['v'] in query_points_set else self.graph
+                            existing_edge = target_graph.get_edge_data(edge_data['u'], edge_data['v'])
+                            if existing_edge is None or existing_edge.get('weight', float('inf')) > edge_data['weight']:
+                                target_graph.add_edge(edge_data['u'], edge_data['v'],
+                                                      **{k: v for k, v in edge_data.items() if k not in ['u', 'v']})
+
+                if graph_params.get('prune_two_hop'):
+                    pruned_edges_count = prune_dominated_edges(self.graph)
+                    print(f'Удалено доминируемых ребер: {pruned_edges_count}')
+
+            last_point = end_point
             if end_point_saved:
                 end_point = end_point_saved
 
             build_graph_time = round(time.time() - build_graph_start_time, 3)
+            observe_span('graph_build', build_graph_time)
+            self.timings['graph_build'] = build_graph_time
 
             # Вызов A* и Дейкстры, отрисовка пути
             find_path_start_time = time.time()
             paths = []
             try:
                 # Длина пути только для сравнения алгоритмов поиска, считается по весам ребер
-                if self.map_renderer.graph_params['search_algorithm'] == 'Dijkstra':
+                if drone_mode and self.hierarchy is not None:
+                    paths.append(self._find_path_with_hierarchy(start_point, current_point, last_point, end_point,
+                                                                start_edges, end_edges))
+                elif self.map_renderer.graph_params['search_algorithm'] == 'Dijkstra':
                     # paths.append(networkx.dijkstra_path(self.graph, start_point, end_point))
-                    paths.append(networkx.bidirectional_dijkstra(self.graph, start_point, end_point)[1])
+                    paths.append(overlay.bidirectional_dijkstra(start_point, end_point))
                 elif self.map_renderer.graph_params['search_algorithm'] == 'A*':
-                    paths.append(networkx.astar_path(self.graph, start_point, end_point, heuristic=astar_heuristic))
+                    paths.append(overlay.astar_path(start_point, end_point, heuristic=astar_heuristic))
             except networkx.NetworkXNoPath:
                 raise networkx.NetworkXNoPath('No path between points.')
 
@@ -267,13 +351,13 @@ class GraphBuilder:
             too_far_from_polygon_exc = ''
             if not start_point_in_poly:
                 for path in paths:
-                    distance = round(self.graph.get_edge_data(path[0], path[1])['distance'], 2)
+                    distance = round(overlay.get_edge_data(path[0], path[1])['distance'], 2)
                     if distance > max_miles_outside_polygon:
                         too_far_from_polygon_exc += (f'start_point is too far from nearest polygon '
                                                      f'({distance} > {max_miles_outside_polygon} miles).')
             if not end_point_in_poly:
                 for path in paths:
-                    distance = round(self.graph.get_edge_data(path[-2], path[-1])['distance'], 2)
+                    distance = round(overlay.get_edge_data(path[-2], path[-1])['distance'], 2)
                     if distance > max_miles_outside_polygon:
                         if too_far_from_polygon_exc:
                             too_far_from_polygon_exc += ' '
@@ -283,8 +367,10 @@ class GraphBuilder:
                 raise networkx.NetworkXNoPath(too_far_from_polygon_exc)
 
             find_path_time = round(time.time() - find_path_start_time, 3)
+            observe_span('search', find_path_time)
+            self.timings['search'] = find_path_time
 
-            result_graph = self.map_renderer.show_graph(self.graph, paths, build_graph_time, find_path_time,
+            result_graph = self.map_renderer.show_graph(overlay, paths, build_graph_time, find_path_time,
                                                         create_new_graph, drone_mode)
 
         except networkx.NetworkXNoPath as exc:
@@ -304,11 +390,6 @@ class GraphBuilder:
         # Выделение точек начала и конца
         self.map_renderer.show_start_and_end_points(start_point, end_point)
 
-        # Удаляем начальный и конечный узлы,
-        # чтобы в графе не копился мусор
-        for point in set(points_to_delete):
-            if point:
-                self.graph.remove_node(point)
         # Если граф не был построен - обнуляем граф и его параметры
         if (start_interesting_points == 0 or end_interesting_points == 0) and create_new_graph:
             self.map_renderer.graph_params = {}
@@ -321,7 +402,48 @@ class GraphBuilder:
 
         return result_graph, graph_id
 
+    def _find_path_with_hierarchy(self, start_point, first_point, last_point, end_point, start_edges, end_edges):
+        """
+        Поиск по иерархии стягивания. Начало и конец маршрута не входят в иерархию,
+        поэтому их ребра задают начальные расстояния прямого и обратного поиска.
+        """
+        index_of_vertex = self.hierarchy.index_of_vertex
+        sources, targets = {}, {}
+        direct_weight = float('inf')
+        for edge in start_edges:
+            if edge['v'] == last_point:
+                direct_weight = min(direct_weight, edge['weight'])
+                continue
+            if edge['v'] == first_point:
+                continue
+            index = index_of_vertex.get(self.graph.nodes[edge['v']].get('vertex_id'))
+            if index is not None:
+                sources[index] = min(sources.get(index, float('inf')), edge['weight'])
+        for edge in end_edges:
+            # Ребро в конец может начинаться в самой точке отправления: ее нет в общем графе, это прямое ребро
+            if edge['u'] == first_point:
+                direct_weight = min(direct_weight, edge['weight'])
+                continue
+            if edge['u'] == last_point:
+                continue
+            index = index_of_vertex.get(self.graph.nodes[edge['u']].get('vertex_id'))
+            if index is not None:
+                targets[index] = min(targets.get(index, float('inf')), edge['weight'])
+
+        weight, vertex_path = self.hierarchy.shortest_path(sources, targets)
+        if vertex_path is None and direct_weight == float('inf'):
+            raise networkx.NetworkXNoPath('No path between points.')
+
+        path = [start_point] if start_point == first_point else [start_point, first_point]
+        if weight <= direct_weight:
+            path.extend(self.hierarchy_nodes[vertex_id] for vertex_id in vertex_path)
+        path.append(last_point)
+        if end_point != last_point:
+            path.append(end_point)
+        return path
+
     def find_path(self, x_start, y_start, x_end, y_end, gr_hash_id=None):
+        start_time = time.perf_counter()
         self.map_renderer.create_empty_map()
         self.map_renderer.calculate_points_on_image()
         self.map_renderer.create_empty_map_with_points()
@@ -329,20 +451,49 @@ class GraphBuilder:
         self.map_renderer.show_intersections()
         self.map_renderer.show_average_values()
 
+        flight_key = flight_call = None
         if gr_hash_id:
-            graph_id, _, self.graph = load_graph(gr_hash_id, self.map_renderer)
+            # Утвержденный граф и его иерархия общие для потоков процесса, запрос их только читает
+            shared_graph = get_shared_graph(gr_hash_id, self.map_renderer)
+            graph_id, self.graph = shared_graph.graph_id, shared_graph.graph
+            self.hierarchy, self.hierarchy_nodes = shared_graph.hierarchy, shared_graph.hierarchy_nodes
             drone_mode = True
         else:
             graph_id, gr_hash_id, self.graph = check_graph(self.map_renderer.graph_params, self.map_renderer)
             drone_mode = False
+            # Если такой же граф уже строится другим запросом - дожидаемся его сохранения и загружаем из БД
+            flight_key = get_hash_value_from_graph_params(self.map_renderer.graph_params)
+            while not self.graph:
+                flight_call, is_leader = graph_flight.join(flight_key)
+                if is_leader:
+                    # Прежний лидер мог сохранить граф и освободить ключ уже после нашей проверки
+                    graph_id, gr_hash_id, self.graph = check_graph(self.map_renderer.graph_params,
+                                                                   self.map_renderer)
+                    if self.graph:
+                        graph_flight.finish(flight_key, flight_call)
+                        flight_call = None
+                    break
+                print(f'Граф с такими параметрами уже строится ({flight_key}), ожидаем...')
+                flight_call.wait()
+                flight_call = None
+                graph_id, gr_hash_id, self.graph = check_graph(self.map_renderer.graph_params, self.map_renderer)
 
+        try:
+            return self._find_path_on_graph(x_start, y_start, x_end, y_end, graph_id, gr_hash_id, drone_mode,
+                                            start_time)
+        finally:
+            if flight_call is not None:
+                graph_flight.finish(flight_key, flight_call)
+
+    def _find_path_on_graph(self, x_start, y_start, x_end, y_end, graph_id, gr_hash_id, drone_mode, start_time):
+        # Точки запроса как их прислал пользователь: широта, долгота
+        start_coords, end_coords = [x_start, y_start], [x_end, y_end]
         if self.graph:
             self.map_renderer.intersection_points = list(self.graph.nodes)
             create_new_graph = False
             saved_params = get_hash_params(gr_hash_id)
-            if (saved_params['weight_time_graph'] != self.map_renderer.graph_params['weight_time_graph'] or
-                    saved_params['weight_course_graph'] != self.map_renderer.graph_params['weight_course_graph'] or
-                    saved_params['weight_func_degree'] != self.map_renderer.graph_params['weight_func_degree']):
+            # У прореженного графа веса входят в хэш, поэтому сюда он попадает только с теми же весами
+            if any(saved_params[key] != self.map_renderer.graph_params[key] for key in GRAPH_WEIGHT_PARAMS):
                 self.recalculate_edges(gr_hash_id)
         else:
             self.graph = networkx.DiGraph()
@@ -363,14 +514,13 @@ class GraphBuilder:
         graph_img = self.map_renderer.save_clustered_image('path')
 
         result_graph['ID графа'] = graph_id
-        with open('./static/logs/PATH_log.txt', 'a') as log_file:
-            if drone_mode:
-                log_file.write('Запрос от беспилотника!' + '\n')
-            log_file.write('Параметры для графа: ' + str(self.map_renderer.graph_params) + '\n')
-            for key, value in result_graph.items():
-                if key != 'drone':
-                    log_file.write(str(key) + ': ' + str(value) + '\n')
-            log_file.write('\n')
+        self.timings['total'] = round(time.perf_counter() - start_time, 3)
+        run_log.write('path', drone_mode=drone_mode, graph_id=graph_id, gr_hash_id=gr_hash_id,
+                      cl_hash_id=self.map_renderer.cl_hash_id, params=self.map_renderer.graph_params,
+                      start_point=start_coords, end_point=end_coords, new_graph=create_new_graph,
+                      found='Error' not in result_graph, error=result_graph.get('Error'),
+                      vertexes=self.graph.number_of_nodes(), edges=self.graph.number_of_edges(),
+                      route=self.map_renderer.route_stats, timings=self.timings)
 
         if drone_mode:
             return result_graph['drone']
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+import networkx
+
+from DataMovements.data_movements import get_graph_version, load_graph, load_graph_hierarchy
+from FindPath.contraction_hierarchy import ContractionHierarchy
+from Jobs.single_flight import SingleFlight
+
+# Сколько утвержденных графов держать в памяти процесса, остальные загружаются из БД заново
+MAX_GRAPHS_IN_MEMORY = 4
+
+_graphs = OrderedDict()
+_graphs_lock = threading.Lock()
+# Одновременные запросы к еще не загруженному графу ждут одну загрузку
+_graph_loads = SingleFlight()
+
+
+class SharedGraph:
+    """
+    Утвержденный граф, общий для всех потоков процесса-воркера. Граф заморожен (networkx.freeze):
+    ребра запроса добавляются только в QueryOverlay, а попытка изменить общий граф завершится ошибкой.
+    Иерархия стягивания после построения тоже только читается.
+    """
+
+    def __init__(self, graph_id, graph: networkx.DiGraph, hierarchy: ContractionHierarchy = None):
+        self.graph_id = graph_id
+        self.graph = networkx.freeze(graph)
+        self.hierarchy = hierarchy
+        self.hierarchy_nodes = {vertex_id: node for node, vertex_id in graph.nodes(data='vertex_id')} \
+            if hierarchy is not None else {}
+
+
+def _load_shared_graph(gr_hash_id, map_renderer):
+    graph_id, _, graph = load_graph(gr_hash_id, map_renderer)
+    hierarchy_arrays = load_graph_hierarchy(graph_id)
+    if hierarchy_arrays is None:
+        print(f'Для графа ID: {graph_id} нет иерархии стягивания, поиск без нее.')
+        return SharedGraph(graph_id, graph)
+    return SharedGraph(graph_id, graph, ContractionHierarchy(hierarchy_arrays))
+
+
+def get_shared_graph(gr_hash_id, map_renderer):
+    """
+    Граф для запросов беспилотников. Узлы графа - точки в координатах изображения карты,
+    поэтому в ключ кэша кроме версии графа входит привязка карты рендерера.
+    """
+    key = (get_graph_version(gr_hash_id), tuple(map_renderer.left_top), map_renderer.kx, map_renderer.ky)
+    with _graphs_lock:
+        shared_graph = _graphs.get(key)
+        if shared_graph is not None:
+            _graphs.move_to_end(key)
+            return shared_graph
+
+    shared_graph = _graph_loads.do(key, _load_shared_graph, gr_hash_id, map_renderer)
+    with _graphs_lock:
+        _graphs[key] = shared_graph
+        while len(_graphs) > MAX_GRAPHS_IN_MEMORY:
+            _graphs.popitem(last=False)
+    return shared_graph
@@ -0,0 +1,134 @@
+import heapq
+from itertools import count
+
+import networkx
+
+
+class QueryOverlay:
+    """
+    Граф одного запроса: общий базовый граф плюс ребра точек отправления и прибытия.
+    Базовый граф не изменяется, поэтому один граф в памяти могут одновременно использовать несколько запросов.
+    Ребро запроса заменяет ребро базового графа между теми же вершинами.
+    """
+
+    def __init__(self, graph: networkx.DiGraph):
+        self.graph = graph
+        self._succ = {}
+        self._pred = {}
+
+    def add_node(self, node):
+        self._succ.setdefault(node, {})
+        self._pred.setdefault(node, {})
+
+    def add_edge(self, u, v, **data):
+        self._succ.setdefault(u, {})[v] = data
+        self._pred.setdefault(v, {})[u] = data
+
+    def get_edge_data(self, u, v):
+        data = self._succ.get(u, {}).get(v)
+        if data is None and u in self.graph:
+            data = self.graph.succ[u].get(v)
+        return data
+
+    def __contains__(self, node):
+        return node in self._succ or node in self._pred or node in self.graph
+
+    def _neighbors(self, node, overlay_adjacency, graph_adjacency):
+        overlay_neighbors = overlay_adjacency.get(node, {})
+        if node in self.graph:
+            for neighbor, data in graph_adjacency[node].items():
+                if neighbor not in overlay_neighbors:
+                    yield neighbor, data
+        yield from overlay_neighbors.items()
+
+    def successors(self, node):
+        return self._neighbors(node, self._succ, self.graph.succ)
+
+    def predecessors(self, node):
+        return self._neighbors(node, self._pred, self.graph.pred)
+
+    def __str__(self):
+        extra_nodes = {node for node in (*self._succ, *self._pred) if node not in self.graph}
+        extra_edges = sum(1 for u, neighbors in self._succ.items() for v in neighbors
+                          if not (u in self.graph and self.graph.has_edge(u, v)))
+        return (f'{type(self.graph).__name__} with {self.graph.number_of_nodes() + len(extra_nodes)} nodes '
+                f'and {self.graph.number_of_edges() + extra_edges} edges')
+
+    def bidirectional_dijkstra(self, source, target):
+        """
+        Двунаправленный алгоритм Дейкстры (как networkx.bidirectional_dijkstra), возвращает список вершин пути.
+        """
+        if source not in self or target not in self:
+            raise networkx.NodeNotFound(f'Either source {source} or target {target} is not in graph')
+        if source == target:
+            return [source]
+
+        distances = ({}, {})
+        seen = ({source: 0}, {target: 0})
+        paths = ({source: [source]}, {target: [target]})
+        tie_breaker = count()
+        queues = ([(0, next(tie_breaker), source)], [(0, next(tie_breaker), target)])
+        neighbors = (self.successors, self.predecessors)
+        final_distance, final_path = None, []
+        direction = 1
+        while queues[0] and queues[1]:
+            direction = 1 - direction
+            distance, _, node = heapq.heappop(queues[direction])
+            if node in distances[direction]:
+                continue
+            distances[direction][node] = distance
+            if node in distances[1 - direction]:
+                return final_path
+            for neighbor, data in neighbors[direction](node):
+                new_distance = distance + data.get('weight', 1)
+                if neighbor in distances[direction]:
+                    continue
+                if neighbor not in seen[direction] or new_distance < seen[direction][neighbor]:
+                    seen[direction][neighbor] = new_distance
+                    heapq.heappush(queues[direction], (new_distance, next(tie_breaker), neighbor))
+                    paths[direction][neighbor] = paths[direction][node] + [neighbor]
+                    if neighbor in seen[0] and neighbor in seen[1]:
+                        total_distance = seen[0][neighbor] + seen[1][neighbor]
+                        if not final_path or final_distance > total_distance:
+                            final_distance = total_distance
+                            final_path = paths[0][neighbor] + paths[1][neighbor][-2::-1]
+        raise networkx.NetworkXNoPath(f'No path between {source} and {target}.')
+
+    def astar_path(self, source, target, heuristic):
+        """
+        Поиск A* (как networkx.astar_path) с эвристикой heuristic(u, target), возвращает список вершин пути.
+        """
+        if source not in self or target not in self:
+            raise networkx.NodeNotFound(f'Either source {source} or target {target} is not in graph')
+
+        tie_breaker = count()
+        queue = [(0, next(tie_breaker), source, 0, None)]
+        enqueued = {}
+        explored = {}
+        while queue:
+            _, _, node, distance, parent = heapq.heappop(queue)
+            if node == target:
+                path = [node]
+                while parent is not None:
+                    path.append(parent)
+                    parent = explored[parent]
+                path.reverse()
+                return path
+            if node in explored:
+                if explored[node] is None:
+                    continue
+                queued_distance, _ = enqueued[node]
+                if queued_distance < distance:
+                    continue
+            explored[node] = parent
+            for neighbor, data in self.successors(node):
+                new_distance = distance + data.get('weight', 1)
+                if neighbor in enqueued:
+                    queued_distance, estimate = enqueued[neighbor]
+                    if queued_distance <= new_distance:
+                        continue
+                else:
+                    estimate = heuristic(neighbor, target)
+                enqueued[neighbor] = new_distance, estimate
+                heapq.heappush(queue, (new_distance + estimate, next(tie_breaker), neighbor, new_distance, node))
+        raise networkx.NetworkXNoPath(f'Node {target} not reachable from {source}')
@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from Helpers.metrics import observe_span
+
 
 def timer(func):
     def wrapper(*args, **kwargs):
@@ -8,6 +10,8 @@ def timer(func):
         end_time = datetime.now()
         duration = end_time - start_time
         print(f"Время выполнения функции {func.__name__}: {duration.total_seconds()} секунд")
+        # Кроме вывода в консоль время попадает в /metrics как этап с именем функции
+        observe_span(func.__name__, duration.total_seconds())
         return result
 
     return wrapper
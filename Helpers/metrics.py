@@ -0,0 +1,133 @@
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Границы корзин гистограмм в секундах: от запросов к БД до построения графа
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# Профили запросов (cProfile) сохраняются сюда, если профилирование включено
+PROFILES_DIR = os.path.join('.', 'DB', 'profiles')
+
+
+class Histogram:
+    """
+    Гистограмма Prometheus: накопительные корзины, сумма и количество для каждого набора меток.
+    Значения хранятся в памяти процесса, под gunicorn у каждого воркера свои.
+    """
+
+    def __init__(self, name, description, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def snapshot(self):
+        """
+        Количество и сумма по каждому набору меток: разница двух снимков - вклад отдельного этапа.
+        """
+        with self._lock:
+            return {labels: (series['count'], series['sum']) for labels, series in self._series.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series_items = sorted((labels, dict(series, counts=list(series['counts'])))
+                                  for labels, series in self._series.items())
+        for label_values, series in series_items:
+            labels = ','.join(f'{name}="{_escape_label(value)}"' for name, value in zip(self.label_names, label_values))
+            separator = ',' if labels else ''
+            for bound, count in zip(self.buckets, series['counts']):
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}{separator}le="+Inf"}} {series["count"]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]}')
+            lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return lines
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Этапы обработки: ingest, dbscan, hull, intersection, graph_build, search, render, db_io
+span_duration = Histogram('theway_span_duration_seconds', 'Длительность этапов обработки данных', ['span'])
+request_duration = Histogram('theway_http_request_duration_seconds', 'Длительность HTTP-запросов',
+                             ['endpoint', 'method', 'status'])
+
+
+def observe_span(name, seconds):
+    """
+    Для этапов, время которых уже измеряется по месту (например, показывается пользователю).
+    """
+    span_duration.observe(seconds, name)
+
+
+@contextmanager
+def span(name):
+    """
+    Именованный этап: with span('dbscan'): ... или декоратор @span('hull').
+    Время попадает в гистограмму и при исключении.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_duration.observe(time.perf_counter() - start, name)
+
+
+def instrument_engine(engine_class):
+    """
+    Каждый SQL-запрос через SQLAlchemy - этап db_io. Массовые вставки через курсор драйвера
+    (bulk_insert) событий движка не вызывают и учитываются в самом bulk_insert.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine_class, 'before_cursor_execute')
+    def _start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    @event.listens_for(engine_class, 'after_cursor_execute')
+    def _finish_query(conn, cursor, statement, parameters, context, executemany):
+        span_duration.observe(time.perf_counter() - conn.info['query_start_times'].pop(), 'db_io')
+
+
+def render_prometheus():
+    lines = span_duration.render() + request_duration.render()
+    return '\n'.join(lines) + '\n'
+
+
+def start_request_profile(profile_all, requested):
+    """
+    profile_all - профилировать каждый запрос, requested - запрос попросил профиль сам (?profile=1).
+    """
+    if not (profile_all or requested):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish_request_profile(profiler, endpoint):
+    """
+    Останавливает профилировщик и сохраняет статистику для snakeviz / pstats, возвращает путь к файлу.
+    """
+    profiler.disable()
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    file_name = f'{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}_{os.getpid()}_{endpoint or "unknown"}.prof'
+    file_path = os.path.join(PROFILES_DIR, file_name)
+    profiler.dump_stats(file_path)
+    return file_path
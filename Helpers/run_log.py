@@ -0,0 +1,173 @@
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+# Журнал запусков кластеризации и поиска пути в формате JSON Lines, вместо static/logs/*.txt
+RUN_LOG_PATH = os.path.join('.', 'DB', 'logs', 'runs.jsonl')
+# Ротация по размеру: runs.jsonl -> runs.jsonl.1 -> ... -> runs.jsonl.N, самый старый файл удаляется
+RUN_LOG_MAX_BYTES = 10 * 1024 * 1024
+RUN_LOG_BACKUPS = 5
+# Записи копятся в памяти и пишутся на диск одной пачкой не позже, чем через столько секунд
+FLUSH_INTERVAL = 1.0
+
+_FLUSH = object()
+
+
+def _to_json(value):
+    # Числа numpy (количество кластеров, время из np.float64) и прочее, что json не знает
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _to_iso(moment):
+    return moment.isoformat() if isinstance(moment, datetime) else moment
+
+
+class RunLog:
+    """
+    Запись не задерживает запрос: она только кладется в очередь, файл пишет фоновый поток процесса.
+    Воркеры gunicorn пишут в один файл: проверка размера, ротация и дозапись пачки идут под flock
+    на файле .lock, иначе два воркера могут ротировать журнал дважды или дописать в уже переименованный файл.
+    """
+
+    def __init__(self, path=RUN_LOG_PATH, max_bytes=RUN_LOG_MAX_BYTES, backups=RUN_LOG_BACKUPS,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def write(self, kind, **fields):
+        record = {'time': datetime.now().isoformat(timespec='milliseconds'), 'kind': kind, 'pid': os.getpid(),
+                  **fields}
+        # Сериализуем сразу: словари параметров вызывающий код может изменить до записи на диск
+        self._get_queue().put(json.dumps(record, ensure_ascii=False, default=_to_json) + '\n')
+
+    def flush(self):
+        """
+        Дожидается записи всего, что уже в очереди (при завершении процесса, в замерах).
+        """
+        with self._lock:
+            records_queue = self._queue if self._pid == os.getpid() else None
+        if records_queue is not None:
+            records_queue.put(_FLUSH)
+            records_queue.join()
+
+    def _get_queue(self):
+        # Поток записи запускается при первой записи: после fork (воркеры gunicorn) потока родителя нет
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._write_loop, args=(self._queue,), name='run-log', daemon=True).start()
+            return self._queue
+
+    def _write_loop(self, records_queue):
+        while True:
+            items = [records_queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while items[-1] is not _FLUSH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(records_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            lines = [item for item in items if item is not _FLUSH]
+            try:
+                if lines:
+                    self._write_lines(lines)
+            except OSError as exc:
+                print(f'Не удалось записать журнал запусков ({len(lines)} записей): {exc}')
+            finally:
+                for _ in items:
+                    records_queue.task_done()
+
+    @contextmanager
+    def _file_lock(self, operation):
+        # Блокировка между процессами, снимается при закрытии файла
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield
+
+    def _write_lines(self, lines):
+        data = ''.join(lines)
+        with self._file_lock(fcntl.LOCK_EX):
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(data.encode('utf-8')) > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'a', encoding='utf-8') as log_file:
+                log_file.write(data)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def read(self, kind=None, since=None, until=None, limit=None):
+        """
+        Записи от старых к новым с учетом ротированных файлов. since и until - datetime или строка ISO,
+        limit - сколько последних записей вернуть.
+        """
+        since, until = _to_iso(since), _to_iso(until)
+        records = []
+        # Общая блокировка: ротация не переименует файлы посреди чтения
+        with self._file_lock(fcntl.LOCK_SH):
+            for file_path in [f'{self.path}.{i}' for i in range(self.backups, 0, -1)] + [self.path]:
+                if not os.path.exists(file_path):
+                    continue
+                with open(file_path, encoding='utf-8') as log_file:
+                    for line in log_file:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Строка, оборванная при аварийном завершении процесса
+                            continue
+                        if kind and record['kind'] != kind:
+                            continue
+                        if (since and record['time'] < since) or (until and record['time'] > until):
+                            continue
+                        records.append(record)
+        return records[-limit:] if limit else records
+
+    def latency_trend(self, kind, stage='total', freq='1h', since=None, until=None):
+        """
+        Время этапа stage (ключ в timings записи) по интервалам freq: количество, среднее, p50, p95, максимум.
+        """
+        rows = [(record['time'], record['timings'][stage]) for record in self.read(kind, since, until)
+                if record.get('timings', {}).get(stage) is not None]
+        if not rows:
+            return []
+        df = pd.DataFrame(rows, columns=['time', 'seconds'])
+        df['time'] = pd.to_datetime(df['time'])
+        grouped = df.groupby(df['time'].dt.floor(freq))['seconds']
+        trend = pd.DataFrame({
+            'count': grouped.count(),
+            'mean': grouped.mean(),
+            'p50': grouped.quantile(0.5),
+            'p95': grouped.quantile(0.95),
+            'max': grouped.max()
+        }).round(3)
+        return [{'period': period.isoformat(), **row} for period, row in zip(trend.index, trend.to_dict('records'))]
+
+
+run_log = RunLog()
+# Записи из очереди дописываются и при штатном завершении процесса
+atexit.register(run_log.flush)
@@ -0,0 +1,123 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Тяжелые задачи (DBSCAN, построение графа) сами распараллеливаются через joblib,
+# поэтому одновременно выполняем немного задач, остальные ждут в очереди
+MAX_WORKERS = 2
+# Сколько секунд хранить завершенные задачи для опроса клиентом
+FINISHED_JOB_TTL = 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='job')
+_jobs = {}
+_condition = threading.Condition()
+_current = threading.local()
+
+
+class Job:
+    def __init__(self, kind, user_id, context=None):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.user_id = user_id
+        # Данные, которые понадобятся веб-слою после завершения задачи
+        self.context = context or {}
+        self.status = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        # Счетчик изменений, по нему SSE-поток понимает, что пора отправить обновление
+        self.version = 0
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self, with_result=False):
+        job_dict = {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': dict(self.progress),
+            'error': self.error
+        }
+        if with_result and self.status == 'done':
+            job_dict['result'] = self.result
+        return job_dict
+
+
+def _touch(job):
+    job.version += 1
+    _condition.notify_all()
+
+
+def _cleanup_finished_jobs():
+    now = time.time()
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job.is_finished and now - job.finished_at > FINISHED_JOB_TTL]:
+        del _jobs[job_id]
+
+
+def _run_job(job, app, func, args, kwargs):
+    _current.job = job
+    with _condition:
+        job.status = 'running'
+        _touch(job)
+    try:
+        with app.app_context():
+            result = func(*args, **kwargs)
+        with _condition:
+            job.result = result
+            job.status = 'done'
+    except Exception as exc:
+        print(f'Задача {job.kind} ({job.job_id}) завершилась с ошибкой: {exc}')
+        with _condition:
+            job.error = exc.args[0] if exc.args else str(exc)
+            job.status = 'failed'
+    finally:
+        _current.job = None
+        with _condition:
+            job.finished_at = time.time()
+            _touch(job)
+        print(f'Задача {job.kind} ({job.job_id}) выполнена за {round(job.finished_at - job.created_at, 2)} сек.')
+
+
+def submit_job(app, kind, user_id, func, *args, job_context=None, **kwargs):
+    """
+    Ставит функцию в очередь на выполнение в фоновом потоке внутри контекста приложения
+    и возвращает идентификатор задачи для опроса.
+    """
+    job = Job(kind, user_id, job_context)
+    with _condition:
+        _cleanup_finished_jobs()
+        _jobs[job.job_id] = job
+    _executor.submit(_run_job, job, app, func, args, kwargs)
+    return job.job_id
+
+
+def get_job(job_id):
+    with _condition:
+        return _jobs.get(job_id)
+
+
+def report_progress(stage, done, total=None):
+    """
+    Обновляет прогресс текущей задачи, вне фоновой задачи ничего не делает.
+    """
+    job = getattr(_current, 'job', None)
+    if job is None:
+        return
+    with _condition:
+        job.progress[stage] = {'done': done, 'total': total}
+        _touch(job)
+
+
+def wait_for_job_update(job, last_version, timeout=15.0):
+    """
+    Блокирует поток до изменения задачи или истечения таймаута, возвращает снимок состояния.
+    """
+    with _condition:
+        _condition.wait_for(lambda: job.version != last_version, timeout=timeout)
+        return job.version, job.to_dict(with_result=True)
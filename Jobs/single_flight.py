@@ -0,0 +1,63 @@
+import threading
+
+
+class _FlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    Схлопывает одновременные одинаковые вычисления в пределах процесса:
+    первый вызов с ключом выполняет работу, остальные ждут его и получают тот же результат.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def join(self, key):
+        """
+        Возвращает (call, is_leader). Лидер обязан вызвать finish, остальные - call.wait().
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = _FlightCall()
+            self._calls[key] = call
+            return call, True
+
+    def finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def do(self, key, func, *args, **kwargs):
+        call, is_leader = self.join(key)
+        if not is_leader:
+            print(f'Такое же вычисление уже выполняется ({key}), ожидаем его результат...')
+            return call.wait()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            self.finish(key, call, error=exc)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+
+# Общие для процесса группы: ключ - хэш параметров, как в таблице hashes
+clustering_flight = SingleFlight()
+graph_flight = SingleFlight()
@@ -1,4 +1,4 @@
-from Clustering.clustering import clustering
+from Clustering.clustering import clustering, suggest_eps, append_to_dataset
 from FindPath.find_path import find_path
 from DataMovements.data_movements import process_and_store_dataset
 
@@ -9,10 +9,20 @@ def call_process_and_store_dataset(file_positions, file_marine, dataset_name, us
                                      max_gap_minutes)
 
 
+def call_append_to_dataset(file_positions, file_marine, dataset_id, user_id, interpolation, algorithm,
+                           max_gap_minutes):
+    return append_to_dataset(file_positions, file_marine, dataset_id, user_id, interpolation, algorithm,
+                             max_gap_minutes)
+
+
 def call_clustering(clustering_params):
     return clustering(clustering_params)
 
 
+def call_suggest_eps(clustering_params):
+    return suggest_eps(clustering_params)
+
+
 def call_find_path(graph_params, clustering_params, cl_hash_id, gr_hash_id=None):
     return find_path(graph_params, clustering_params, cl_hash_id, gr_hash_id)
 
@@ -25,4 +35,5 @@ def load_clustering_params():
 def load_graph_params():
     return {'points_inside': True, 'distance_delta': 150.0, 'weight_func_degree': 2.0,
             'angle_of_vision': 30.0, 'weight_time_graph': 1.0, 'weight_course_graph': 0.1,
-            'search_algorithm': 'Dijkstra'}
+            'search_algorithm': 'Dijkstra', 'max_edge_length': 0.0, 'edges_per_sector': 0, 'sectors_count': 3,
+            'prune_two_hop': False}
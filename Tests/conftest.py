@@ -0,0 +1,76 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask
+from sqlalchemy.engine import Engine
+from werkzeug.datastructures import FileStorage
+
+# Модули проекта импортируются от корня репозитория, как в app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DataMovements.model import db, User, install_sqlite_pragmas  # noqa: E402
+
+# Те же прагмы, что у приложения: без foreign_keys каскадное удаление в SQLite не работает
+install_sqlite_pragmas(Engine)
+
+
+def _to_file(df):
+    return FileStorage(stream=io.BytesIO(df.to_csv(index=False, sep=';', decimal=',').encode()), filename='data.csv')
+
+
+def _source_files(n_points, seed, lat_shift=0.0):
+    """
+    Позиции вокруг четырех центров с курсами 0, 90, 180 и 270 градусов. lat_shift сдвигает центры,
+    чтобы дозапись меняла среднее и разброс признаков датасета.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, 4, n_points)
+    df_data = pd.DataFrame({
+        'id_marine': rng.integers(1, 50, n_points),
+        'lat': 60 + lat_shift + centers * 0.1 + rng.normal(0, 0.01, n_points),
+        'lon': 30 + centers * 0.1 + rng.normal(0, 0.01, n_points),
+        'speed': rng.uniform(5, 10, n_points),
+        'course': (centers * 90 + rng.normal(0, 5, n_points)) % 360,
+        'date_add': '2024-01-01 00:00:00',
+        'age': np.arange(n_points)
+    })
+    df_marine = pd.DataFrame({'id_marine': range(1, 50), 'port': 1, 'length': 100})
+    return _to_file(df_data), _to_file(df_marine)
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """
+    Приложение с пустой БД SQLite во временном каталоге. Кэш снимков и журнал запусков
+    пишутся по относительным путям ./DB/..., поэтому тест работает из того же каталога.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('DB')
+    test_app = Flask(__name__)
+    test_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_path, 'DB', 'test.db')
+    db.init_app(test_app)
+    with test_app.app_context():
+        db.create_all()
+        yield test_app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def user(app):
+    test_user = User(username='test', password_hash='test')
+    db.session.add(test_user)
+    db.session.commit()
+    return test_user
+
+
+@pytest.fixture
+def source_files():
+    """
+    Файлы позиций и судов, как их загружает пользователь: source_files(n_points, seed, lat_shift).
+    """
+    return _source_files
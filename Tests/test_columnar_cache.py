@@ -0,0 +1,19 @@
+from DataMovements import columnar_cache
+from DataMovements.data_movements import process_and_store_dataset, load_positions_cleaned
+from DataMovements.model import db, Datasets, PositionsCleaned
+
+
+def test_dataset_is_stored_when_snapshot_cannot_be_written(app, user, source_files, tmp_path, monkeypatch):
+    # Каталог кэша не создать: на его месте обычный файл
+    (tmp_path / 'not_a_directory').write_text('')
+    monkeypatch.setattr(columnar_cache, 'CACHE_DIR', str(tmp_path / 'not_a_directory' / 'cache'))
+
+    success, message = process_and_store_dataset(*source_files(500, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+    dataset = db.session.query(Datasets).filter_by(dataset_name='dataset').one()
+    positions_count = db.session.query(PositionsCleaned).filter_by(dataset_id=dataset.id).count()
+
+    # Без снимка позиции читаются из БД
+    df = load_positions_cleaned(dataset.id)
+    assert len(df) == positions_count > 0
+    assert list(df.columns) == ['position_id', 'lat', 'lon', 'speed', 'course']
@@ -0,0 +1,115 @@
+import math
+
+import networkx
+import numpy as np
+import pytest
+
+from FindPath.contraction_hierarchy import build_contraction_hierarchy, ContractionHierarchy
+from FindPath.find_path import GraphBuilder
+
+
+def random_digraph(nodes_count, edge_probability, seed):
+    """
+    Случайный взвешенный орграф с целыми весами (много равных по длине путей) и изолированной вершиной.
+    """
+    rng = np.random.default_rng(seed)
+    graph = networkx.gnp_random_graph(nodes_count, edge_probability, seed=seed, directed=True)
+    for u, w in graph.edges:
+        graph[u][w]['weight'] = float(rng.integers(1, 10))
+    graph.add_node(nodes_count)
+    return graph
+
+
+def build_hierarchy(graph):
+    # Идентификаторы вершин в БД не совпадают с позициями вершин в иерархии
+    vertex_ids = np.arange(len(graph)) * 10 + 1000
+    edges = np.array([(u, w, weight) for u, w, weight in graph.edges(data='weight')]).reshape(-1, 3)
+    arrays = build_contraction_hierarchy(vertex_ids, edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64),
+                                         edges[:, 2])
+    return ContractionHierarchy(arrays), vertex_ids
+
+
+def path_weight(graph, path):
+    return sum(graph[u][w]['weight'] for u, w in zip(path, path[1:]))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_shortest_path_matches_networkx(seed):
+    graph = random_digraph(40, 0.08, seed)
+    hierarchy, vertex_ids = build_hierarchy(graph)
+    node_of_vertex = {vertex_id: node for node, vertex_id in enumerate(vertex_ids.tolist())}
+    lengths = dict(networkx.all_pairs_dijkstra_path_length(graph))
+
+    disconnected_pairs = 0
+    for source in graph:
+        for target in graph:
+            weight, vertex_path = hierarchy.shortest_path({source: 0.0}, {target: 0.0})
+            expected = lengths[source].get(target)
+            if expected is None:
+                disconnected_pairs += 1
+                assert weight == math.inf and vertex_path is None
+                continue
+            path = [node_of_vertex[vertex_id] for vertex_id in vertex_path]
+            assert weight == pytest.approx(expected)
+            assert path[0] == source and path[-1] == target
+            # Развернутые shortcuts дают путь по ребрам исходного графа той же длины
+            assert path_weight(graph, path) == pytest.approx(expected)
+    assert disconnected_pairs > 0
+
+
+def test_same_source_and_target():
+    graph = random_digraph(20, 0.2, 7)
+    hierarchy, vertex_ids = build_hierarchy(graph)
+    for node in graph:
+        assert hierarchy.shortest_path({node: 0.0}, {node: 0.0}) == (0.0, [int(vertex_ids[node])])
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_several_sources_and_targets(seed):
+    """
+    Начальные расстояния sources и targets - ребра точек запроса, которых нет в иерархии.
+    """
+    graph = random_digraph(40, 0.08, seed)
+    hierarchy, vertex_ids = build_hierarchy(graph)
+    rng = np.random.default_rng(seed)
+    for _ in range(20):
+        sources = {int(node): float(rng.integers(0, 5)) for node in rng.choice(len(graph), 3, replace=False)}
+        targets = {int(node): float(rng.integers(0, 5)) for node in rng.choice(len(graph), 3, replace=False)}
+        query_graph = graph.copy()
+        for node, weight in sources.items():
+            query_graph.add_edge('start', node, weight=weight)
+        for node, weight in targets.items():
+            query_graph.add_edge(node, 'end', weight=weight)
+
+        weight, vertex_path = hierarchy.shortest_path(sources, targets)
+        try:
+            expected = networkx.dijkstra_path_length(query_graph, 'start', 'end')
+        except networkx.NetworkXNoPath:
+            assert weight == math.inf and vertex_path is None
+            continue
+        assert weight == pytest.approx(expected)
+        path = [int(np.searchsorted(vertex_ids, vertex_id)) for vertex_id in vertex_path]
+        assert weight == pytest.approx(sources[path[0]] + path_weight(graph, path) + targets[path[-1]])
+
+
+@pytest.mark.parametrize('direct_weight, expected_path', [(2.0, ['start', 'end']),
+                                                          (10.0, ['start', 0, 1, 2, 3, 'end'])])
+def test_hierarchy_search_with_direct_edge(direct_weight, expected_path):
+    """
+    Точка отправления не входит в общий граф, а ребро в точку прибытия начинается прямо в ней.
+    """
+    graph = networkx.DiGraph()
+    graph.add_weighted_edges_from([(0, 1, 1.0), (1, 2, 1.0), (2, 3, 1.0)])
+    hierarchy, vertex_ids = build_hierarchy(graph)
+    builder = GraphBuilder.__new__(GraphBuilder)
+    builder.graph = graph
+    builder.hierarchy = hierarchy
+    builder.hierarchy_nodes = {int(vertex_id): node for node, vertex_id in enumerate(vertex_ids.tolist())}
+    for node, vertex_id in enumerate(vertex_ids.tolist()):
+        graph.nodes[node]['vertex_id'] = vertex_id
+
+    start_edges = [{'u': 'start', 'v': 0, 'weight': 1.0}]
+    end_edges = [{'u': 3, 'v': 'end', 'weight': 1.0}, {'u': 'start', 'v': 'end', 'weight': direct_weight}]
+    path = builder._find_path_with_hierarchy('start', 'start', 'end', 'end', start_edges, end_edges)
+
+    assert path == expected_path
@@ -0,0 +1,75 @@
+import math
+
+import networkx
+import numpy as np
+import pytest
+
+from FindPath.find_path import prune_dominated_edges, _sparsify_candidates
+
+
+def random_weighted_digraph(nodes_count, edge_probability, seed):
+    """
+    Случайный орграф с малыми целыми весами: много равных по длине обходов и ребра нулевого веса.
+    """
+    rng = np.random.default_rng(seed)
+    graph = networkx.gnp_random_graph(nodes_count, edge_probability, seed=seed, directed=True)
+    for u, w in graph.edges:
+        graph[u][w]['weight'] = float(rng.integers(0, 4))
+    return graph
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_pruning_keeps_shortest_path_lengths(seed):
+    graph = random_weighted_digraph(30, 0.2, seed)
+    lengths = dict(networkx.all_pairs_dijkstra_path_length(graph))
+
+    removed = prune_dominated_edges(graph)
+
+    assert removed > 0
+    assert dict(networkx.all_pairs_dijkstra_path_length(graph)) == lengths
+
+
+def test_pruning_ties_and_zero_weights():
+    graph = networkx.DiGraph()
+    # Обход 0->1->2 той же длины, что и ребро 0->2: ребро лишнее
+    graph.add_weighted_edges_from([(0, 1, 1.0), (1, 2, 1.0), (0, 2, 2.0)])
+    # Равные ребра 3->4 и 3->5 с нулевым циклом 4<->5: каждое заменимо другим, но удалять оба нельзя
+    graph.add_weighted_edges_from([(3, 4, 1.0), (3, 5, 1.0), (4, 5, 0.0), (5, 4, 0.0)])
+    lengths = dict(networkx.all_pairs_dijkstra_path_length(graph))
+
+    prune_dominated_edges(graph)
+
+    assert not graph.has_edge(0, 2)
+    assert dict(networkx.all_pairs_dijkstra_path_length(graph)) == lengths
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sparsify_keeps_nearest_in_each_sector(seed):
+    rng = np.random.default_rng(seed)
+    graph_params = {'angle_of_vision': 90.0, 'max_edge_length': 80.0, 'edges_per_sector': 2, 'sectors_count': 3}
+    angle_left_rad = 0.5
+    candidates = np.arange(50)
+    angles = angle_left_rad + rng.uniform(0, math.radians(90), 50)
+    distances = rng.uniform(1, 100, 50)
+
+    kept, kept_angles, kept_distances = _sparsify_candidates(candidates, angles, distances, angle_left_rad,
+                                                             graph_params)
+
+    sector_size = math.radians(90) / 3
+    sectors = np.clip(((angles - angle_left_rad) // sector_size).astype(int), 0, 2)
+    expected = []
+    for sector in range(3):
+        in_sector = candidates[(sectors == sector) & (distances <= 80.0)]
+        expected.extend(in_sector[np.argsort(distances[in_sector])][:2].tolist())
+    assert kept.tolist() == sorted(expected)
+    assert np.array_equal(kept_angles, angles[kept]) and np.array_equal(kept_distances, distances[kept])
+
+
+def test_sparsify_defaults_keep_all_candidates():
+    candidates = np.arange(5)
+    angles = np.linspace(0, 1, 5)
+    distances = np.linspace(10, 1000, 5)
+
+    kept, _, _ = _sparsify_candidates(candidates, angles, distances, 0.0, {'angle_of_vision': 60.0})
+
+    assert kept.tolist() == candidates.tolist()
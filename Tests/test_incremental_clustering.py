@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import networkx
+import numpy as np
+import pandas as pd
+import shapely
+from sklearn.cluster import DBSCAN
+
+from Clustering.clustering import run_dbscan, append_to_dataset, build_features
+from Clustering.neighbor_index import scale_features
+from DataMovements.data_movements import process_and_store_dataset, load_positions_cleaned, load_cluster_labels, \
+    store_graph, approve_graph, check_graph, store_avg_values
+from DataMovements.model import db, Hashes, Graphs, ApprovedGraphs, GraphHierarchies, Clusters, ClAverageValues
+
+CLUSTERING_PARAMS = {'weight_distance': '3.5', 'weight_speed': '1', 'weight_course': '4', 'eps': '0.4',
+                     'min_samples': '10', 'metric_degree': '2', 'dataset_id': 1}
+
+
+def assert_same_clustering(labels, expected_labels, core_mask):
+    """
+    Метки совпадают с точностью до перенумерации: одинаковый шум и одинаковое разбиение ядер.
+    Пограничная точка у DBSCAN может достаться любому из соседних кластеров, поэтому не сравнивается.
+    """
+    np.testing.assert_array_equal(labels == -1, expected_labels == -1)
+    pairs = set(zip(labels[core_mask], expected_labels[core_mask]))
+    assert len(pairs) == len(set(labels[core_mask])) == len(set(expected_labels[core_mask]))
+
+
+def test_two_appends_match_dbscan_in_original_scale(app, user, source_files):
+    success, message = process_and_store_dataset(*source_files(3000, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+    cl_hash_id, _, _ = run_dbscan(dict(CLUSTERING_PARAMS))
+    feature_scaler = db.session.get(Hashes, cl_hash_id).feature_scaler
+
+    for seed, lat_shift in [(2, 0.3), (3, 0.6)]:
+        success, message = append_to_dataset(*source_files(1500, seed, lat_shift), 1, user.id, None, 'linear', 30)
+        assert success, message
+
+    db.session.expire_all()
+    # Масштаб кластеризации не меняется при дозаписи
+    assert db.session.get(Hashes, cl_hash_id).feature_scaler == feature_scaler
+
+    positions = load_positions_cleaned(1)
+    labels = positions[['position_id']].merge(load_cluster_labels(cl_hash_id), on='position_id', how='left')
+    assert labels['cluster'].notna().all()
+
+    X, weights, _ = build_features(positions.copy(), CLUSTERING_PARAMS, feature_scaler)
+    metric_degree = float(CLUSTERING_PARAMS['metric_degree'])
+    dbscan = DBSCAN(eps=float(CLUSTERING_PARAMS['eps']), min_samples=int(CLUSTERING_PARAMS['min_samples']),
+                    metric='minkowski', p=metric_degree).fit(scale_features(X, weights, metric_degree))
+    core_mask = np.zeros(len(positions), dtype=bool)
+    core_mask[dbscan.core_sample_indices_] = True
+
+    assert_same_clustering(labels['cluster'].to_numpy(dtype=np.int64), dbscan.labels_, core_mask)
+
+
+def graph_renderer(cl_hash_id, distance_delta):
+    """
+    Параметры графа и пересчет координат изображения в географические - все, что store_graph берет у карты.
+    """
+    graph_params = {'points_inside': True, 'distance_delta': distance_delta, 'angle_of_vision': 30.0,
+                    'dataset_id': 1, 'cl_hash_id': cl_hash_id, 'hull_type': 'convex_hull',
+                    'weight_time_graph': 1.0, 'weight_course_graph': 1.0, 'weight_func_degree': 2.0,
+                    'search_algorithm': 'Dijkstra'}
+    return SimpleNamespace(graph_params=graph_params, lon_lat_from_img_coords=lambda x, y: (x / 100, y / 100))
+
+
+def small_graph():
+    graph = networkx.DiGraph()
+    points = [shapely.Point(3000 + i, 6000 + i) for i in range(3)]
+    for u, v in zip(points, points[1:]):
+        graph.add_edge(u, v, weight=1.0, distance=1.0, speed=10.0, angle_deviation=0.0, cluster_num=0)
+    return graph
+
+
+def test_append_keeps_approved_graphs_until_rebuild(app, user, source_files):
+    success, message = process_and_store_dataset(*source_files(3000, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+    cl_hash_id, _, _ = run_dbscan(dict(CLUSTERING_PARAMS))
+    approved_renderer = graph_renderer(cl_hash_id, 1000.0)
+    approved_id = store_graph(small_graph(), 1, cl_hash_id, approved_renderer)
+    assert approve_graph(approved_id)
+    other_id = store_graph(small_graph(), 1, cl_hash_id, graph_renderer(cl_hash_id, 2000.0))
+
+    success, message = append_to_dataset(*source_files(1500, 2, 0.3), 1, user.id, None, 'linear', 30)
+    assert success, message
+    assert f'ID: {approved_id}' in message
+    db.session.expire_all()
+
+    # Неутвержденный граф удален, утвержденный продолжает обслуживать беспилотников до перестроения
+    assert db.session.get(Graphs, other_id) is None
+    assert db.session.get(Graphs, approved_id).needs_rebuild
+    assert db.session.get(ApprovedGraphs, approved_id) is not None
+    assert db.session.get(GraphHierarchies, approved_id) is not None
+    assert check_graph(approved_renderer.graph_params, approved_renderer) == (None, None, None)
+
+    # Перестроенный граф заменяет прежний и получает его утверждение
+    rebuilt_id = store_graph(small_graph(), 1, cl_hash_id, approved_renderer)
+    db.session.expire_all()
+    assert db.session.query(Graphs).count() == 1
+    assert not db.session.get(Graphs, rebuilt_id).needs_rebuild
+    assert db.session.get(ApprovedGraphs, rebuilt_id) is not None
+    assert db.session.get(GraphHierarchies, rebuilt_id) is not None
+
+
+def test_avg_values_without_speeds(app, user, source_files):
+    success, message = process_and_store_dataset(*source_files(1000, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+    cl_hash_id, _, _ = run_dbscan(dict(CLUSTERING_PARAMS))
+    cluster_nums = [num for num, in db.session.query(Clusters.cluster_num).filter(Clusters.hash_id == cl_hash_id,
+                                                                               Clusters.cluster_num >= 0)]
+    db.session.query(ClAverageValues).filter(ClAverageValues.hash_id == cl_hash_id).delete()
+
+    df = pd.DataFrame({'cluster': cluster_nums, 'speed': np.nan, 'course': 90.0})
+    store_avg_values(df, cl_hash_id)
+
+    rows = db.session.query(ClAverageValues).filter(ClAverageValues.hash_id == cl_hash_id).all()
+    assert len(rows) == len(cluster_nums)
+    assert all(row.average_speed is None and row.speed_median is None for row in rows)
+    assert all(row.average_course == 90.0 for row in rows)
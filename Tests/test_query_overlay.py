@@ -0,0 +1,101 @@
+import networkx
+import numpy as np
+import pytest
+
+from FindPath.query_overlay import QueryOverlay
+
+
+def random_geometric_digraph(nodes_count, edge_probability, seed):
+    """
+    Случайный орграф на точках плоскости: вес ребра не меньше расстояния между концами,
+    поэтому евклидово расстояние - допустимая эвристика для A*.
+    """
+    rng = np.random.default_rng(seed)
+    graph = networkx.gnp_random_graph(nodes_count, edge_probability, seed=seed, directed=True)
+    positions = {node: rng.uniform(0, 100, 2) for node in graph}
+    for u, w in graph.edges:
+        graph[u][w]['weight'] = float(np.linalg.norm(positions[u] - positions[w]) * rng.uniform(1, 2))
+    # Вершина без ребер: пары с ней недостижимы
+    graph.add_node(nodes_count)
+    positions[nodes_count] = rng.uniform(0, 100, 2)
+    return graph, positions
+
+
+def add_query_edges(overlay, query_graph, graph, positions, rng):
+    """
+    Точки отправления и прибытия с ребрами к нескольким вершинам и ребро запроса поверх ребра базового графа.
+    Те же ребра добавляются в копию графа query_graph для сравнения с networkx.
+    """
+    for point, position in (('start', rng.uniform(0, 100, 2)), ('end', rng.uniform(0, 100, 2))):
+        positions[point] = position
+        overlay.add_node(point)
+        query_graph.add_node(point)
+        for node in rng.choice(len(graph) - 1, 3, replace=False).tolist():
+            u, w = (point, node) if point == 'start' else (node, point)
+            weight = float(np.linalg.norm(positions[u] - positions[w]))
+            overlay.add_edge(u, w, weight=weight)
+            query_graph.add_edge(u, w, weight=weight)
+    u, w = list(graph.edges)[0]
+    overlay.add_edge(u, w, weight=graph[u][w]['weight'] * 10)
+    query_graph.add_edge(u, w, weight=graph[u][w]['weight'] * 10)
+
+
+def path_weight(graph, path):
+    return sum(graph[u][w]['weight'] for u, w in zip(path, path[1:]))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_overlay_search_matches_networkx(seed):
+    rng = np.random.default_rng(seed)
+    graph, positions = random_geometric_digraph(40, 0.08, seed)
+    base_nodes = dict(graph.nodes(data=True))
+    base_edges = networkx.to_dict_of_dicts(graph)
+    overlay = QueryOverlay(graph)
+    query_graph = graph.copy()
+    add_query_edges(overlay, query_graph, graph, positions, rng)
+
+    def heuristic(u, target):
+        return float(np.linalg.norm(positions[u] - positions[target]))
+
+    nodes = list(query_graph.nodes)
+    disconnected_pairs = 0
+    for source in nodes:
+        for target in nodes:
+            try:
+                expected = networkx.dijkstra_path_length(query_graph, source, target)
+            except networkx.NetworkXNoPath:
+                disconnected_pairs += 1
+                with pytest.raises(networkx.NetworkXNoPath):
+                    overlay.bidirectional_dijkstra(source, target)
+                with pytest.raises(networkx.NetworkXNoPath):
+                    overlay.astar_path(source, target, heuristic)
+                continue
+            for path in (overlay.bidirectional_dijkstra(source, target),
+                         overlay.astar_path(source, target, heuristic)):
+                assert path[0] == source and path[-1] == target
+                assert path_weight(query_graph, path) == pytest.approx(expected)
+    assert disconnected_pairs > 0
+
+    # Запросы не меняют общий базовый граф
+    assert dict(graph.nodes(data=True)) == base_nodes
+    assert networkx.to_dict_of_dicts(graph) == base_edges
+
+
+def test_same_source_and_target():
+    graph, positions = random_geometric_digraph(20, 0.2, 7)
+    overlay = QueryOverlay(graph)
+    for node in graph:
+        assert overlay.bidirectional_dijkstra(node, node) == [node]
+        assert overlay.astar_path(node, node, lambda u, target: 0) == [node]
+
+
+def test_unknown_node():
+    graph, _ = random_geometric_digraph(10, 0.3, 1)
+    overlay = QueryOverlay(graph)
+    overlay.add_edge('start', 0, weight=1.0)
+    assert overlay.bidirectional_dijkstra('start', 0) == ['start', 0]
+    with pytest.raises(networkx.NodeNotFound):
+        overlay.bidirectional_dijkstra('start', 'end')
+    with pytest.raises(networkx.NodeNotFound):
+        overlay.astar_path('end', 0, lambda u, target: 0)
+    assert 'start' not in graph
@@ -0,0 +1,36 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from Helpers.run_log import RunLog
+
+WRITERS = 4
+BATCHES = 200
+
+
+def write_batches(path, writer):
+    run_log = RunLog(path, max_bytes=4096, backups=1000)
+    for batch in range(BATCHES):
+        run_log._write_lines([json.dumps({'time': '', 'kind': 'test', 'writer': writer, 'batch': batch}) + '\n'])
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='воркеры gunicorn - процессы, созданные fork')
+def test_concurrent_rotation_keeps_every_record(tmp_path):
+    """
+    Несколько процессов пишут с частой ротацией: ни одна пачка не теряется в переименованных файлах.
+    """
+    path = str(tmp_path / 'runs.jsonl')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=write_batches, args=(path, writer)) for writer in range(WRITERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    records = RunLog(path, backups=1000).read(kind='test')
+    assert sorted((record['writer'], record['batch']) for record in records) == \
+        [(writer, batch) for writer in range(WRITERS) for batch in range(BATCHES)]
+    assert all(os.path.getsize(file_path) <= 4096 for file_path in tmp_path.glob('runs.jsonl*'))
@@ -0,0 +1,25 @@
+import pytest
+import shapely
+
+from DataMovements.data_movements import process_and_store_dataset, store_extent
+from DataMovements.model import db, Datasets, upgrade_schema
+
+
+def test_extent_geometry_backfilled_without_postgis(app, user, source_files, monkeypatch):
+    success, message = process_and_store_dataset(*source_files(200, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+    extent = [3000.0, 6000.0, 3500.0, 6400.0]
+    # Строка, сохраненная до появления extent_geom: границы есть, геометрии нет
+    db.session.query(Datasets).filter(Datasets.id == 1).update(
+        {'extent_min_x': extent[0], 'extent_min_y': extent[1], 'extent_max_x': extent[2], 'extent_max_y': extent[3],
+         'extent_geom': None})
+    db.session.commit()
+
+    upgrade_schema()
+    db.session.expire_all()
+
+    dataset = db.session.get(Datasets, 1)
+    assert shapely.equals(dataset.extent_geom, shapely.box(*extent))
+    # Тот же extent больше не записывается
+    monkeypatch.setattr(db.session, 'commit', lambda: pytest.fail('extent записан повторно'))
+    store_extent(extent, 1)
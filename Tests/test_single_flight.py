@@ -0,0 +1,66 @@
+import threading
+
+from Clustering import clustering
+from DataMovements.data_movements import process_and_store_dataset
+
+CLUSTERING_PARAMS = {'weight_distance': '3.5', 'weight_speed': '1', 'weight_course': '4', 'eps': '0.4',
+                     'min_samples': '10', 'metric_degree': '2', 'dataset_id': 1}
+
+
+def test_late_leader_takes_stored_clustering(app, user, source_files, monkeypatch):
+    """
+    Поток B проверяет БД до того, как поток A сохранил кластеризацию, а встает в очередь после того,
+    как A освободил ключ. B становится новым лидером и должен взять результат A из БД, а не считать заново.
+    """
+    success, message = process_and_store_dataset(*source_files(1000, 1), 'dataset', user.id, None, 'linear', 30)
+    assert success, message
+
+    both_checked = threading.Barrier(2, timeout=30)
+    first_finished = threading.Event()
+    first_checks = set()
+    check_clusters = clustering.check_clusters
+
+    def racing_check_clusters(params):
+        result = check_clusters(params)
+        if threading.current_thread().name not in first_checks:
+            first_checks.add(threading.current_thread().name)
+            both_checked.wait()
+            if threading.current_thread().name == 'late':
+                first_finished.wait(timeout=30)
+        return result
+
+    dbscan_runs = []
+    run_dbscan = clustering.run_dbscan
+
+    def counting_run_dbscan(params):
+        dbscan_runs.append(threading.current_thread().name)
+        return run_dbscan(params)
+
+    monkeypatch.setattr(clustering, 'check_clusters', racing_check_clusters)
+    monkeypatch.setattr(clustering, 'run_dbscan', counting_run_dbscan)
+
+    results, errors = {}, []
+
+    def request():
+        try:
+            with app.app_context():
+                cl_hash_id, df, dbscan_time = clustering.find_or_run_dbscan(dict(CLUSTERING_PARAMS))
+                results[threading.current_thread().name] = (cl_hash_id, len(df), dbscan_time)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            if threading.current_thread().name == 'first':
+                first_finished.set()
+
+    threads = [threading.Thread(target=request, name=name) for name in ('first', 'late')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    assert not errors
+    assert dbscan_runs == ['first']
+    assert results['late'][0] == results['first'][0]
+    assert results['late'][1] == results['first'][1]
+    assert results['late'][2] == 0
+
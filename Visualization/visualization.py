@@ -1,6 +1,7 @@
 import concurrent.futures
 import math
 import os
+import threading
 import time
 
 import mercantile
@@ -9,10 +10,29 @@ import pandas
 import shapely
 from cairo import ImageSurface, FORMAT_ARGB32, Context, LINE_JOIN_ROUND, LINE_CAP_ROUND, LinearGradient
 
-from DataMovements.data_movements import load_avg_values, load_polygon_geoms, store_polygon_geoms, store_extent
+from DataMovements.data_movements import load_avg_values, store_extent, load_derived, store_derived, \
+    geoms_to_arrays, arrays_to_geoms
 from Helpers.data_helpers import format_coordinate
+from Helpers.metrics import span
 from Helpers.vis_helpers import get_hours_minutes_str, generate_colors
 from Helpers.web_helpers import load_tile
+from Jobs.jobs import report_progress
+
+# Радиус сферы web-mercator, как в mercantile
+EARTH_RADIUS = 6378137.0
+# Сколько потоков строят оболочки кластеров
+HULL_WORKERS = os.cpu_count() or 1
+
+
+def write_png(surface, file_path):
+    """
+    Сохраняет изображение через временный файл: параллельные воркеры и веб-сервер
+    никогда не увидят недописанный png, при гонке просто побеждает последняя запись.
+    """
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        surface.write_to_png(f)
+    os.replace(tmp_path, file_path)
 
 
 class MapRenderer:
@@ -49,6 +69,8 @@ class MapRenderer:
         self.colors = generate_colors(self.cluster_count)
         self.context = None
         self.map_image = None
+        # Протяженность и время прохождения найденного маршрута - для журнала запусков
+        self.route_stats = None
 
         if (not os.path.exists(f'./static/images/clean/with_points_{self.ds_hash_value}.png') or
                 not os.path.exists(f'./static/images/clean/{self.ds_hash_value}.png')):
@@ -97,48 +119,73 @@ class MapRenderer:
             self.context.line_to(row[0] + line_length * math.cos(angle), row[1] + line_length * math.sin(angle))
             self.context.stroke()
 
-    def process_polygon(self, coords):
-        if len(coords) < 3:
-            return None, None
-        polygon_geom = shapely.Polygon(coords)
-        if self.clustering_params['hull_type'] == 'convex_hull':
-            polygon_geom2 = polygon_geom.convex_hull
-        elif self.clustering_params['hull_type'] == 'concave_hull':
-            polygon_geom2 = shapely.concave_hull(polygon_geom, ratio=0.5)
+    @span('hull')
+    def compute_hulls(self, multipoints):
+        hull_type = self.clustering_params['hull_type']
+        if hull_type == 'convex_hull':
+            def hull_func(geoms):
+                return shapely.convex_hull(geoms)
+        elif hull_type == 'concave_hull':
+            def hull_func(geoms):
+                return shapely.concave_hull(geoms, ratio=0.5)
         else:
-            polygon_geom2 = None
-
-        if isinstance(polygon_geom2, shapely.Polygon):
-            a, b = polygon_geom2.exterior.coords.xy
-            bounds = tuple(zip(a, b))
-            buffer = shapely.Polygon(bounds).buffer(1e-9)
-            return bounds, buffer
-        return None, None
+            return np.full(len(multipoints), None, dtype=object)
+
+        # Векторные функции shapely отпускают GIL, поэтому кластеры считаются параллельно в потоках
+        chunks = np.array_split(multipoints, min(len(multipoints), HULL_WORKERS))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            return np.concatenate(list(executor.map(hull_func, chunks)))
+
+    def build_polygons(self, skip_clusters):
+        """
+        Оболочки кластеров за один проход: точки сортируются по кластеру один раз
+        и передаются в shapely массивом MultiPoint.
+        """
+        clusters = self.df_points_on_image['cluster'].to_numpy(dtype=np.int64)
+        keep = (clusters >= 0) & ~np.isin(clusters, list(skip_clusters))
+        order = np.argsort(clusters[keep], kind='stable')
+        sorted_clusters = clusters[keep][order]
+        xy = self.df_points_on_image[['x', 'y']].to_numpy(dtype=float)[keep][order]
+
+        cluster_nums, inverse, counts = np.unique(sorted_clusters, return_inverse=True, return_counts=True)
+        # Для оболочки нужно минимум три точки
+        enough_points = counts[inverse] >= 3
+        cluster_nums = cluster_nums[counts >= 3]
+        if len(cluster_nums) == 0:
+            return {}
+        _, indices = np.unique(inverse[enough_points], return_inverse=True)
+        multipoints = shapely.multipoints(xy[enough_points], indices=indices)
+        hulls = self.compute_hulls(multipoints)
+        return {int(cluster): hull for cluster, hull in zip(cluster_nums, hulls) if isinstance(hull, shapely.Polygon)}
 
     def show_polygons(self):
-        polygon_geoms = load_polygon_geoms(self.cl_hash_id)
-        if not polygon_geoms:
-            polygon_geoms = {}
-            for cluster in range(self.cluster_count):
-                polygon = self.df_points_on_image.where(self.df_points_on_image['cluster'] == cluster).dropna(how='any')
-                coords = list(zip(polygon['x'].values.tolist(), polygon['y'].values.tolist()))
-                if len(coords) < 3:
-                    continue
-                bounds, buffer = self.process_polygon(coords)
-                if bounds is not None:
-                    self.polygon_bounds[cluster] = bounds
-                    self.polygon_buffers[cluster] = buffer
-                    # Сохраняем исходные координаты (до оболочки)
-                    polygon_geom = shapely.Polygon(coords)
-                    a1, b1 = polygon_geom.exterior.coords.xy
-                    polygon_geoms[cluster] = list(zip(a1, b1))
-            store_polygon_geoms(polygon_geoms, self.cl_hash_id)
+        hull_type = self.clustering_params['hull_type']
+        # Оболочки и буферы хранятся в географических координатах, они не зависят от границ карты
+        stored_hulls = load_derived(self.cl_hash_id, hull_type, 'hulls')
+        stored_buffers = load_derived(self.cl_hash_id, hull_type, 'buffers')
+        if stored_hulls is not None and stored_buffers is not None:
+            clusters, hulls = arrays_to_geoms(stored_hulls)
+            _, buffers = arrays_to_geoms(stored_buffers)
+            hulls, buffers = self.from_geographic(hulls), self.from_geographic(buffers)
         else:
-            for cluster, coords in polygon_geoms.items():
-                bounds, buffer = self.process_polygon(coords)
-                if bounds is not None:
-                    self.polygon_bounds[cluster] = bounds
-                    self.polygon_buffers[cluster] = buffer
+            clusters = np.array([], dtype=np.int64)
+            hulls = buffers = np.array([], dtype=object)
+
+        # После дозаписи датасета сохранены не все оболочки, достраиваем только недостающие
+        new_polygons = self.build_polygons(skip_clusters=set(clusters.tolist()))
+        if new_polygons or stored_hulls is None:
+            new_hulls = np.array(list(new_polygons.values()), dtype=object)
+            clusters = np.concatenate([clusters, np.fromiter(new_polygons.keys(), dtype=np.int64)])
+            hulls = np.concatenate([hulls, new_hulls])
+            buffers = np.concatenate([buffers, shapely.buffer(new_hulls, 1e-9)])
+            store_derived(self.cl_hash_id, hull_type, 'hulls', geoms_to_arrays(clusters, self.to_geographic(hulls)))
+            store_derived(self.cl_hash_id, hull_type, 'buffers',
+                          geoms_to_arrays(clusters, self.to_geographic(buffers)))
+
+        for cluster, hull, buffer in zip(clusters.tolist(), hulls, buffers):
+            a, b = hull.exterior.coords.xy
+            self.polygon_bounds[cluster] = tuple(zip(a, b))
+            self.polygon_buffers[cluster] = buffer
 
         for key, polygon_bound in self.polygon_bounds.items():
             red = self.colors[key][0]
@@ -154,19 +201,46 @@ class MapRenderer:
             self.context.set_source_rgba(red, green, blue, 1)
             self.context.stroke()
 
+    @span('intersection')
+    def compute_intersections(self):
+        """
+        Пары пересекающихся оболочек находятся одним запросом к STRtree,
+        пересечения считаются векторно по всем парам сразу.
+        """
+        keys = list(self.polygon_bounds.keys())
+        polygons = np.array([shapely.Polygon(bounds) for bounds in self.polygon_bounds.values()], dtype=object)
+        if len(polygons) < 2:
+            return {}
+        tree = shapely.STRtree(polygons)
+        left, right = tree.query(polygons, predicate='intersects')
+        pairs = left < right
+        left, right = left[pairs], right[pairs]
+        order = np.lexsort((right, left))
+        left, right = left[order], right[order]
+        geoms = shapely.intersection(polygons[left], polygons[right])
+        return {(keys[i], keys[j]): geom for i, j, geom in zip(left, right, geoms)}
+
+    def to_geographic(self, geoms):
+        return shapely.transform(geoms, lambda xy: np.column_stack(self.lon_lat_from_img_coords(xy[:, 0], xy[:, 1])))
+
+    def from_geographic(self, geoms):
+        return shapely.transform(geoms, lambda xy: self.img_coords_from_lon_lat(xy[:, 0], xy[:, 1]))
+
     def show_intersections(self):
         # Ищем и отображаем пересечения полигонов
         if len(self.intersections) == 0 or len(self.intersection_bounds) == 0:
-            keys = list(self.polygon_bounds.keys())
-            for i in range(len(keys)):
-                key_i = keys[i]
-                for j in range(i + 1, len(keys)):
-                    key_j = keys[j]
-                    if shapely.intersects(shapely.Polygon(self.polygon_bounds[key_i]),
-                                          shapely.Polygon(self.polygon_bounds[key_j])):
-                        self.intersections[key_i, key_j] = (
-                            shapely.intersection(shapely.Polygon(self.polygon_bounds[key_i]),
-                                                 shapely.Polygon(self.polygon_bounds[key_j])))
+            hull_type = self.clustering_params['hull_type']
+            stored_intersections = load_derived(self.cl_hash_id, hull_type, 'intersections')
+            if stored_intersections is not None:
+                keys, geoms = arrays_to_geoms(stored_intersections)
+                self.intersections = {tuple(key): geom
+                                      for key, geom in zip(keys.reshape(-1, 2).tolist(), self.from_geographic(geoms))}
+            else:
+                # Пустой результат тоже сохраняется, чтобы не искать пересечения повторно
+                self.intersections = self.compute_intersections()
+                geoms = self.to_geographic(np.array(list(self.intersections.values()), dtype=object))
+                store_derived(self.cl_hash_id, hull_type, 'intersections',
+                              geoms_to_arrays(np.array(list(self.intersections.keys()), dtype=np.int64), geoms))
 
             for key, intersection in self.intersections.items():
                 if isinstance(intersection, shapely.Polygon):
@@ -195,52 +269,83 @@ class MapRenderer:
                 self.context.line_to(dot[0], dot[1])
             self.context.fill()
 
+    @staticmethod
+    def sample_boundary_points(bounds_list, distance_delta):
+        """
+        Точки на границах пересечений через каждые distance_delta, одним вызовом line_interpolate_point.
+        """
+        lines = [shapely.LineString(bounds) for bounds in bounds_list if len(bounds) > 1]
+        single_points = [shapely.Point(bounds) for bounds in bounds_list if len(bounds) == 1]
+        if not lines:
+            return single_points
+        lines = np.array(lines, dtype=object)
+        counts = np.ceil(shapely.length(lines) / distance_delta).astype(np.int64)
+        # Для каждой линии расстояния 0, delta, 2*delta, ... меньше ее длины
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        distances = (np.arange(counts.sum()) - starts) * distance_delta
+        boundary_points = shapely.line_interpolate_point(np.repeat(lines, counts), distances)
+        return list(boundary_points) + single_points
+
+    @staticmethod
+    def sample_grid_points(intersections, distance_delta):
+        """
+        Узлы общей сетки с шагом distance_delta внутри пересечений: для каждого полигона сетка
+        строится через np.meshgrid только по его границам и фильтруется shapely.contains_xy.
+        """
+        parts = shapely.get_parts(np.array(list(intersections), dtype=object))
+        polygons = parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+        if len(polygons) == 0:
+            return []
+        all_bounds = shapely.bounds(polygons)
+        # Начало сетки общее для всех пересечений, чтобы узлы перекрывающихся частей совпадали
+        x_origin, y_origin = all_bounds[:, 0].min(), all_bounds[:, 1].min()
+
+        cells = []
+        for polygon, (x_min, y_min, x_max, y_max) in zip(polygons, all_bounds):
+            # Номера узлов общей сетки, попадающих в границы полигона
+            i = np.arange(np.ceil((x_min - x_origin) / distance_delta),
+                          np.floor((x_max - x_origin) / distance_delta) + 1)
+            j = np.arange(np.ceil((y_min - y_origin) / distance_delta),
+                          np.floor((y_max - y_origin) / distance_delta) + 1)
+            grid_i, grid_j = np.meshgrid(i, j)
+            grid_i, grid_j = grid_i.ravel(), grid_j.ravel()
+            inside = shapely.contains_xy(polygon, x_origin + grid_i * distance_delta,
+                                         y_origin + grid_j * distance_delta)
+            cells.append(np.column_stack([grid_i[inside], grid_j[inside]]))
+        cells = np.unique(np.concatenate(cells), axis=0)
+        return list(shapely.points(x_origin + cells[:, 0] * distance_delta, y_origin + cells[:, 1] * distance_delta))
+
+    def load_or_sample_nodes(self, hull_type, kind, distance_delta, sample):
+        """
+        Узлы графа для (кластеризация, оболочка, шаг) берутся из кэша, иначе считаются sample()
+        и сохраняются в географических координатах.
+        """
+        stored_nodes = load_derived(self.cl_hash_id, hull_type, kind, distance_delta)
+        if stored_nodes is not None:
+            lon_lat = stored_nodes['lon_lat']
+            return list(shapely.points(self.img_coords_from_lon_lat(lon_lat[:, 0], lon_lat[:, 1])))
+
+        points = sample()
+        xy = shapely.get_coordinates(np.array(points, dtype=object))
+        lon, lat = self.lon_lat_from_img_coords(xy[:, 0], xy[:, 1])
+        store_derived(self.cl_hash_id, hull_type, kind, {'lon_lat': np.column_stack([lon, lat])}, distance_delta)
+        return points
+
     def show_intersection_points(self):
         # Расстояние между точками в пересечении
-        distance_delta = self.graph_params['distance_delta']
-        # Накидываем точки на границу пересечения полигонов
+        distance_delta = float(self.graph_params['distance_delta'])
         if len(self.intersection_points) == 0:
-            for key, intersection_bound in self.intersection_bounds.items():
-                if len(intersection_bound) > 1:
-                    distances = np.arange(0, shapely.LineString(intersection_bound).length, distance_delta)
-                    self.intersection_points.extend(
-                        [shapely.LineString(intersection_bound).interpolate(distance) for distance in
-                         distances])
-                else:
-                    self.intersection_points.append(shapely.Point(intersection_bound))
+            hull_type = self.clustering_params['hull_type']
+            # Накидываем точки на границу пересечения полигонов
+            self.intersection_points.extend(self.load_or_sample_nodes(
+                hull_type, 'boundary_nodes', distance_delta,
+                lambda: self.sample_boundary_points(list(self.intersection_bounds.values()), distance_delta)))
 
             if self.graph_params['points_inside']:
                 try:
-                    def flatten_geometrycollection(geom):
-                        if isinstance(geom, (shapely.GeometryCollection, shapely.MultiPolygon, shapely.MultiPoint)):
-                            flattened_list = []
-                            for g in geom.geoms:
-                                flattened_list.extend(flatten_geometrycollection(g))
-                            return flattened_list
-                        else:
-                            return [geom]
-
-                    gc = shapely.GeometryCollection(list(self.intersections.values()))
-                    flat_gc = flatten_geometrycollection(gc)
-                    all_intersections = shapely.GeometryCollection(flat_gc)
-
-                    x_min, y_min, x_max, y_max = all_intersections.bounds
-                    current_y = y_min - distance_delta
-                    calculated_points = []
-                    while current_y <= y_max:
-                        current_y += distance_delta
-                        current_x = x_min - distance_delta
-                        while current_x <= x_max:
-                            current_x += distance_delta
-                            calculated_points.append(shapely.Point(current_x, current_y))
-                    calculated_multi_point = shapely.MultiPoint(calculated_points)
-                    actual_multi_point = shapely.MultiPoint(
-                        [point for point in set(flatten_geometrycollection(
-                            shapely.GeometryCollection(
-                                [i.intersection(calculated_multi_point) for i in all_intersections.geoms]))) if
-                         not point.is_empty])
-                    actual_multi_point = actual_multi_point.geoms
-                    self.intersection_points.extend(actual_multi_point)
+                    self.intersection_points.extend(self.load_or_sample_nodes(
+                        hull_type, 'inner_nodes', distance_delta,
+                        lambda: self.sample_grid_points(self.intersections.values(), distance_delta)))
                 except Exception as exc:
                     print(f'При добавлении точек внутрь пересечений что-то пошло не так:\n{str(exc)}')
 
@@ -287,9 +392,7 @@ class MapRenderer:
     def save_clustered_image(self, save_mode):
         file_path = (f'./static/images/clustered/'
                      f'{str(save_mode)}_{str(time.time_ns())}.png')
-        with open(file_path, 'wb') as f:
-            self.map_image.write_to_png(f)
-        f.close()
+        write_png(self.map_image, file_path)
         return file_path
 
     def create_empty_map(self):
@@ -329,6 +432,7 @@ class MapRenderer:
                     i += 1
                     if i % 100 == 0 or i == len_tiles:
                         print(f'Загружено тайлов: {i}')
+                    report_progress('tiles', i, len_tiles)
                     img, x, y = future.result()
                     ctx.set_source_surface(img, x, y)
                     ctx.paint()
@@ -390,9 +494,7 @@ class MapRenderer:
 
         # Сохраняем результат
         if self.create_new_empty_map:
-            with open(f'./static/images/clean/{self.ds_hash_value}.png', 'wb') as f:
-                self.map_image.write_to_png(f)
-                f.close()
+            write_png(self.map_image, f'./static/images/clean/{self.ds_hash_value}.png')
 
         self.context = Context(self.map_image)
 
@@ -412,8 +514,7 @@ class MapRenderer:
                 context.line_to(row[0] + line_length * math.cos(angle), row[1] + line_length * math.sin(angle))
                 context.stroke()
             # Сохраняем результат
-            with open(f'./static/images/clean/with_points_{self.ds_hash_value}.png', 'wb') as f:
-                self.map_image.write_to_png(f)
+            write_png(self.map_image, f'./static/images/clean/with_points_{self.ds_hash_value}.png')
 
         self.map_image = ImageSurface.create_from_png(f'./static/images/clean/{self.ds_hash_value}.png')
         self.context = Context(self.map_image)
@@ -426,6 +527,17 @@ class MapRenderer:
         y = (xy[1] - self.left_top[1]) * self.ky
         return x, y
 
+    def img_coords_from_lon_lat(self, lon, lat):
+        # То же, что mercantile.xy, но для массивов
+        web_x = EARTH_RADIUS * np.radians(lon)
+        web_y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+        return np.column_stack([(web_x - self.left_top[0]) * self.kx, (web_y - self.left_top[1]) * self.ky])
+
+    def lon_lat_from_img_coords(self, x, y):
+        web_x = x / self.kx + self.left_top[0]
+        web_y = y / self.ky + self.left_top[1]
+        return np.degrees(web_x / EARTH_RADIUS), np.degrees(np.arctan(np.sinh(web_y / EARTH_RADIUS)))
+
     def get_lat_lon_from_img_coords(self, x, y):
         web_x = x / self.kx + self.left_top[0]
         web_y = y / self.ky + self.left_top[1]
@@ -445,6 +557,7 @@ class MapRenderer:
         self.context.arc(end_point.x, end_point.y, 6, 0 * math.pi / 180, 360 * math.pi / 180)
         self.context.fill()
 
+    @span('render')
     def show_graph(self, graph, paths, build_graph_time, find_path_time, create_new_graph, drone_mode=False):
         result_graph = {}
         for path in paths:
@@ -508,6 +621,8 @@ class MapRenderer:
             distance_of_section.append(last_edge_data['distance'])
 
             angle_deviation_mean = angle_deviation_sum / (len(path) - 1)
+            self.route_stats = {'length_miles': round(distance, 3), 'duration_hours': round(time_sum, 2),
+                                'sections': len(path) - 1}
 
             result_graph['Протяженность маршрута'] = f'{str(round(distance, 3))} (м. мили)'
             result_graph['Примерное время прохождения маршрута'] = f'{get_hours_minutes_str(time_sum)}'
@@ -539,6 +654,7 @@ class MapRenderer:
         return result_graph
 
     # Возможно стоит убрать мелкие кластеры...
+    @span('render')
     def create_clustered_map(self, dbscan_time):
         result_clustering = {}
         img_paths = []
@@ -557,14 +673,6 @@ class MapRenderer:
 
             img_paths.append(self.save_clustered_image(save_mode))
 
-        log = (f'Параметры для DBSCAN: {str(self.clustering_params)}\n'
-               f'Всего кластеров: {str(self.cluster_count)}\n'
-               f'Доля шума: {str(self.noise_count)} / {str(self.total_count)}\n'
-               f'Время выполнения DBSCAN: {str(dbscan_time)} (секунды)\n\n')
-
-        with open('./static/logs/DBSCAN_log.txt', 'a') as log_file:
-            log_file.write(log)
-
         result_clustering['Всего кластеров'] = f'{str(self.cluster_count)}'
         result_clustering['Доля шума'] = f'{str(self.noise_count)} / {str(self.total_count)}'
         result_clustering['Время выполнения DBSCAN'] = f'{str(dbscan_time)} (секунды)'
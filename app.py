@@ -1,44 +1,102 @@
+import io
+import json
 import os
 import time
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, g
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from sqlalchemy import event
 from sqlalchemy.engine import Engine
-
-from DataMovements.data_movements import fetch_datasets_for_user, delete_dataset_by_id, find_approved_graphs
-from DataMovements.model import db, User, Datasets
+from werkzeug.datastructures import FileStorage
+
+from DataMovements.data_movements import fetch_datasets_for_user, delete_dataset_by_id, find_approved_graphs, \
+    approve_graph, backfill_hull_geometries
+from DataMovements.model import db, User, Datasets, upgrade_schema, READ_ONLY_BIND, install_sqlite_pragmas, \
+    use_read_only_db, create_spatial_extension
+from Helpers.metrics import instrument_engine, request_duration, render_prometheus, start_request_profile, \
+    finish_request_profile
+from Helpers.run_log import run_log
 from Helpers.web_helpers import create_success_response, create_error_response
-from Main.main import (call_process_and_store_dataset, call_clustering,
+from Jobs.jobs import submit_job, get_job, wait_for_job_update
+from Main.main import (call_process_and_store_dataset, call_append_to_dataset, call_clustering, call_suggest_eps,
                        load_clustering_params, call_find_path, load_graph_params)
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=1;")
-    cursor.close()
+install_sqlite_pragmas(Engine)
+
 
+# Время каждого SQL-запроса попадает в гистограмму этапа db_io (/metrics)
+instrument_engine(Engine)
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'FeAF<j,f322AfHnE_VfCnB#'
-# DB_USER = os.environ.get('DB_USER')
-# DB_PASSWORD = os.environ.get('DB_PASSWORD')
-# DB_NAME = os.environ.get('DB_NAME')
-# DB_HOST = os.environ.get('DB_HOST')
-# DB_PORT = os.environ.get('DB_PORT')
-# app.config['SQLALCHEMY_DATABASE_URI'] = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'DB', 'TheWay.db')
+# PostgreSQL + PostGIS включается переменной окружения DB_NAME (см. docker-compose.yml), иначе - файл SQLite
+DB_NAME = os.environ.get('DB_NAME')
+if DB_NAME:
+    DB_USER = os.environ.get('DB_USER')
+    DB_PASSWORD = os.environ.get('DB_PASSWORD')
+    DB_HOST = os.environ.get('DB_HOST', 'localhost')
+    DB_PORT = os.environ.get('DB_PORT', '5432')
+    database_uri = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    # Запросы беспилотников только читают БД: у каждого процесса-воркера свой пул подключений в режиме read-only
+    app.config['SQLALCHEMY_BINDS'] = {
+        READ_ONLY_BIND: {'url': database_uri, 'connect_args': {'options': '-c default_transaction_read_only=on'}}
+    }
+else:
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'DB', 'TheWay.db')
+    app.config['SQLALCHEMY_BINDS'] = {
+        READ_ONLY_BIND: 'sqlite:///file:' + os.path.join(basedir, 'DB', 'TheWay.db') + '?mode=ro&uri=true'
+    }
+# Пул на процесс: подключения одновременно держат потоки запросов и фоновые задачи
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 30}
+# Профилирование запросов cProfile: 'on' - по параметру ?profile=1, 'all' - каждый запрос, пусто - выключено
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '')
 db.init_app(app)
 with app.app_context():
+    create_spatial_extension()
     db.create_all()
+    upgrade_schema()
+    backfill_hull_geometries()
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    profile_mode = app.config['PROFILE_REQUESTS']
+    # Профиль по запросу нагружает сервер, а X-Profile-File раскрывает путь на нем - только для вошедших
+    g.profiler = start_request_profile(profile_mode == 'all', profile_mode == 'on' and
+                                       request.args.get('profile') == '1' and current_user.is_authenticated)
+
+
+@app.after_request
+def finish_request_timing(response):
+    if g.get('profiler') is not None:
+        profile_file = finish_request_profile(g.profiler, request.endpoint)
+        g.profiler = None
+        if current_user.is_authenticated:
+            response.headers['X-Profile-File'] = profile_file
+    if 'request_start' in g:
+        # Шаблон маршрута, а не сам URL: у /jobs/<job_id> одна серия, а не по серии на задачу
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_duration.observe(time.perf_counter() - g.request_start, endpoint, request.method,
+                                 str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # after_request не вызывается, если обработчик упал с исключением: профилировщик остановится здесь
+    if g.get('profiler') is not None:
+        finish_request_profile(g.profiler, request.endpoint)
+        g.profiler = None
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -93,20 +151,66 @@ def get_graph():
     if not (cl_hash_id and clustering_params):
         return jsonify({"error": "Сначала необходимо выполнить кластеризацию."}), 400
     parameters_for_graph['cl_hash_id'] = cl_hash_id
-    graph_data = call_find_path(parameters_for_graph, clustering_params, cl_hash_id)
-    return jsonify(graph_data)
+    job_id = submit_job(app, 'graph', current_user.id,
+                        call_find_path, parameters_for_graph, clustering_params, cl_hash_id)
+    return jsonify(job_id=job_id), 202
 
 
 @app.route('/post_clustering_parameters', methods=['POST'])
 @login_required
 def get_clusters():
-    start = time.time()
     parameters_for_clustering = request.get_json()
-    clusters_data = call_clustering(parameters_for_clustering)
-    session['cl_hash_id'] = clusters_data[3]
-    session['clustering_params'] = parameters_for_clustering
-    print('Общее время прогона кластеризации с отрисовкой:', round(time.time() - start, 2), 'сек.')
-    return jsonify(clusters_data)
+    job_id = submit_job(app, 'clustering', current_user.id, call_clustering, parameters_for_clustering,
+                        job_context={'clustering_params': parameters_for_clustering})
+    return jsonify(job_id=job_id), 202
+
+
+@app.route('/suggest_eps', methods=['POST'])
+@login_required
+def get_eps_suggestion():
+    parameters_for_clustering = request.get_json()
+    job_id = submit_job(app, 'eps_suggestion', current_user.id, call_suggest_eps, parameters_for_clustering)
+    return jsonify(job_id=job_id), 202
+
+
+def get_user_job(job_id):
+    job = get_job(job_id)
+    if not job or job.user_id != current_user.id:
+        return None
+    return job
+
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({"error": "Задача не найдена."}), 404
+    # Параметры кластеризации попадают в сессию только после успешного завершения задачи
+    if job.kind == 'clustering' and job.status == 'done':
+        session['cl_hash_id'] = job.result[3]
+        session['clustering_params'] = job.context['clustering_params']
+    return jsonify(job.to_dict(with_result=True))
+
+
+@app.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({"error": "Задача не найдена."}), 404
+
+    def stream():
+        version = None
+        while True:
+            version, job_dict = wait_for_job_update(job, version)
+            # Результат забирается через /jobs/<job_id>, чтобы обновить сессию
+            job_dict.pop('result', None)
+            yield f'data: {json.dumps(job_dict, ensure_ascii=False)}\n\n'
+            if job.is_finished:
+                break
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 def clean_session():
@@ -148,20 +252,26 @@ def upload_dataset():
     interpolation = request.form.get('interpolation')
     max_gap_minutes = request.form.get('max_gap_minutes')
     algorithm = request.form.get('interpolation_algorithm')
+    append_dataset_id = request.form.get('append_dataset_id') if request.form.get('append') else None
     user_id = current_user.id
 
     if not file_positions or not file_marine:
         return jsonify(success=False, message='Не выбраны оба файла!')
 
-    success, message = call_process_and_store_dataset(file_positions,
-                                                      file_marine,
-                                                      dataset_name,
-                                                      user_id,
-                                                      interpolation,
-                                                      algorithm,
-                                                      max_gap_minutes)
+    # Файлы запроса закрываются вместе с ним, поэтому фоновой задаче отдаем копии в памяти
+    file_positions = FileStorage(stream=io.BytesIO(file_positions.read()), filename=file_positions.filename)
+    file_marine = FileStorage(stream=io.BytesIO(file_marine.read()), filename=file_marine.filename)
+    if append_dataset_id:
+        # Дозапись: в датасет попадают только новые позиции, кластеризации обновляются инкрементально
+        job_id = submit_job(app, 'dataset', user_id, call_append_to_dataset,
+                            file_positions, file_marine, append_dataset_id, user_id, interpolation, algorithm,
+                            max_gap_minutes)
+    else:
+        job_id = submit_job(app, 'dataset', user_id, call_process_and_store_dataset,
+                            file_positions, file_marine, dataset_name, user_id, interpolation, algorithm,
+                            max_gap_minutes)
 
-    return jsonify(success=success, message=message)
+    return jsonify(success=True, job_id=job_id), 202
 
 
 @app.route('/delete_dataset', methods=['POST'])
@@ -195,8 +305,17 @@ def index():
                            )
 
 
+@app.cli.command('approve-graph')
+@click.argument('graph_id', type=int)
+def approve_graph_command(graph_id):
+    """Утверждает граф для беспилотников и строит его иерархию стягивания."""
+    if not approve_graph(graph_id):
+        raise click.ClickException(f'Не удалось утвердить граф ID: {graph_id}.')
+
+
 @app.route('/api/find_drone_path', methods=['POST'])
 def find_drone_path():
+    use_read_only_db()
     data = request.get_json()
     approved_graphs = find_approved_graphs(data['start_point'], data['end_point'])
     if approved_graphs:
@@ -219,5 +338,38 @@ def find_drone_path():
                                      'These points are not included in any approved area.')
 
 
+# Журнал запусков только после входа: в записях параметры запросов пользователей и координаты маршрутов
+@app.route('/run_log')
+@login_required
+def run_log_records():
+    # ?kind=path&since=2025-06-01T00:00&until=...&limit=100, время - в формате ISO
+    limit = request.args.get('limit', '1000')
+    # limit=0 вернул бы весь журнал, отрицательный - все записи, кроме первых
+    if not limit.isdigit() or int(limit) < 1:
+        return create_error_response(dict(request.args), 'limit must be a positive integer.')
+    records = run_log.read(request.args.get('kind'), request.args.get('since'), request.args.get('until'),
+                           int(limit))
+    return create_success_response(records)
+
+
+@app.route('/run_log/trend')
+@login_required
+def run_log_trend():
+    # ?kind=path&stage=total&freq=1h - время этапа по часам: количество, среднее, p50, p95, максимум
+    try:
+        trend = run_log.latency_trend(request.args.get('kind', 'path'), request.args.get('stage', 'total'),
+                                      request.args.get('freq', '1h'), request.args.get('since'),
+                                      request.args.get('until'))
+    except ValueError as exc:
+        return create_error_response(dict(request.args), str(exc))
+    return create_success_response(trend)
+
+
+# Без входа: Prometheus опрашивает endpoint без сессии, а в ответе только длительности этапов и запросов
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run()
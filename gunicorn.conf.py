@@ -0,0 +1,25 @@
+# Конфигурация gunicorn для обслуживания API беспилотников несколькими процессами:
+# gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# Фоновые задачи веб-интерфейса (загрузка датасетов, кластеризация, построение графа) хранятся
+# в памяти процесса, поэтому для интерфейса нужен один воркер; API беспилотников от воркеров не зависит
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+# Построение графа по запросу из интерфейса может идти несколько минут
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+# Приложение (create_all, upgrade_schema) инициализируется один раз в мастер-процессе
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Подключения к SQLite, открытые в мастер-процессе, нельзя использовать после fork:
+    # каждый воркер открывает собственные, в том числе только для чтения
+    from app import app
+    from DataMovements.model import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
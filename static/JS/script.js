@@ -28,6 +28,69 @@ function createImageLayer(options) {
 }
 
 
+/**
+ * Названия этапов фоновых задач для отображения прогресса.
+ */
+const jobStageNames = {
+    'tiles': 'Загрузка тайлов',
+    'graph_points': 'Обработка точек графа',
+    'dbscan': 'Кластеризация',
+    'neighbors': 'Поиск соседей',
+    'interpolation': 'Интерполяция',
+    'storing': 'Сохранение позиций',
+    'clustering': 'Обновление кластеризаций'
+};
+
+function formatJobProgress(progress) {
+    return Object.entries(progress || {}).map(([stage, value]) => {
+        const name = jobStageNames[stage] || stage;
+        return value.total ? `${name}: ${value.done} / ${value.total}` : `${name}: ${value.done}`;
+    }).join('<br>');
+}
+
+function showJobProgress(progress) {
+    const progressEl = document.getElementById('job-progress');
+    if (!progressEl) return;
+    progressEl.innerHTML = formatJobProgress(progress);
+    progressEl.style.display = progressEl.innerHTML ? 'block' : 'none';
+}
+
+/**
+ * Ожидает завершения фоновой задачи: прогресс приходит через SSE,
+ * результат забирается отдельным запросом. Если SSE недоступен - опрашиваем статус.
+ */
+function waitForJob(jobId, onProgress) {
+    return new Promise((resolve, reject) => {
+        const finish = (job) => job.status === 'done' ? resolve(job.result) : reject(new Error(job.error || 'Задача завершилась с ошибкой'));
+
+        const poll = () => {
+            $.getJSON(`/jobs/${jobId}`).then(job => {
+                if (onProgress) onProgress(job.progress);
+                if (job.status === 'done' || job.status === 'failed') return finish(job);
+                setTimeout(poll, 2000);
+            }).catch(reject);
+        };
+
+        if (!window.EventSource) return poll();
+        const events = new EventSource(`/jobs/${jobId}/events`);
+        events.onmessage = (event) => {
+            const job = JSON.parse(event.data);
+            if (onProgress) onProgress(job.progress);
+            if (job.status === 'done' || job.status === 'failed') {
+                events.close();
+                $.getJSON(`/jobs/${jobId}`).then(finish).catch(reject);
+            }
+        };
+        events.onerror = () => {
+            events.close();
+            poll();
+        };
+    }).finally(() => {
+        if (onProgress) onProgress({});
+    });
+}
+
+
 /**
  * =============================================================================
  *                      ОСНОВНАЯ ЛОГИКА ИНИЦИАЛИЗАЦИИ КАРТЫ
@@ -197,8 +260,11 @@ backgroundImage.onload = function () {
             // document.getElementById('do_cluster').style.cssText = 'box-shadow: 0px 0px 3px 3px #91B44AB2;';
             return alert("Сначала необходимо кластеризовать данные");
         }
-        const fields = ['distance_delta', 'weight_func_degree', 'angle_of_vision', 'weight_time_graph', 'weight_course_graph', 'search_algorithm', 'start_coords', 'end_coords'];
-        const parameters = {'points_inside': $('#points_inside').is(':checked')};
+        const fields = ['distance_delta', 'weight_func_degree', 'angle_of_vision', 'max_edge_length', 'edges_per_sector', 'sectors_count', 'weight_time_graph', 'weight_course_graph', 'search_algorithm', 'start_coords', 'end_coords'];
+        const parameters = {
+            'points_inside': $('#points_inside').is(':checked'),
+            'prune_two_hop': $('#prune_two_hop').is(':checked')
+        };
         fields.forEach(id => {
             parameters[id] = document.getElementById(id).value;
         });
@@ -210,12 +276,13 @@ backgroundImage.onload = function () {
         parameters['dataset_id'] = selectedDataset.value;
         $("#loader").show();
         try {
-            const data = await $.ajax({
+            const job = await $.ajax({
                 type: 'POST',
                 url: '/post_graphs_parameters',
                 contentType: 'application/json',
                 data: JSON.stringify(parameters)
             });
+            const data = await waitForJob(job.job_id, showJobProgress);
             geographicExtent = data[2];
             map.getLayers().getArray().filter(l => l.get('name') === 'Graph').forEach(l => map.removeLayer(l));
             const {layer: graphLayer, newPixelExtent} = await createImageLayer({
@@ -259,7 +326,7 @@ backgroundImage.onload = function () {
             legendElement.appendChild(item);
             console.log(data[3]);
         } catch (error) {
-            const errorMessage = error.responseJSON?.error || error.statusText || "Неизвестная ошибка";
+            const errorMessage = error.responseJSON?.error || error.message || error.statusText || "Неизвестная ошибка";
             alert(`Ошибка: ${errorMessage}`);
         } finally {
             $("#loader").hide();
@@ -281,12 +348,13 @@ backgroundImage.onload = function () {
         if (emptyFields.length > 0) return alert("Остались незаполненные поля: " + emptyFields.join(', '));
         $("#loader").show();
         try {
-            const data = await $.ajax({
+            const job = await $.ajax({
                 type: 'POST',
                 url: '/post_clustering_parameters',
                 contentType: 'application/json',
                 data: JSON.stringify(parameters)
             });
+            const data = await waitForJob(job.job_id, showJobProgress);
             geographicExtent = data[2];
             const [{layer: clustersLayer}, {layer: polygonsLayer, newPixelExtent}] = await Promise.all([
                 createImageLayer({
@@ -333,12 +401,43 @@ backgroundImage.onload = function () {
             item.innerHTML = Object.entries(data[1]).map(([key, value]) => `<strong>${key}</strong>: ${value}<br>`).join('');
             legendElement.appendChild(item);
         } catch (error) {
-            alert(`Ошибка при кластеризации: ${error.statusText || 'Проверьте консоль'}`);
+            alert(`Ошибка при кластеризации: ${error.message || error.statusText || 'Проверьте консоль'}`);
         } finally {
             $("#loader").hide();
         }
     }
 
+    // --- Обработка кнопки подбора eps ---
+    async function suggestEps() {
+        const fields = ['weight_distance', 'weight_speed', 'weight_course', 'min_samples', 'metric_degree'];
+        const parameters = {};
+        fields.forEach(id => {
+            parameters[id] = document.getElementById(id).value;
+        });
+        const emptyFields = fields.filter(id => !parameters[id]);
+        const selectedDataset = document.querySelector('input[name="dataset_id"]:checked');
+        if (!selectedDataset) return alert("Пожалуйста, выберите датасет!");
+        parameters['dataset_id'] = selectedDataset.value;
+        if (emptyFields.length > 0) return alert("Остались незаполненные поля: " + emptyFields.join(', '));
+        $("#loader").show();
+        try {
+            const job = await $.ajax({
+                type: 'POST',
+                url: '/suggest_eps',
+                contentType: 'application/json',
+                data: JSON.stringify(parameters)
+            });
+            const data = await waitForJob(job.job_id, showJobProgress);
+            document.getElementById('eps').value = data['eps'];
+            console.log('Отсортированные k-расстояния:', data['k_distances']);
+        } catch (error) {
+            alert(`Ошибка при подборе eps: ${error.message || error.statusText || 'Проверьте консоль'}`);
+        } finally {
+            $("#loader").hide();
+        }
+    }
+
+    document.getElementById('suggest-eps-btn').addEventListener('click', suggestEps);
     document.getElementById('do_graph').addEventListener('click', createGraph);
     document.getElementById('do_cluster').addEventListener('click', doClustering);
     window.addEventListener('resize', () => map.updateSize());
@@ -406,7 +505,13 @@ document.addEventListener('DOMContentLoaded', function () {
                 successEl = document.getElementById('upload-success'),
                 loadingEl = document.getElementById('upload-loading');
             [errorEl, successEl, loadingEl].forEach(el => el.style.display = 'none');
-            if (!document.getElementById('dataset-name').value.trim()) {
+            const appendMode = document.getElementById('append').checked;
+            const selectedDataset = document.querySelector('input[name="dataset_id"]:checked');
+            if (appendMode && !selectedDataset) {
+                errorEl.textContent = 'Выберите датасет, в который нужно дописать данные!';
+                return errorEl.style.display = 'block';
+            }
+            if (!appendMode && !document.getElementById('dataset-name').value.trim()) {
                 errorEl.textContent = 'Поле "Название датасета" обязательно для заполнения!';
                 return errorEl.style.display = 'block';
             }
@@ -414,22 +519,30 @@ document.addEventListener('DOMContentLoaded', function () {
                 errorEl.textContent = 'Пожалуйста, выберите оба файла!';
                 return errorEl.style.display = 'block';
             }
+            loadingEl.innerHTML = 'Загрузка...';
             loadingEl.style.display = 'block';
             const formData = new FormData(document.getElementById('dataset-upload-form'));
+            if (appendMode) formData.append('append_dataset_id', selectedDataset.value);
             fetch('/upload_dataset', {method: 'POST', body: formData})
                 .then(res => res.json())
                 .then(data => {
-                    if (data.success) {
-                        successEl.textContent = data.message || 'Данные успешно загружены!';
+                    if (!data.job_id) return [data.success, data.message];
+                    return waitForJob(data.job_id, progress => {
+                        loadingEl.innerHTML = formatJobProgress(progress) || 'Загрузка...';
+                    });
+                })
+                .then(([success, message]) => {
+                    if (success) {
+                        successEl.textContent = message || 'Данные успешно загружены!';
                         successEl.style.display = 'block';
                         updateDatasetList();
                     } else {
-                        errorEl.textContent = data.message || 'Ошибка загрузки!';
+                        errorEl.textContent = message || 'Ошибка загрузки!';
                         errorEl.style.display = 'block';
                     }
                 })
-                .catch(() => {
-                    errorEl.textContent = 'Ошибка соединения с сервером!';
+                .catch((error) => {
+                    errorEl.textContent = error.message || 'Ошибка соединения с сервером!';
                     errorEl.style.display = 'block';
                 })
                 .finally(() => {